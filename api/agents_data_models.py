@@ -1,15 +1,43 @@
 from pydantic import BaseModel, Field, field_validator, ValidationInfo
 from typing import Optional, Iterable, Union
+from datetime import datetime, timezone
 from jinja2 import Template
 from openai import OpenAI
 from asyncio import run
-from fuzzywuzzy import process
+from itertools import chain, zip_longest
+from llm import get_async_instructor
+from context import context_packer
+from embeddings import embed_query
+from repo_index import RepoIndex, as_repo_index
+from router import Route, router
+from search import SearchBackend, SearchHit, IterativeScan
+from sql_engine import run_sql, schema_description, validate_sql
+import asyncio
 import openai
 import instructor
+import os
+import pandas as pd
 
 
+# Seconds a single tool call may run before it is cancelled
+TOOL_TIMEOUT = float(os.getenv("TOOL_TIMEOUT", "10"))
 
-class SearchIssues(BaseModel):
+
+class RepoTool(BaseModel):
+    # Tools that run against one repo; the repo the model names is matched to
+    # the catalog passed as context={"repos": ...}, so subclasses declare
+    # `repo` with their own description
+    @field_validator("repo", check_fields=False)
+    def validate_repo(cls, v: str, info: ValidationInfo):
+        matched_repo = find_closest_repo(v, info.context["repos"])
+        if matched_repo is None:
+            raise ValueError(
+                f"Unable to match repo {v} to a known repo, the closest are {as_repo_index(info.context['repos']).shortlist(v)}"
+            )
+        return matched_repo
+
+
+class SearchIssues(RepoTool):
     """
     Use this when the user wants to get original issue information from the database 
     """
@@ -18,44 +46,92 @@ class SearchIssues(BaseModel):
     repo: str = Field(
         description="the repo to search for issues in, should be in the format of 'owner/repo'"
     )
+    keywords: Optional[str] = Field(
+        default=None,
+        description="exact words the issues must mention, such as product names, error messages or identifiers; leave empty for a purely semantic search",
+    )
+    start: Optional[datetime] = Field(
+        default=None,
+        description="only include issues opened at or after this time, when the question gives a time range",
+    )
+    end: Optional[datetime] = Field(
+        default=None,
+        description="only include issues opened before this time, when the question gives a time range",
+    )
 
-    @field_validator("repo")
-    def validate_repo(cls, v: str, info: ValidationInfo):
-        matched_repo = find_closest_repo(v, info.context["repos"])
-        if matched_repo is None:
-            raise ValueError(
-                f"Unable to match repo {v} to a list of known repos of {info.context['repos']}"
-            )
-        return matched_repo
+    async def execute(
+        self,
+        backend: SearchBackend,
+        limit: int,
+        ef_search: Optional[int] = None,
+        iterative_scan: Optional[IterativeScan] = None,
+    ) -> list[SearchHit]:
+        embedding = await embed_query(self.query) if self.query else None
+        return await backend.search(
+            "github_issues",
+            self.repo,
+            embedding,
+            limit,
+            ef_search,
+            iterative_scan,
+            self.keywords,
+            self.start,
+            self.end,
+        )
 
-    async def execute(self, conn, limit: int):
-        if self.query:
-            embedding = (
-                OpenAI()
-                .embeddings.create(input=self.query, model="text-embedding-3-small")
-                .data[0]
-                .embedding
-            )
-            args = [self.repo, limit, embedding]
-        else:
-            args = [self.repo, limit]
-            embedding = None
-
-        sql_query = Template(
-            """
-            SELECT *
-            FROM {{ table_name }}
-            WHERE repo_name = '{{ repo_name }}'
-            {%- if embedding is not none %}
-            ORDER BY embedding <=> '{{ embedding }}'
-            {%- endif %}
-            LIMIT {{ limit }}
-            """
-        ).render(table_name="github_issues", repo_name=self.repo, limit=limit, embedding=embedding)
-        cur = conn.cursor()
-        cur.execute(sql_query)
-
-        return cur
+class CountIssues(RepoTool):
+    """
+    Use this when the user asks how many issues mention a specific word, name or error in a repo
+    """
+
+    keywords: str = Field(description="the words the counted issues must mention")
+    repo: str = Field(
+        description="the repo to count issues in, should be in the format of 'owner/repo'"
+    )
+    start: Optional[datetime] = Field(
+        default=None,
+        description="only include issues opened at or after this time, when the question gives a time range",
+    )
+    end: Optional[datetime] = Field(
+        default=None,
+        description="only include issues opened before this time, when the question gives a time range",
+    )
+
+    async def execute(self, backend: SearchBackend, limit: int) -> int:
+        # answered from the full-text index, limit doesn't apply to a count
+        return await backend.count(
+            "github_issues", self.repo, self.keywords, self.start, self.end
+        )
+
+    def answer(self, count: int) -> str:
+        period = ""
+        if self.start:
+            period += f" since {self.start:%Y-%m-%d}"
+        if self.end:
+            period += f" before {self.end:%Y-%m-%d}"
+        return f"{count} issues in {self.repo} mention {self.keywords!r}{period}."
+
+
+class IssueMetrics(RepoTool):
+    """
+    Use this when the user asks how many issues were opened or closed, how long issues take to close or get a first response, or how the open issue backlog of a repo changes over time
+    """
+
+    repo: str = Field(
+        description="the repo to get metrics for, should be in the format of 'owner/repo'"
+    )
+    start: Optional[datetime] = Field(
+        default=None,
+        description="only include months from this time on, when the question gives a time range",
+    )
+    end: Optional[datetime] = Field(
+        default=None,
+        description="only include months before this time, when the question gives a time range",
+    )
+
+    async def execute(self, backend: SearchBackend, limit: int) -> list[dict]:
+        # one precomputed row per month, limit doesn't apply
+        return await backend.metrics(self.repo, self.start, self.end)
  
 class RunSQLReturnPandas(BaseModel):
     """
@@ -63,27 +139,27 @@ class RunSQLReturnPandas(BaseModel):
     """
 
     query: str = Field(description="Description of user's query")
+    sql: str = Field(
+        description=f"a single PostgreSQL SELECT statement that answers the query, naming the columns it needs. The tables are {schema_description()}"
+    )
     repos: list[str] = Field(
         description="the repos to run the query on, should be in the format of 'owner/repo'"
     )
-    async def execute(self, conn, limit: int):
-        before_issues, after_issues = self.query.split("issues", 1)  # Split at the first occurrence of "issues"
-        before_issues = before_issues.strip()
-        after_issues = after_issues.strip()
-        sql_query = Template(
-            """
-            {{ before_issues }} github_issues {{ after_issues }}
-            """
-        ).render(query=self.query)
-        print(sql_query)
-        
-        cur = conn.cursor()
-        cur.execute(sql_query)
-
-        return cur
-        
-
-class SearchSummaries(BaseModel):
+
+    @field_validator("sql")
+    def check_sql(cls, v: str):
+        # rejected SQL goes back to the model with the reason, like a bad repo
+        return validate_sql(v)
+
+    async def execute(self, backend: SearchBackend, limit: int) -> pd.DataFrame:
+        # limit is a search result count; SQL results are capped at SQL_ROW_LIMIT
+        pool = getattr(backend, "pool", None)
+        if pool is None:
+            raise ValueError("SQL queries need the postgres search backend")
+        return await run_sql(pool, self.sql)
+
+
+class SearchSummaries(RepoTool):
     """
 		This function retrieves summarized information about GitHub issues that match/are similar to a specific query, It's particularly useful for obtaining a quick snapshot of issue trends or patterns within a project.
     """
@@ -92,135 +168,365 @@ class SearchSummaries(BaseModel):
     repo: str = Field(
         description="the repo to search for issues in, should be in the format of 'owner/repo'"
     )
+    keywords: Optional[str] = Field(
+        default=None,
+        description="exact words the issues must mention, such as product names, error messages or identifiers; leave empty for a purely semantic search",
+    )
+    start: Optional[datetime] = Field(
+        default=None,
+        description="only include issues opened at or after this time, when the question gives a time range",
+    )
+    end: Optional[datetime] = Field(
+        default=None,
+        description="only include issues opened before this time, when the question gives a time range",
+    )
 
-    @field_validator("repo")
-    def validate_repo(cls, v: str, info: ValidationInfo):
-        matched_repo = find_closest_repo(v, info.context["repos"])
-        if matched_repo is None:
-            raise ValueError(
-                f"Unable to match repo {v} to a list of known repos of {info.context['repos']}"
-            )
-        return matched_repo
+    async def execute(
+        self,
+        backend: SearchBackend,
+        limit: int,
+        ef_search: Optional[int] = None,
+        iterative_scan: Optional[IterativeScan] = None,
+    ) -> list[SearchHit]:
+        embedding = await embed_query(self.query) if self.query else None
+        return await backend.search(
+            "github_issue_summaries",
+            self.repo,
+            embedding,
+            limit,
+            ef_search,
+            iterative_scan,
+            self.keywords,
+            self.start,
+            self.end,
+        )
 
-    async def execute(self, conn, limit: int):
-        if self.query:
-            embedding = (
-                OpenAI()
-                .embeddings.create(input=self.query, model="text-embedding-3-small")
-                .data[0]
-                .embedding
-            )
-        else:
-            embedding = None
-        sql_query = Template(
-            """
-            SELECT *
-            FROM {{ table_name }}
-            WHERE repo_name = '{{ repo_name }}'
-            {%- if embedding is not none %}
-            ORDER BY embedding <=> '{{ embedding }}'
-            {%- endif %}
-            LIMIT {{ limit }}
-            """
-        ).render(table_name="github_issue_summaries", repo_name=self.repo, limit=limit, embedding=embedding)
-        
-        cur = conn.cursor()
-        cur.execute(sql_query)
-
-        return cur
+# Tools the local router can pick, by the names in router.INTENT_EXAMPLES
+ROUTED_TOOLS = [SearchIssues, SearchSummaries, IssueMetrics]
 
 class Summary(BaseModel):
     chain_of_thought: str
     summary: str
 
+def summary_messages(issues: list, query: Optional[str]):
+    return [
+        {
+            "role": "system",
+            "content": """You're a helpful assistant that summarizes information about issues from a github repository. Be sure to output your response in a single paragraph that is concise and to the point.""",
+        },
+        {
+            "role": "user",
+            "content": Template(
+                """
+                Here are the relevant issues:
+                {% for issue in issues %}
+                - {{ issue.text }}
+                {% endfor %}
+                {% if query %}
+                My specific query is: {{ query }}
+                {% else %}
+                Please provide a broad summary and key insights from the issues above.
+                {% endif %}
+                """
+            ).render(issues=issues, query=query),
+        },
+    ]
+
+def metrics_context(metrics: list[dict]) -> str:
+    return Template(
+        """
+        Here are the repo's monthly issue metrics. opened and closed count the
+        issues opened and closed that month, still_open how many of the month's
+        new issues are still open and open_backlog the issues open at the end of
+        the month. Times to close (in days) and to first response (in hours) are
+        for the issues opened that month (p50 is the median, p90 the 90th
+        percentile):
+        {% for row in metrics %}
+        - {{ row['month'].strftime('%Y-%m') }}: {% for key, value in row.items() if key != 'month' %}{{ key }}={{ value if value is not number or value is integer else '%.1f' % value }}{% if not loop.last %}, {% endif %}{% endfor %}
+        {% endfor %}
+        """
+    ).render(metrics=metrics)
+
+def metrics_messages(metrics: list[dict], query: Optional[str]):
+    return [
+        {
+            "role": "system",
+            "content": """You're a helpful assistant that answers questions about the issue activity of a github repository from monthly metrics. Be sure to output your response in a single paragraph that is concise and to the point, quoting the numbers that answer the question.""",
+        },
+        {
+            "role": "user",
+            "content": metrics_context(metrics)
+            + Template(
+                """
+                {% if query %}
+                My specific query is: {{ query }}
+                {% else %}
+                Please summarize how issue activity has changed over this period.
+                {% endif %}
+                """
+            ).render(query=query),
+        },
+    ]
+
 def summarize_content(issues: list, query: Optional[str]):
     client = instructor.from_openai(OpenAI())
     return client.chat.completions.create(
-        messages=[
-            {
-                "role": "system",
-                "content": """You're a helpful assistant that summarizes information about issues from a github repository. Be sure to output your response in a single paragraph that is concise and to the point.""",
-            },
-            {
-                "role": "user",
-                "content": Template(
-                    """
-                    Here are the relevant issues:
-                    {% for issue in issues %}
-                    - {{ issue['text'] }}
-                    {% endfor %}
-                    {% if query %}
-                    My specific query is: {{ query }}
-                    {% else %}
-                    Please provide a broad summary and key insights from the issues above.
-                    {% endif %}
-                    """
-                ).render(issues=issues, query=query),
-            },
-        ],
+        messages=summary_messages(issues, query),
+        response_model=Summary,
+        model="gpt-4o-mini",
+    )
+
+async def summarize_content_async(
+    issues: list, query: Optional[str], messages: Optional[list[dict]] = None
+):
+    client = get_async_instructor()
+    return await client.chat.completions.create(
+        messages=messages or summary_messages(issues, query),
         response_model=Summary,
         model="gpt-4o-mini",
     )
-    
-def find_closest_repo(query: str, repos: list[str]) -> Union[str, None]:
-    if not query:
-        return None
 
-    best_match = process.extractOne(query, repos)
-    return best_match[0] if best_match[1] >= 80 else None
+async def summarize_content_stream(
+    issues: list, query: Optional[str], messages: Optional[list[dict]] = None
+):
+    # Yields partial Summary objects whose fields grow as tokens arrive
+    client = get_async_instructor()
+    async for partial in client.chat.completions.create_partial(
+        messages=messages or summary_messages(issues, query),
+        response_model=Summary,
+        model="gpt-4o-mini",
+    ):
+        yield partial
+
+def find_closest_repo(query: str, repos: Union[RepoIndex, list[str]]) -> Union[str, None]:
+    return as_repo_index(repos).match(query)
+
+def agent_messages(question: str, repos):
+    return [
+        {
+            "role": "system",
+            "content": "You are an AI assistant that helps users query and analyze GitHub issues stored in a PostgreSQL database. Search for summaries when the user wants to understand the trends or patterns within a project. Otherwise just get the issues and return them. Only resort to SQL queries if the other tools are not able to answer the user's query.",
+        },
+        {"role": "user", "content": Template(
+                """
+                Today's date is {{ today }}.
+                Here is the user's question: {{ question }}
+                Here is a list of repos that we have stored in our database. Choose the one that is most relevant to the user's query:
+                {% for repo in as_repo_index(repos).shortlist(question) %}
+                - {{ repo }}
+                {% endfor %}
+                """
+            ).render(
+                question=question,
+                repos=repos,
+                as_repo_index=as_repo_index,
+                today=datetime.now(timezone.utc).date().isoformat(),
+            ),
+        },
+    ]
 
 def one_step_agent(question: str, repos):
     client = instructor.from_openai(
         openai.OpenAI(), mode=instructor.Mode.PARALLEL_TOOLS
     )
 
-    repos = [
-        "rust-lang/rust",
-        "kubernetes/kubernetes",
-        "apache/spark",
-        "golang/go",
-        "tensorflow/tensorflow",
-        "MicrosoftDocs/azure-docs",
-        "pytorch/pytorch",
-        "Microsoft/TypeScript",
-        "python/cpython",
-        "facebook/react",
-        "django/django",
-        "rails/rails",
-        "bitcoin/bitcoin",
-        "nodejs/node",
-        "ocaml/opam-repository",
-        "apache/airflow",
-        "scipy/scipy",
-        "vercel/next.js",
-    ]
-
     return client.chat.completions.create(
         model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are an AI assistant that helps users query and analyze GitHub issues stored in a PostgreSQL database. Search for summaries when the user wants to understand the trends or patterns within a project. Otherwise just get the issues and return them. Only resort to SQL queries if the other tools are not able to answer the user's query.",
-            },
-            {"role": "user", "content": Template(
-                    """
-                    Here is the user's question: {{ question }}
-                    Here is a list of repos that we have stored in our database. Choose the one that is most relevant to the user's query:
-                    {% for repo in repos %}
-                    - {{ repo }}
-                    {% endfor %}
-                    """
-                ).render(question=question, repos=repos),
-            },
+        messages=agent_messages(question, repos),
+        validation_context={"repos": repos},
+        response_model=Iterable[
+            Union[
+                SearchIssues,
+                SearchSummaries,
+                CountIssues,
+                IssueMetrics,
+            ]
         ],
+    )
+
+async def one_step_agent_async(question: str, repos):
+    client = get_async_instructor(instructor.Mode.PARALLEL_TOOLS)
+
+    return await client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=agent_messages(question, repos),
         validation_context={"repos": repos},
         response_model=Iterable[
             Union[
                 SearchIssues,
                 SearchSummaries,
+                CountIssues,
+                IssueMetrics,
             ]
         ],
     )
 
+def route_tool(route: Route, question: str, repos: list[str]) -> BaseModel:
+    tool = {tool.__name__: tool for tool in ROUTED_TOOLS}[route.tool]
+    return tool.model_validate(
+        {"query": question, "repo": route.repo, "start": route.start, "end": route.end},
+        context={"repos": repos},
+    )
+
+async def select_tools(
+    question: str, repos: list[str], embedding: Optional[list[float]] = None
+) -> list[BaseModel]:
+    # The local router answers most questions from the question embedding;
+    # the tool-selection LLM gets the ones it isn't sure about
+    if embedding is not None:
+        route = await router.route(question, embedding, repos)
+        if route is not None:
+            return [route_tool(route, question, repos)]
+    tools = list(await one_step_agent_async(question, repos))
+    if tools:
+        return tools
+    # The model may answer without calling a tool; search the summaries of
+    # whatever repos the question names rather than answer from nothing
+    named = as_repo_index(repos).named(question)
+    if not named:
+        raise ValueError(
+            "Couldn't tell which repo the question is about; name one, e.g. 'kubernetes/kubernetes'"
+        )
+    return [
+        SearchSummaries.model_validate({"query": question, "repo": repo}, context={"repos": repos})
+        for repo in named
+    ]
+
+async def execute_tools(
+    tools: list[BaseModel], backend: SearchBackend, limit: int, timeout: float = TOOL_TIMEOUT
+) -> list[tuple[BaseModel, object]]:
+    """
+    Runs every tool call concurrently, cancelling any still running after
+    `timeout` seconds. Returns (tool, result) pairs in call order, where a
+    call that failed or timed out has its exception as the result. Identical
+    calls run once. Raises the first error if every call failed.
+    """
+    tools = list({tool.model_dump_json(): tool for tool in tools}.values())
+    results = await asyncio.gather(
+        *(asyncio.wait_for(tool.execute(backend, limit), timeout) for tool in tools),
+        return_exceptions=True,
+    )
+    if results and all(isinstance(result, Exception) for result in results):
+        raise results[0]
+    return list(zip(tools, results))
+
+def merge_issues(results: list[list[SearchHit]]) -> list[SearchHit]:
+    # Interleaves the searches so each one's best matches come first, keeping
+    # the first copy of an issue found by more than one of them
+    merged, seen = [], set()
+    for row in chain.from_iterable(zip_longest(*results)):
+        if row is None:
+            continue
+        key = (row.repo_name, row.issue_id)
+        if key not in seen:
+            seen.add(key)
+            merged.append(row)
+    return merged
+
+def results_messages(results: list[tuple[BaseModel, object]], query: Optional[str]):
+    # One summarization prompt over everything the tool calls returned: the
+    # merged issues, packed into the context token budget, or the metrics
+    # when nothing was searched, with counts and any other metrics passed
+    # along as context
+    issues = context_packer.pack(
+        merge_issues(
+            [result for tool, result in results if isinstance(tool, (SearchIssues, SearchSummaries))]
+        ),
+        query,
+    )
+    metrics = [
+        {"repo_name": tool.repo, **row}
+        for tool, result in results
+        if isinstance(tool, IssueMetrics)
+        for row in result
+    ]
+    counts = [tool.answer(result) for tool, result in results if isinstance(tool, CountIssues)]
+
+    if metrics and not issues:
+        messages = metrics_messages(metrics, query)
+    else:
+        messages = summary_messages(issues, query)
+        if metrics:
+            messages.insert(1, {"role": "user", "content": metrics_context(metrics)})
+    if counts:
+        messages.insert(1, {"role": "user", "content": "\n".join(counts)})
+    return messages
+
+def tool_repos(results: list[tuple[BaseModel, object]]) -> list[str]:
+    return list(dict.fromkeys(tool.repo for tool, _ in results))
+
+async def answer_question(
+    question: str,
+    repos: list[str],
+    backend: SearchBackend,
+    limit: int = 10,
+    embedding: Optional[list[float]] = None,
+):
+    # Returns the summary and the repos it was drawn from; the question's
+    # embedding, when the caller has it, lets the router skip tool selection
+    tools = await select_tools(question, repos, embedding)
+    results = []
+    for tool, result in await execute_tools(tools, backend, limit):
+        if isinstance(result, Exception):
+            print(f"{type(tool).__name__} for {tool.repo} failed: {result!r}")
+        else:
+            results.append((tool, result))
+
+    if results and all(isinstance(tool, CountIssues) for tool, _ in results):
+        return " ".join(tool.answer(result) for tool, result in results), tool_repos(results)
+    summary = await summarize_content_async([], question, results_messages(results, question))
+    return summary.summary, tool_repos(results)
+
+async def answer_question_stream(
+    question: str,
+    repos: list[str],
+    backend: SearchBackend,
+    limit: int = 10,
+    embedding: Optional[list[float]] = None,
+):
+    # Same pipeline as answer_question, yielding (event, data) as each stage
+    # finishes and then the summary text as it is generated. repo and tool
+    # name the first tool call; repos and tools list all of them.
+    tools = await select_tools(question, repos, embedding)
+    yield "repo_resolved", {
+        "repo": tools[0].repo,
+        "tool": type(tools[0]).__name__,
+        "repos": list(dict.fromkeys(tool.repo for tool in tools)),
+        "tools": [type(tool).__name__ for tool in tools],
+    }
+
+    results = []
+    for tool, result in await execute_tools(tools, backend, limit):
+        if isinstance(result, Exception):
+            yield "tool_failed", {
+                "repo": tool.repo,
+                "tool": type(tool).__name__,
+                "detail": repr(result),
+            }
+        else:
+            results.append((tool, result))
+    repos = tool_repos(results)
+
+    if results and all(isinstance(tool, CountIssues) for tool, _ in results):
+        yield "issues_counted", {"count": sum(result for _, result in results)}
+        response = " ".join(tool.answer(result) for tool, result in results)
+        yield "done", {"response": response, "repo": repos[0] if repos else None, "repos": repos}
+        return
+    if any(isinstance(tool, IssueMetrics) for tool, _ in results):
+        months = sum(len(result) for tool, result in results if isinstance(tool, IssueMetrics))
+        yield "metrics_retrieved", {"months": months}
+    if any(isinstance(tool, (SearchIssues, SearchSummaries)) for tool, _ in results):
+        issues = merge_issues(
+            [result for tool, result in results if isinstance(tool, (SearchIssues, SearchSummaries))]
+        )
+        yield "issues_retrieved", {"count": len(issues)}
+
+    summary = ""
+    async for partial in summarize_content_stream([], question, results_messages(results, question)):
+        if partial.summary and len(partial.summary) > len(summary):
+            yield "token", {"text": partial.summary[len(summary):]}
+            summary = partial.summary
+    yield "done", {"response": summary, "repo": repos[0] if repos else None, "repos": repos}
+
 #if __name__ == "__main__":
     #run()
\ No newline at end of file
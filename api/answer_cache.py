@@ -0,0 +1,115 @@
+from psycopg import errors
+from typing import Optional
+import numpy as np
+import os
+import time
+
+
+class AnswerCache:
+    """
+    Semantic cache of /chat answers, grouped by the repo each answer was
+    searched in. A question whose embedding has at least `threshold` cosine
+    similarity to an earlier question gets the earlier answer back. Entries
+    expire after ttl_seconds, and a repo's entries are dropped as soon as
+    ingestion bumps or removes its row in repo_ingest_stamps.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.92,
+        ttl_seconds: float = 3600,
+        max_entries_per_repo: int = 256,
+        poll_interval: float = 30,
+    ):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries_per_repo = max_entries_per_repo
+        self.poll_interval = poll_interval
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.latency_saved = 0.0
+        # repo -> [(expires_at, unit question embedding, answer, seconds to answer)]
+        self._entries: dict[str, list[tuple[float, np.ndarray, str, float]]] = {}
+        self._stamps: Optional[dict[str, object]] = None
+        self._polled_at = 0.0
+
+    @staticmethod
+    def _unit(embedding: list[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def get(self, embedding: list[float], repos: list[str]) -> Optional[str]:
+        # Only answers from the repos the question resolves to are considered;
+        # a question that resolves to none is a miss, an answer about another
+        # repo would be wrong however similar the wording
+        now = time.time()
+        query = self._unit(embedding)
+        best, best_similarity = None, self.threshold
+        for repo in repos:
+            entries = [e for e in self._entries.get(repo, []) if e[0] > now]
+            if not entries:
+                self._entries.pop(repo, None)
+                continue
+            self._entries[repo] = entries
+            similarities = np.stack([e[1] for e in entries]) @ query
+            i = int(np.argmax(similarities))
+            if similarities[i] >= best_similarity:
+                best, best_similarity = entries[i], float(similarities[i])
+
+        if best is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.latency_saved += best[3]
+        return best[2]
+
+    def put(self, embedding: list[float], answer: str, repo: str, latency: float):
+        entries = self._entries.setdefault(repo, [])
+        entries.append((time.time() + self.ttl_seconds, self._unit(embedding), answer, latency))
+        del entries[: -self.max_entries_per_repo]
+
+    def invalidate(self, repo: str):
+        if self._entries.pop(repo, None):
+            self.invalidations += 1
+
+    async def refresh(self, pool):
+        # Polls at most once per poll_interval; the first poll only records the
+        # current stamps since nothing cached predates it
+        if time.time() - self._polled_at < self.poll_interval:
+            return
+        self._polled_at = time.time()
+        try:
+            async with pool.connection() as conn:
+                cur = await conn.execute("SELECT repo_name, ingested_at FROM repo_ingest_stamps")
+                stamps = {row["repo_name"]: row["ingested_at"] for row in await cur.fetchall()}
+        except errors.UndefinedTable:
+            # database set up before stamps existed; only the TTL applies
+            return
+
+        if self._stamps is not None:
+            for repo, ingested_at in stamps.items():
+                if self._stamps.get(repo) != ingested_at:
+                    self.invalidate(repo)
+            # repos a reset dropped lose their stamps
+            for repo in self._stamps.keys() - stamps.keys():
+                self.invalidate(repo)
+        self._stamps = stamps
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": sum(len(entries) for entries in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "latency_saved_seconds": self.latency_saved,
+            "invalidations": self.invalidations,
+        }
+
+
+answer_cache = AnswerCache(
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.92")),
+    ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+    poll_interval=float(os.getenv("ANSWER_CACHE_POLL_INTERVAL", "30")),
+)
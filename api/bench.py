@@ -0,0 +1,569 @@
+# Benchmarks for the /chat pipeline. Run from api/, e.g.
+#   python bench.py chat-load --requests 200 --latency 0.2
+#   python bench.py chat-stream --requests 10 --latency 0.3
+#   python bench.py vector-search --table github_issue_summaries
+#   python bench.py vector-storage --table github_issues --queries 100
+#   python bench.py local-search --rows-per-repo 5000
+# Everything that talks to OpenAI is pointed at a local stub server so the
+# numbers measure our own overhead and concurrency, not OpenAI's. chat-stream
+# runs the API itself over a generated local index; the database benchmarks
+# need SUPABASE_URI pointing at a loaded database.
+from aiohttp import web
+from argparse import ArgumentParser
+from functools import lru_cache
+from asyncio import run, gather, sleep, Semaphore, new_event_loop, set_event_loop
+from dotenv import load_dotenv
+from jinja2 import Template
+from pgvector.psycopg import Vector
+from psycopg import sql
+from repo_index import DEFAULT_REPOS
+from statistics import median
+from threading import Thread, Event
+from time import perf_counter, sleep as sleep_sync
+from typing import Any
+import hashlib
+import json
+import os
+import random
+
+
+REPOS = DEFAULT_REPOS
+
+QUESTIONS = [
+    "What are the main issues people face with endpoint connectivity between different pods in kubernetes?",
+    "What were some of the big features that were implemented in the last 4 months for the scipy repo?",
+    "How many issues mentioned issues with Cohere in the 'vercel/next.js' repository?",
+    "What problems do users hit when compiling pytorch from source?",
+]
+
+LEGACY_SEARCH_SQL = """
+SELECT *
+FROM {{ table_name }}
+WHERE repo_name = '{{ repo_name }}'
+ORDER BY embedding <=> '{{ embedding }}'
+LIMIT {{ limit }}
+"""
+
+# Stubbed completions produce text this long and take token_latency per token
+STUB_TEXT_TOKENS = 200
+
+FAKE_ROWS = [
+    {"issue_id": i, "text": f"Stub issue {i} about pod networking and CNI plugins."}
+    for i in range(10)
+]
+
+
+@lru_cache(maxsize=1024)
+def stub_embedding(text: str, dimensions: int = 1536) -> list[float]:
+    rng = random.Random(hashlib.sha256(text.encode()).digest())
+    vector = [rng.gauss(0, 1) for _ in range(dimensions)]
+    norm = sum(v * v for v in vector) ** 0.5
+    return [v / norm for v in vector]
+
+
+def stub_arguments(schema: dict, name: str = "") -> Any:
+    # Fill a JSON schema with plausible values so instructor can validate it
+    if "anyOf" in schema:
+        options = [s for s in schema["anyOf"] if s.get("type") != "null"]
+        return stub_arguments(options[0], name) if options else None
+    if "enum" in schema:
+        return schema["enum"][0]
+    if schema.get("format") == "date-time":
+        return "2024-01-01T00:00:00Z"
+    kind = schema.get("type")
+    if kind == "object":
+        return {
+            key: stub_arguments(value, key)
+            for key, value in schema.get("properties", {}).items()
+        }
+    if kind == "array":
+        return [stub_arguments(schema.get("items", {}), name)]
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return False
+    if "repo" in name:
+        return "kubernetes/kubernetes"
+    if name in ("summary", "chain_of_thought"):
+        # long enough that streaming it token by token is measurable
+        return " ".join(f"stub {name} token {i}." for i in range(STUB_TEXT_TOKENS // 4))
+    return f"stub {name}"
+
+
+def stub_tool_call(body: dict) -> dict:
+    tools = [tool["function"] for tool in body.get("tools", [])]
+    names = [tool["name"] for tool in tools]
+    tool = tools[names.index("SearchSummaries")] if "SearchSummaries" in names else tools[0]
+    return {
+        "id": "call_stub",
+        "type": "function",
+        "function": {
+            "name": tool["name"],
+            "arguments": json.dumps(stub_arguments(tool["parameters"])),
+        },
+    }
+
+
+def stub_chunks(text: str, size: int = 4) -> list[str]:
+    # ~4 characters per token
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+def create_stub_app(latency: float, token_latency: float = 0.0) -> web.Application:
+    # latency is time to first token; each generated token adds token_latency
+    async def embeddings(request: web.Request):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        await sleep(latency)
+        return web.json_response(
+            {
+                "object": "list",
+                "model": body["model"],
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": stub_embedding(text)}
+                    for i, text in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": 8, "total_tokens": 8},
+            }
+        )
+
+    async def chat_completions(request: web.Request):
+        body = await request.json()
+        message = {"role": "assistant", "content": None}
+        if body.get("tools"):
+            message["tool_calls"] = [stub_tool_call(body)]
+            generated = message["tool_calls"][0]["function"]["arguments"]
+        else:
+            message["content"] = "stub"
+            generated = message["content"]
+        completion = {
+            "id": "chatcmpl-stub",
+            "created": 0,
+            "model": body["model"],
+        }
+        await sleep(latency)
+
+        if body.get("stream"):
+            return await stream_completion(request, completion, message)
+
+        await sleep(token_latency * len(stub_chunks(generated)))
+        return web.json_response(
+            {
+                **completion,
+                "object": "chat.completion",
+                "choices": [
+                    {"index": 0, "message": message, "finish_reason": "stop"}
+                ],
+                "usage": {"prompt_tokens": 8, "completion_tokens": 8, "total_tokens": 16},
+            }
+        )
+
+    async def stream_completion(request: web.Request, completion: dict, message: dict):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason=None):
+            chunk = {
+                **completion,
+                "object": "chat.completion.chunk",
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        if message.get("tool_calls"):
+            call = message["tool_calls"][0]
+            await send(
+                {
+                    "role": "assistant",
+                    "tool_calls": [
+                        {
+                            "index": 0,
+                            "id": call["id"],
+                            "type": "function",
+                            "function": {"name": call["function"]["name"], "arguments": ""},
+                        }
+                    ],
+                }
+            )
+            for piece in stub_chunks(call["function"]["arguments"]):
+                await sleep(token_latency)
+                await send({"tool_calls": [{"index": 0, "function": {"arguments": piece}}]})
+        else:
+            for piece in stub_chunks(message["content"]):
+                await sleep(token_latency)
+                await send({"content": piece})
+        await send({}, finish_reason="stop")
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/embeddings", embeddings)
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    return app
+
+
+def start_stub_server(latency: float, port: int = 8765, token_latency: float = 0.0) -> str:
+    # The stub runs on its own thread and loop, so blocking clients in the
+    # benchmark loop can't stall it.
+    ready = Event()
+
+    def serve():
+        loop = new_event_loop()
+        set_event_loop(loop)
+        runner = web.AppRunner(create_stub_app(latency, token_latency))
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", port).start())
+        ready.set()
+        loop.run_forever()
+
+    Thread(target=serve, daemon=True).start()
+    ready.wait()
+    base_url = f"http://127.0.0.1:{port}/v1"
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ["OPENAI_API_KEY"] = "stub"
+    return base_url
+
+
+def report(name: str, n_requests: int, elapsed: float):
+    print(
+        f"{name:<10} {n_requests} requests in {elapsed:.2f}s "
+        f"-> {n_requests / elapsed:.1f} req/s"
+    )
+
+
+async def bench_chat_load(n_requests: int, concurrency: int, latency: float):
+    from openai import OpenAI
+    from embeddings import embed_query
+    from agents_data_models import (
+        one_step_agent,
+        one_step_agent_async,
+        summarize_content,
+        summarize_content_async,
+    )
+
+    start_stub_server(latency)
+    questions = [QUESTIONS[i % len(QUESTIONS)] for i in range(n_requests)]
+    print(
+        f"tool selection -> query embedding -> summary, {latency * 1000:.0f}ms stub "
+        f"latency per call (database search excluded)"
+    )
+
+    async def chat_blocking(question: str):
+        tool = list(one_step_agent(question, REPOS))[0]
+        OpenAI().embeddings.create(input=tool.query, model="text-embedding-3-small")
+        return summarize_content(FAKE_ROWS, question).summary
+
+    semaphore = Semaphore(concurrency)
+
+    async def chat_async(question: str):
+        async with semaphore:
+            tool = list(await one_step_agent_async(question, REPOS))[0]
+            await embed_query(tool.query)
+            return (await summarize_content_async(FAKE_ROWS, question)).summary
+
+    # The blocking path stalls the loop, so a handful of requests is enough
+    n_blocking = min(n_requests, 10)
+    start = perf_counter()
+    await gather(*[chat_blocking(q) for q in questions[:n_blocking]])
+    report("blocking", n_blocking, perf_counter() - start)
+
+    await chat_async(questions[0])  # warm up the shared client
+    start = perf_counter()
+    await gather(*[chat_async(q) for q in questions])
+    report("async", n_requests, perf_counter() - start)
+
+
+def start_api_server(port: int = 8766) -> str:
+    import uvicorn
+    from main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        sleep_sync(0.05)
+    return f"http://127.0.0.1:{port}"
+
+
+def build_stub_index(directory: str, rows_per_repo: int = 50):
+    # A local index over stub issues for every repo, so the API can answer
+    # without a database
+    from datetime import datetime, timedelta, timezone
+    from local_index import LocalIndexBuilder
+
+    opened = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for table_name in ["github_issues", "github_issue_summaries"]:
+        builder = LocalIndexBuilder(directory, table_name)
+        for repo_name in REPOS:
+            for i in range(rows_per_repo):
+                text = f"Stub issue {i} in {repo_name} about pod networking and CNI plugins."
+                row = {
+                    "issue_id": i,
+                    "repo_name": repo_name,
+                    "text": text,
+                    "label": "OPEN",
+                    "start_ts": opened + timedelta(days=i),
+                    "end_ts": None,
+                }
+                builder.add(row, stub_embedding(text))
+        builder.finish()
+
+
+async def bench_chat_stream(n_requests: int, latency: float, token_latency: float):
+    import httpx
+    import tempfile
+
+    # No question may be answered from the answer cache, cosine similarity never reaches 2
+    os.environ["ANSWER_CACHE_THRESHOLD"] = "2"
+    # Searches run against a generated local index, so only the stubbed
+    # OpenAI calls take time and no database is needed
+    # (set before anything imports search, which reads them)
+    directory = tempfile.mkdtemp(prefix="bench-index-")
+    os.environ["SEARCH_BACKEND"] = "local"
+    os.environ["LOCAL_INDEX_PATH"] = directory
+    build_stub_index(directory)
+    start_stub_server(latency, token_latency=token_latency)
+    base_url = start_api_server()
+    print(
+        f"{latency * 1000:.0f}ms stub latency to first token, "
+        f"{token_latency * 1000:.0f}ms per token, {n_requests} sequential requests"
+    )
+    print(f"{'':<14} {'p50 TTFB ms':>12} {'p50 total ms':>13}")
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120) as client:
+        for endpoint in ["/chat", "/chat/stream"]:
+            ttfb, total = [], []
+            for i in range(n_requests):
+                question = QUESTIONS[i % len(QUESTIONS)]
+                start = perf_counter()
+                first_byte = None
+                async with client.stream("POST", endpoint, json={"content": question}) as response:
+                    response.raise_for_status()
+                    async for _ in response.aiter_raw():
+                        if first_byte is None:
+                            first_byte = perf_counter() - start
+                ttfb.append(first_byte)
+                total.append(perf_counter() - start)
+            print(f"{endpoint:<14} {median(ttfb) * 1000:>12.0f} {median(total) * 1000:>13.0f}")
+
+
+async def explain_timings(conn, query, params=None) -> tuple[float, float]:
+    cur = await conn.execute(
+        sql.SQL("EXPLAIN (ANALYZE, SUMMARY, FORMAT JSON) ") + query, params
+    )
+    plan = (await cur.fetchone())["QUERY PLAN"][0]
+    return plan["Planning Time"], plan["Execution Time"]
+
+
+async def bench_vector_search(table_name: str, repo_name: str, iterations: int):
+    from db import get_pool
+    from search import search_query
+
+    pool = await get_pool()
+    embedding = stub_embedding("endpoint connectivity between pods")
+    limit = 10
+
+    legacy_sql = Template(LEGACY_SEARCH_SQL).render(
+        table_name=table_name, repo_name=repo_name, limit=limit, embedding=embedding
+    )
+    query = search_query(table_name, with_embedding=True)
+    params = {"repo_name": repo_name, "embedding": Vector(embedding), "limit": limit}
+
+    async with pool.connection() as conn:
+        query_text = query.as_string(conn)
+        legacy_plan = await explain_timings(conn, sql.SQL(legacy_sql))
+        prepared_plan = await explain_timings(conn, query, params)
+
+        legacy_times = []
+        for _ in range(iterations):
+            start = perf_counter()
+            await (await conn.execute(legacy_sql)).fetchall()
+            legacy_times.append(perf_counter() - start)
+
+        prepared_times = []
+        for _ in range(iterations):
+            start = perf_counter()
+            await (await conn.execute(query, params, prepare=True)).fetchall()
+            prepared_times.append(perf_counter() - start)
+
+    # Request bytes only: the legacy path re-sends the whole statement, the
+    # prepared path sends the statement once and then just binds parameters.
+    bind_bytes = len(repo_name.encode()) + len(Vector._to_db_binary(embedding)) + 8
+    legacy_bytes = len(legacy_sql.encode())
+
+    print(f"{table_name} / {repo_name}, {iterations} iterations")
+    print(f"{'':<10} {'plan ms':>8} {'exec ms':>8} {'p50 ms':>8} {'bytes/query':>12}")
+    print(
+        f"{'jinja':<10} {legacy_plan[0]:>8.2f} {legacy_plan[1]:>8.2f} "
+        f"{median(legacy_times) * 1000:>8.2f} {legacy_bytes:>12}"
+    )
+    print(
+        f"{'prepared':<10} {prepared_plan[0]:>8.2f} {prepared_plan[1]:>8.2f} "
+        f"{median(prepared_times) * 1000:>8.2f} {bind_bytes:>12}"
+        f"  (+{len(query_text.encode())} once per connection)"
+    )
+
+
+async def bench_vector_storage(table_name: str, repos: list[str], n_queries: int, limit: int = 10):
+    from db import get_pool
+    from search import (
+        hnsw_index_sql,
+        repo_hnsw_index_name,
+        rerank_candidates,
+        search_query,
+        VECTOR_STORAGE,
+    )
+
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        # Stored embeddings of the repos' own rows stand in for questions
+        cur = await conn.execute(
+            sql.SQL(
+                "SELECT repo_name, embedding FROM {} WHERE repo_name = ANY(%s) ORDER BY random() LIMIT %s"
+            ).format(sql.Identifier(table_name)),
+            (repos, n_queries),
+        )
+        queries = [(row["repo_name"], Vector(row["embedding"])) for row in await cur.fetchall()]
+
+        # Ground truth is the exact ranking, read with the vector indexes off
+        exact = []
+        query = search_query(table_name, True, storage="full")
+        for repo_name, embedding in queries:
+            async with conn.transaction():
+                await conn.execute("SELECT set_config('enable_indexscan', 'off', true)")
+                cur = await conn.execute(
+                    query, {"repo_name": repo_name, "embedding": embedding, "limit": limit}
+                )
+                exact.append({row["issue_id"] for row in await cur.fetchall()})
+
+    print(f"{table_name}, {len(repos)} repos, {len(queries)} queries, recall@{limit}")
+    print(f"{'':<10} {'index MB':>9} {'build s':>8} {'p50 ms':>8} {'p99 ms':>8} {'recall':>7}")
+    for storage in ["full", "halfvec", "binary"]:
+        index_names = [repo_hnsw_index_name(table_name, repo, storage) for repo in repos]
+        async with pool.connection() as conn:
+            cur = await conn.execute(
+                "SELECT indexname FROM pg_indexes WHERE indexname = ANY(%s)", (index_names,)
+            )
+            existing = {row["indexname"] for row in await cur.fetchall()}
+            start = perf_counter()
+            for repo in repos:
+                await conn.execute(hnsw_index_sql(table_name, repo, storage))
+            build = perf_counter() - start
+            cur = await conn.execute(
+                "SELECT sum(hypertable_index_size(name::regclass)) AS size FROM unnest(%s::text[]) name",
+                (index_names,),
+            )
+            size = (await cur.fetchone())["size"] or 0
+
+            query = search_query(table_name, True, storage=storage)
+            times, hits = [], 0
+            for (repo_name, embedding), expected in zip(queries, exact):
+                params = {
+                    "repo_name": repo_name,
+                    "embedding": embedding,
+                    "limit": limit,
+                    **rerank_candidates(limit, storage),
+                }
+                start = perf_counter()
+                rows = await (await conn.execute(query, params, prepare=True)).fetchall()
+                times.append(perf_counter() - start)
+                hits += len(expected & {row["issue_id"] for row in rows})
+
+            # Leave the database with only the indexes it had plus the
+            # configured storage's
+            if storage != VECTOR_STORAGE:
+                for index_name in set(index_names) - existing:
+                    await conn.execute(
+                        sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(index_name))
+                    )
+        times.sort()
+        built = f"{build:>8.1f}" if len(existing) < len(index_names) else f"{'-':>8}"
+        print(
+            f"{storage:<10} {size / 1e6:>9.1f} {built} {median(times) * 1000:>8.2f} "
+            f"{times[int(len(times) * 0.99)] * 1000:>8.2f} "
+            f"{hits / max(sum(len(e) for e in exact), 1):>7.3f}"
+        )
+
+
+async def bench_local_search(rows_per_repo: int, iterations: int, hnsw: bool):
+    import numpy as np
+    import tempfile
+    from local_index import LocalIndexBuilder, LocalSearch
+
+    # Synthetic embeddings, the scan cost only depends on the matrix shape
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(rows_per_repo * len(REPOS), 1536)).astype(np.float32)
+    queries = rng.normal(size=(iterations, 1536)).astype(np.float32)
+    print(f"{len(REPOS)} repos x {rows_per_repo} rows, 1536 dimensions, {iterations} searches")
+    print(f"{'':<10} {'p50 ms':>8} {'p99 ms':>8} {'MB':>8}")
+
+    for dtype in ["float32", "float16", "int8"]:
+        with tempfile.TemporaryDirectory() as directory:
+            builder = LocalIndexBuilder(directory, "github_issue_summaries", dtype)
+            for i, embedding in enumerate(embeddings):
+                builder.add({"issue_id": i, "repo_name": REPOS[i % len(REPOS)]}, embedding)
+            builder.finish(hnsw)
+            backend = LocalSearch(directory)
+            index = backend.index("github_issue_summaries")
+
+            times = []
+            for i, query in enumerate(queries):
+                start = perf_counter()
+                await backend.search(
+                    "github_issue_summaries",
+                    REPOS[i % len(REPOS)],
+                    query,
+                    limit=10,
+                    ef_search=40 if hnsw else None,
+                )
+                times.append(perf_counter() - start)
+            times.sort()
+            print(
+                f"{dtype:<10} {median(times) * 1000:>8.2f} "
+                f"{times[int(len(times) * 0.99)] * 1000:>8.2f} {index.vectors.nbytes / 1e6:>8.0f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    chat_load = subparsers.add_parser("chat-load")
+    chat_load.add_argument("--requests", type=int, default=200)
+    chat_load.add_argument("--concurrency", type=int, default=50)
+    chat_load.add_argument("--latency", type=float, default=0.2)
+
+    chat_stream = subparsers.add_parser("chat-stream")
+    chat_stream.add_argument("--requests", type=int, default=10)
+    chat_stream.add_argument("--latency", type=float, default=0.3)
+    chat_stream.add_argument("--token-latency", type=float, default=0.01)
+
+    vector_search = subparsers.add_parser("vector-search")
+    vector_search.add_argument("--table", default="github_issue_summaries")
+    vector_search.add_argument("--repo", default="kubernetes/kubernetes")
+    vector_search.add_argument("--iterations", type=int, default=50)
+
+    vector_storage = subparsers.add_parser("vector-storage")
+    vector_storage.add_argument("--table", default="github_issues")
+    vector_storage.add_argument("--repos", nargs="+", default=REPOS)
+    vector_storage.add_argument("--queries", type=int, default=100)
+
+    local_search = subparsers.add_parser("local-search")
+    local_search.add_argument("--rows-per-repo", type=int, default=5000)
+    local_search.add_argument("--iterations", type=int, default=200)
+    local_search.add_argument("--hnsw", action="store_true")
+
+    args = parser.parse_args()
+    load_dotenv()
+    if args.benchmark == "chat-load":
+        run(bench_chat_load(args.requests, args.concurrency, args.latency))
+    elif args.benchmark == "chat-stream":
+        run(bench_chat_stream(args.requests, args.latency, args.token_latency))
+    elif args.benchmark == "vector-search":
+        run(bench_vector_search(args.table, args.repo, args.iterations))
+    elif args.benchmark == "vector-storage":
+        run(bench_vector_storage(args.table, args.repos, args.queries))
+    elif args.benchmark == "local-search":
+        run(bench_local_search(args.rows_per_repo, args.iterations, args.hnsw))
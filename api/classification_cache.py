@@ -0,0 +1,89 @@
+from pydantic import BaseModel
+from threading import Lock
+from typing import Optional, Type, TypeVar
+import hashlib
+import json
+import sqlite3
+
+
+T = TypeVar("T", bound=BaseModel)
+
+
+class ClassificationCache:
+    """
+    Persistent cache of LLM classification results in a local SQLite file.
+    Entries are keyed by everything that determines the output: model, prompt
+    template, response schema, repo and issue text. Changing any of them
+    misses the cache instead of returning a stale result.
+    """
+
+    def __init__(self, path: str):
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+        self.tokens_spent = 0
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS classifications (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                total_tokens INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        self._db.commit()
+
+    @staticmethod
+    def key(
+        model: str,
+        prompt_template: str,
+        response_model: Type[BaseModel],
+        repo_name: str,
+        issue_text: str,
+    ) -> str:
+        content = json.dumps(
+            [
+                model,
+                prompt_template,
+                response_model.model_json_schema(),
+                repo_name,
+                issue_text,
+            ],
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get(self, key: str, response_model: Type[T]) -> Optional[T]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result, total_tokens FROM classifications WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.tokens_saved += row[1]
+            return response_model.model_validate_json(row[0])
+
+    def put(self, key: str, result: BaseModel, total_tokens: int):
+        with self._lock:
+            self.tokens_spent += total_tokens
+            self._db.execute(
+                "INSERT OR REPLACE INTO classifications (key, result, total_tokens) VALUES (?, ?, ?)",
+                (key, result.model_dump_json(), total_tokens),
+            )
+            self._db.commit()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "tokens_spent": self.tokens_spent,
+        }
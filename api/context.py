@@ -0,0 +1,164 @@
+from search import SearchHit
+from typing import Iterator, Optional
+import os
+import re
+import tiktoken
+
+
+# Issue text a summary prompt may carry, in tokens of SUMMARY_MODEL. Each issue
+# is cut to CONTEXT_ISSUE_TOKENS first, so one long issue can't crowd out the
+# rest of the results.
+SUMMARY_MODEL = "gpt-4o-mini"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_ISSUE_TOKENS = int(os.getenv("CONTEXT_ISSUE_TOKENS", "600"))
+# Hits whose word shingles overlap an already packed hit's this much (Jaccard)
+# are dropped as near duplicates, e.g. an issue and its summary
+DUPLICATE_SIMILARITY = float(os.getenv("CONTEXT_DUPLICATE_SIMILARITY", "0.8"))
+# MMR trade-off between relevance (1.0) and novelty against what's packed (0.0)
+MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))
+# Packing stops once less than this is left, rather than add a stub of an issue
+MIN_EXCERPT_TOKENS = 64
+# Rough characters per token, to pick an excerpt before counting it exactly
+CHARS_PER_TOKEN = 4
+SHINGLE_WORDS = 3
+# Near duplicates are told apart by their opening this many characters, which
+# keeps comparisons cheap however long the issues are
+SHINGLE_CHARS = 2000
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+SENTENCE_PATTERN = re.compile(r"[^\n.!?]*(?:[.!?]+|\n+|$)")
+
+
+def shingles(text: str, n: int = SHINGLE_WORDS) -> set[tuple[str, ...]]:
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < n:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i : i + n]) for i in range(len(words) - n + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def relevance(hits: list[SearchHit]) -> list[float]:
+    # 1 - cosine distance where the search had an embedding; otherwise the
+    # hit's position, since keyword and merged results arrive best first
+    return [
+        1.0 - hit.distance if hit.distance is not None else 1.0 - i / len(hits)
+        for i, hit in enumerate(hits)
+    ]
+
+
+class ContextPacker:
+    """
+    Turns search hits into the issue text of a summary prompt: drops near
+    duplicates, orders the rest by maximal marginal relevance so similar
+    issues don't all make the cut, cuts each issue to the sentences that
+    mention the question's words, and stops at token_budget tokens.
+    """
+
+    def __init__(
+        self,
+        model: str = SUMMARY_MODEL,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+        issue_tokens: int = CONTEXT_ISSUE_TOKENS,
+        duplicate_similarity: float = DUPLICATE_SIMILARITY,
+        mmr_lambda: float = MMR_LAMBDA,
+    ):
+        self.model = model
+        self.token_budget = token_budget
+        self.issue_tokens = issue_tokens
+        self.duplicate_similarity = duplicate_similarity
+        self.mmr_lambda = mmr_lambda
+        self.packs = 0
+        self.hits = 0
+        self.packed = 0
+        self.duplicates = 0
+        self.excerpted = 0
+        self.tokens = 0
+        self._encoding = None
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        # Loaded lazily, the BPE ranks are fetched/cached on first use
+        if self._encoding is None:
+            self._encoding = tiktoken.encoding_for_model(self.model)
+        return self._encoding
+
+    def order(self, hits: list[SearchHit]) -> Iterator[SearchHit]:
+        # Greedy MMR over word shingles, which need no embeddings on the hits.
+        # A generator, so packing stops paying for it once the budget is full.
+        scores = relevance(hits)
+        sets = [shingles((hit.text or "")[:SHINGLE_CHARS]) for hit in hits]
+        remaining = list(range(len(hits)))
+        novelty = [0.0] * len(hits)  # max similarity to anything selected
+        while remaining:
+            best = max(
+                remaining,
+                key=lambda i: self.mmr_lambda * scores[i] - (1 - self.mmr_lambda) * novelty[i],
+            )
+            remaining.remove(best)
+            yield hits[best]
+            for i in remaining:
+                novelty[i] = max(novelty[i], jaccard(sets[i], sets[best]))
+            duplicates = [i for i in remaining if novelty[i] >= self.duplicate_similarity]
+            self.duplicates += len(duplicates)
+            remaining = [i for i in remaining if i not in duplicates]
+
+    def excerpt(self, text: str, query: Optional[str], max_tokens: int) -> tuple[str, int]:
+        # The issue's opening sentence, then the sentences sharing the most
+        # words with the query, in their original order, up to about
+        # max_tokens; the result is then cut to exactly max_tokens
+        max_chars = max_tokens * CHARS_PER_TOKEN
+        if len(text) > max_chars and text.strip():
+            sentences = [s for s in SENTENCE_PATTERN.findall(text) if s.strip()]
+            # words under three letters are mostly stop words
+            terms = {word for word in WORD_PATTERN.findall((query or "").lower()) if len(word) > 2}
+            ranked = range(1, len(sentences))
+            if terms:
+                ranked = sorted(
+                    ranked,
+                    key=lambda i: -len(terms.intersection(WORD_PATTERN.findall(sentences[i].lower()))),
+                )
+            kept, length = {0}, len(sentences[0])
+            for i in ranked:
+                if length + len(sentences[i]) > max_chars:
+                    continue
+                kept.add(i)
+                length += len(sentences[i])
+            text = " … ".join(sentences[i].strip() for i in sorted(kept))
+            self.excerpted += 1
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) > max_tokens:
+            return self.encoding.decode(tokens[:max_tokens]), max_tokens
+        return text, len(tokens)
+
+    def pack(self, hits: list[SearchHit], query: Optional[str]) -> list[SearchHit]:
+        packed, used = [], 0
+        for hit in self.order(hits):
+            remaining = self.token_budget - used
+            if remaining < MIN_EXCERPT_TOKENS:
+                break
+            text, n_tokens = self.excerpt(hit.text or "", query, min(self.issue_tokens, remaining))
+            packed.append(hit._replace(text=text))
+            used += n_tokens
+        self.packs += 1
+        self.hits += len(hits)
+        self.packed += len(packed)
+        self.tokens += used
+        return packed
+
+    def stats(self) -> dict:
+        return {
+            "packs": self.packs,
+            "hits": self.hits,
+            "packed": self.packed,
+            "duplicates": self.duplicates,
+            "excerpted": self.excerpted,
+            "tokens_per_pack": self.tokens / self.packs if self.packs else 0.0,
+        }
+
+
+context_packer = ContextPacker()
@@ -0,0 +1,97 @@
+from psycopg_pool import AsyncConnectionPool
+from psycopg.rows import dict_row
+from pgvector.psycopg import register_vector_async
+from asyncio import Lock
+from typing import Optional
+import os
+
+
+# Sized for a single uvicorn worker talking to Supabase. min_size connections
+# are kept warm, the pool grows up to max_size under load, and at most
+# max_waiting requests queue for a connection before being rejected outright.
+POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+POOL_MAX_WAITING = int(os.getenv("DB_POOL_MAX_WAITING", "50"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))
+# Server-side prepared statements don't survive a transaction-mode pooler
+# (Supabase's port 6543); turn them off when connecting through one.
+PREPARE_STATEMENTS = os.getenv("DB_PREPARE_STATEMENTS", "1") == "1"
+# A time range filters the rows a repo's HNSW index returns; an iterative scan
+# (pgvector 0.8+) keeps walking the graph until `limit` rows pass the filter.
+# Searches can still override it per transaction.
+HNSW_ITERATIVE_SCAN = os.getenv("HNSW_ITERATIVE_SCAN", "strict_order")
+
+_pool: Optional[AsyncConnectionPool] = None
+_pool_lock: Optional[Lock] = None
+
+
+async def configure_connection(conn):
+    # Runs once per physical connection, not once per request. Searches match
+    # a per-repo partial HNSW index only when the plan sees the repo name, so
+    # prepared statements are planned for their parameters every time rather
+    # than switching to a generic plan after five executions.
+    await register_vector_async(conn)
+    await conn.execute(
+        "SELECT set_config('plan_cache_mode', 'force_custom_plan', false),"
+        " set_config('hnsw.iterative_scan', %s, false)",
+        (HNSW_ITERATIVE_SCAN,),
+    )
+
+
+async def get_pool() -> AsyncConnectionPool:
+    global _pool, _pool_lock
+    if _pool is not None:
+        return _pool
+
+    if _pool_lock is None:
+        # created lazily so it binds to the running loop (Python 3.9)
+        _pool_lock = Lock()
+    async with _pool_lock:
+        if _pool is None:
+            pool = AsyncConnectionPool(
+                os.getenv("SUPABASE_URI"),
+                min_size=POOL_MIN_SIZE,
+                max_size=POOL_MAX_SIZE,
+                max_waiting=POOL_MAX_WAITING,
+                timeout=POOL_TIMEOUT,
+                max_idle=POOL_MAX_IDLE,
+                kwargs={"autocommit": True, "row_factory": dict_row},
+                configure=configure_connection,
+                check=AsyncConnectionPool.check_connection,
+                name="devsearch",
+                open=False,
+            )
+            await pool.open(wait=True)
+            _pool = pool
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+def pool_stats() -> dict:
+    if _pool is None:
+        return {}
+    # requests_errors counts acquisitions that timed out or were rejected
+    # because max_waiting was reached; requests_wait_ms is total queue time.
+    stats = _pool.get_stats()
+    return {
+        "pool_min": stats.get("pool_min"),
+        "pool_max": stats.get("pool_max"),
+        "pool_size": stats.get("pool_size", 0),
+        "pool_available": stats.get("pool_available", 0),
+        "requests_waiting": stats.get("requests_waiting", 0),
+        "requests_num": stats.get("requests_num", 0),
+        "requests_queued": stats.get("requests_queued", 0),
+        "requests_wait_ms": stats.get("requests_wait_ms", 0),
+        "acquire_timeouts": stats.get("requests_errors", 0),
+        "connections_num": stats.get("connections_num", 0),
+        "connections_errors": stats.get("connections_errors", 0),
+        "connections_lost": stats.get("connections_lost", 0),
+        "returns_bad": stats.get("returns_bad", 0),
+    }
@@ -0,0 +1,288 @@
+from array import array
+from asyncio import Future, Semaphore, create_task, gather, get_running_loop
+from collections import OrderedDict
+from llm import get_async_openai
+from singleflight import SingleFlight
+from threading import Lock
+from typing import Optional
+import hashlib
+import os
+import re
+import sqlite3
+import tiktoken
+import time
+
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Per-input context of the embedding models; longer inputs are rejected
+MAX_INPUT_TOKENS = 8191
+
+
+def normalize_text(text: str) -> str:
+    # "How do I X?" / "how do i  x" should share one embedding
+    text = re.sub(r"\s+", " ", text).strip().lower()
+    return text.rstrip("?!. ")
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU+TTL cache of query embeddings keyed by (model, normalized text).
+    If path is set, entries are also written to a SQLite file so they survive
+    restarts; the in-memory tier is checked first.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 4096,
+        ttl_seconds: float = 7 * 24 * 3600,
+        path: Optional[str] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+        self._lock = Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    key TEXT PRIMARY KEY,
+                    embedding BLOB NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            self._db.commit()
+
+    @staticmethod
+    def key(text: str, model: str) -> str:
+        return hashlib.sha256(f"{model}\0{normalize_text(text)}".encode()).hexdigest()
+
+    def get(self, text: str, model: str = EMBEDDING_MODEL) -> Optional[list[float]]:
+        key = self.key(text, model)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, embedding = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return embedding
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT embedding, created_at FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] + self.ttl_seconds > now:
+                    embedding = array("f", row[0]).tolist()
+                    self._remember(key, embedding, row[1] + self.ttl_seconds)
+                    self.disk_hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def put(self, text: str, embedding: list[float], model: str = EMBEDDING_MODEL):
+        key = self.key(text, model)
+        now = time.time()
+        with self._lock:
+            self._remember(key, embedding, now + self.ttl_seconds)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding, created_at) VALUES (?, ?, ?)",
+                    (key, array("f", embedding).tobytes(), now),
+                )
+                self._db.commit()
+
+    def _remember(self, key: str, embedding: list[float], expires_at: float):
+        self._entries[key] = (expires_at, embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+
+embedding_cache = EmbeddingCache(
+    max_entries=int(os.getenv("EMBEDDING_CACHE_SIZE", "4096")),
+    ttl_seconds=float(os.getenv("EMBEDDING_CACHE_TTL", str(7 * 24 * 3600))),
+    path=os.getenv("EMBEDDING_CACHE_PATH"),
+)
+
+
+class EmbeddingBatcher:
+    """
+    Packs many texts into each embeddings request. Requests are bounded by
+    input count and by total tokens, and every input is truncated by tokens to
+    the model's context. embed_many() embeds a known list; embed() queues one
+    text and shares a request with whatever else arrives within max_wait.
+    """
+
+    def __init__(
+        self,
+        model: str = EMBEDDING_MODEL,
+        max_inputs: int = 512,
+        max_tokens: int = 100_000,
+        max_input_tokens: int = MAX_INPUT_TOKENS,
+        max_concurrent_requests: int = 8,
+        max_wait: float = 0.01,
+    ):
+        self.model = model
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.max_input_tokens = max_input_tokens
+        self.max_wait = max_wait
+        self.max_concurrent_requests = max_concurrent_requests
+        self.requests = 0
+        self.inputs = 0
+        self.tokens = 0
+        self.truncated = 0
+        self._encoding = None
+        self._semaphore = None
+        self._pending: list[tuple[str, Future]] = []
+        self._flush_handle = None
+        self._tasks = set()
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        # Loaded lazily, the BPE ranks are fetched/cached on first use
+        if self._encoding is None:
+            self._encoding = tiktoken.encoding_for_model(self.model)
+        return self._encoding
+
+    def truncate(self, text: str) -> tuple[str, int]:
+        tokens = self.encoding.encode_ordinary(text)
+        if len(tokens) <= self.max_input_tokens:
+            return text, len(tokens)
+        self.truncated += 1
+        return self.encoding.decode(tokens[: self.max_input_tokens]), self.max_input_tokens
+
+    def pack(self, token_counts: list[int]) -> list[list[int]]:
+        # Greedy, order-preserving: start a new batch when either bound would break
+        batches, batch, batch_tokens = [], [], 0
+        for i, n_tokens in enumerate(token_counts):
+            if batch and (
+                len(batch) >= self.max_inputs or batch_tokens + n_tokens > self.max_tokens
+            ):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += n_tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def embed_many(self, texts: list[str]) -> list[list[float]]:
+        truncated = [self.truncate(text) for text in texts]
+        embeddings: list[Optional[list[float]]] = [None] * len(texts)
+
+        if self._semaphore is None:
+            # created on first use so it belongs to the running loop
+            self._semaphore = Semaphore(self.max_concurrent_requests)
+
+        async def send(batch: list[int]):
+            async with self._semaphore:
+                response = await get_async_openai().embeddings.create(
+                    input=[truncated[i][0] for i in batch], model=self.model
+                )
+            self.requests += 1
+            self.inputs += len(batch)
+            self.tokens += sum(truncated[i][1] for i in batch)
+            # data[].index is the position within this request's input list
+            for item in response.data:
+                embeddings[batch[item.index]] = item.embedding
+
+        await gather(*[send(batch) for batch in self.pack([n for _, n in truncated])])
+        return embeddings
+
+    async def embed(self, text: str) -> list[float]:
+        future = get_running_loop().create_future()
+        self._pending.append((text, future))
+        if len(self._pending) >= self.max_inputs:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = get_running_loop().call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if pending:
+            task = create_task(self._send_pending(pending))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send_pending(self, pending: list[tuple[str, Future]]):
+        try:
+            embeddings = await self.embed_many([text for text, _ in pending])
+        except Exception as e:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), embedding in zip(pending, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "inputs": self.inputs,
+            "tokens": self.tokens,
+            "truncated": self.truncated,
+            "inputs_per_request": self.inputs / self.requests if self.requests else 0.0,
+        }
+
+
+def new_query_batcher(model: str) -> EmbeddingBatcher:
+    return EmbeddingBatcher(
+        model=model,
+        max_inputs=int(os.getenv("EMBEDDING_BATCH_INPUTS", "512")),
+        max_tokens=int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000")),
+    )
+
+
+embedding_batcher = new_query_batcher(EMBEDDING_MODEL)
+# A request embeds with one model, so queries for another model get a batcher
+# of their own
+embedding_batchers = {EMBEDDING_MODEL: embedding_batcher}
+# Identical questions that miss the cache together are embedded once
+embedding_flights = SingleFlight()
+
+
+async def embed_query(query: str, model: str = EMBEDDING_MODEL) -> list[float]:
+    embedding = embedding_cache.get(query, model)
+    if embedding is not None:
+        return embedding
+
+    # Concurrent queries that miss the cache share one embeddings request,
+    # and concurrent identical ones one input in it
+    return await embedding_flights.do(
+        EmbeddingCache.key(query, model), lambda: _embed_and_cache(query, model)
+    )
+
+
+async def _embed_and_cache(query: str, model: str) -> list[float]:
+    batcher = embedding_batchers.get(model)
+    if batcher is None:
+        batcher = embedding_batchers[model] = new_query_batcher(model)
+    embedding = await batcher.embed(query)
+    embedding_cache.put(query, embedding, model)
+    return embedding
@@ -1,27 +1,27 @@
-from agents_data_models import find_closest_repo, RunSQLReturnPandas, SearchIssues, SearchSummaries, one_step_agent, summarize_content
-from ingest import get_conn
+import agents_data_models
+from agents_data_models import find_closest_repo, CountIssues, IssueMetrics, RunSQLReturnPandas, SearchIssues, SearchSummaries, execute_tools, merge_issues, one_step_agent, one_step_agent_async, results_messages, select_tools, summarize_content_async
+from answer_cache import AnswerCache
+from classification_cache import ClassificationCache
+from context import ContextPacker
+from db import get_pool
+from embeddings import EmbeddingBatcher, EmbeddingCache, EMBEDDING_MODEL, embed_query
+from ingest import ClassifiedSummary, IngestCheckpoint, parse_issue
+from local_index import LocalIndexBuilder, LocalSearch
+from repo_index import DEFAULT_REPOS, RepoIndex
+from router import Router, parse_time_range
+from singleflight import SingleFlight
+from search import HYBRID_SEARCH_SQL, SearchHit, get_search_backend, hnsw_index_sql, reciprocal_rank_fusion, search_query, search_uses_index, text_search_query
+from sql_engine import validate_sql
+from asyncio import run
+from datetime import datetime, timezone
+import asyncio
+import numpy as np
+import os
+import tempfile
+import time
 
 def test_fuzzywuzzy():
-    repos = [
-        "rust-lang/rust",
-        "kubernetes/kubernetes",
-        "apache/spark",
-        "golang/go",
-        "tensorflow/tensorflow",
-        "MicrosoftDocs/azure-docs",
-        "pytorch/pytorch",
-        "Microsoft/TypeScript",
-        "python/cpython",
-        "facebook/react",
-        "django/django",
-        "rails/rails",
-        "bitcoin/bitcoin",
-        "nodejs/node",
-        "ocaml/opam-repository",
-        "apache/airflow",
-        "scipy/scipy",
-        "vercel/next.js",
-    ]
+    repos = DEFAULT_REPOS
 
     test = [
         ["kuberntes", "kubernetes/kubernetes"],
@@ -34,98 +34,631 @@ def test_fuzzywuzzy():
     for query, expected in test:
         assert find_closest_repo(query, repos) == expected
     
-def test_agentic_tooling_with_openai():
-    repos = [
-        "rust-lang/rust",
-        "kubernetes/kubernetes",
-        "apache/spark",
-        "golang/go",
-        "tensorflow/tensorflow",
-        "MicrosoftDocs/azure-docs",
-        "pytorch/pytorch",
-        "Microsoft/TypeScript",
-        "python/cpython",
-        "facebook/react",
-        "django/django",
-        "rails/rails",
-        "bitcoin/bitcoin",
-        "nodejs/node",
-        "ocaml/opam-repository",
-        "apache/airflow",
-        "scipy/scipy",
-        "vercel/next.js",
+def test_repo_index():
+    # test_fuzzywuzzy's expectations hold against a 10k repo catalog too
+    rng = np.random.default_rng(0)
+    words = ["cloud", "data", "kube", "net", "py", "rust", "web", "lib", "core", "docs", "go", "ml"]
+    catalog = DEFAULT_REPOS + [
+        f"{''.join(rng.choice(words, 2))}{i}/{'-'.join(rng.choice(words, 2))}" for i in range(10_000)
     ]
-
-    tests = [
-        [
-            "What is the average time to first response for issues in the azure repository over the last 6 months? Has this metric improved or worsened?",
-            [RunSQLReturnPandas],
-        ],
-        [
-            "How many issues mentioned issues with Cohere in the 'vercel/next.js' repository in the last 6 months?",
-            [SearchIssues],
-        ],
-        [
-            "What were some of the big features that were implemented in the last 4 months for the scipy repo that addressed some previously open issues?",
-            [SearchSummaries],
-        ],
+    index = RepoIndex(catalog)
+    test = [
+        ["kuberntes", "kubernetes/kubernetes"],
+        ["next.js", "vercel/next.js"],
+        ["scipy", "scipy/scipy"],
+        ["k8s", "kubernetes/kubernetes"],
+        ["", None],
+        ["fakerepo", None],
     ]
-    for query, expected_result in tests:
+    for query, expected in test:
+        assert index.match(query) == expected
+    assert find_closest_repo("kuberntes", index) == "kubernetes/kubernetes"
+
+    for query in ["kubernetes/kubernetes", "kuberntes"]:
+        start = time.perf_counter()
+        for _ in range(100):
+            index.match(query)
+        per_lookup = (time.perf_counter() - start) / 100
+        print(f"{query}: {per_lookup * 1e6:.0f}us per lookup")
+        assert per_lookup < 0.01
+
+AGENT_TOOLING_CASES = [
+    [
+        "What is the average time to first response for issues in the azure repository over the last 6 months? Has this metric improved or worsened?",
+        [IssueMetrics],
+    ],
+    [
+        "How many issues mentioned issues with Cohere in the 'vercel/next.js' repository in the last 6 months?",
+        [CountIssues],
+    ],
+    [
+        "What were some of the big features that were implemented in the last 4 months for the scipy repo that addressed some previously open issues?",
+        [SearchSummaries],
+    ],
+]
+
+def test_agentic_tooling_with_openai():
+    repos = DEFAULT_REPOS
+
+    for query, expected_result in AGENT_TOOLING_CASES:
         response = one_step_agent(query, repos)
         print(response)
         for expected_call, agent_call in zip(expected_result, response):
             assert isinstance(agent_call, expected_call)
 
+def test_router_with_openai():
+    # Routes the agent tooling cases locally; the ones it isn't sure about
+    # would go to the LLM and don't count against its accuracy
+    async def route_cases():
+        router = Router()
+        routes = []
+        for query, expected_result in AGENT_TOOLING_CASES:
+            routes.append(await router.route(query, await embed_query(query), DEFAULT_REPOS))
+        return router, routes
+
+    router, routes = run(route_cases())
+    routed = [
+        (route, expected_result[0])
+        for route, (_, expected_result) in zip(routes, AGENT_TOOLING_CASES)
+        if route is not None
+    ]
+    correct = sum(route.tool == expected.__name__ for route, expected in routed)
+    print(f"routed {len(routed)}/{len(routes)} locally, {correct}/{len(routed)} correct")
+    print(router.stats())
+    assert correct == len(routed)
+
+def test_router_fallback():
+    now = datetime(2024, 8, 31, tzinfo=timezone.utc)
+    assert parse_time_range("issues from the last 6 months", now)[0] == datetime(2024, 2, 29, tzinfo=timezone.utc)
+    assert parse_time_range("what broke in 2023?", now) == (
+        datetime(2023, 1, 1, tzinfo=timezone.utc),
+        datetime(2024, 1, 1, tzinfo=timezone.utc),
+    )
+    assert parse_time_range("what are the main networking issues?", now) == (None, None)
+    assert parse_time_range("what changed before the 1.0 release?", now) is None
+
+    repos = RepoIndex(DEFAULT_REPOS)
+    assert repos.named("Why do my k8s pods restart?") == ["kubernetes/kubernetes"]
+    assert repos.named("What's new in 'vercel/next.js'?") == ["vercel/next.js"]
+    assert repos.named("react vs next.js hydration") == ["facebook/react", "vercel/next.js"]
+
+    async def same_embedding(text):
+        return [1.0, 0.0, 0.0]
+
+    # every example looks alike, so no intent is confident enough to route
+    router = Router(same_embedding)
+    assert run(router.route("How long do kubernetes issues stay open?", [1.0, 0.0, 0.0], DEFAULT_REPOS)) is None
+    assert router.stats()["fallback_reasons"] == {"intent_confidence": 1}
+
+    # common words are left to the repo embeddings, which can't tell these
+    # repos apart, unless a distinctive name settles it
+    async def resolve(question):
+        index = RepoIndex(DEFAULT_REPOS)
+        await router._prepare(index)
+        return router.resolve_repo(question, np.array([1.0, 0.0, 0.0]), index)
+
+    assert run(resolve("Which bugs go unfixed the longest?"))[1] < router.repo_margin
+    assert run(resolve("Which kubernetes node pools fail to scale?")) == ("kubernetes/kubernetes", 1.0)
+    assert run(resolve("Which golang/go bugs go unfixed the longest?")) == ("golang/go", 1.0)
+
+def test_embedding_cache():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "embeddings.sqlite")
+        cache = EmbeddingCache(max_entries=2, ttl_seconds=60, path=path)
+        cache.put("How do I build Rust?", [0.5, 0.25])
+        cache.put("second", [1.0, 0.0])
+
+        # normalized text shares an entry
+        assert cache.get("  how do i build rust  ") == [0.5, 0.25]
+        assert cache.get("never seen") is None
+
+        # LRU eviction drops "second" from memory, the SQLite tier still has it
+        cache.put("third", [0.0, 1.0])
+        assert cache.key("second", EMBEDDING_MODEL) not in cache._entries
+        assert cache.get("second") == [1.0, 0.0]
+        assert cache.stats()["disk_hits"] == 1
+
+        # a fresh cache over the same file survives a restart
+        restarted = EmbeddingCache(max_entries=2, ttl_seconds=60, path=path)
+        assert restarted.get("third") == [0.0, 1.0]
+
+        expired = EmbeddingCache(ttl_seconds=0.01)
+        expired.put("stale", [1.0])
+        time.sleep(0.02)
+        assert expired.get("stale") is None
+        assert expired.stats() == {"size": 0, "hits": 0, "disk_hits": 0, "misses": 1, "hit_rate": 0.0}
+
+def test_classification_cache():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "classifications.sqlite")
+        cache = ClassificationCache(path)
+        key = cache.key("gpt-4o-mini", "prompt", ClassifiedSummary, "golang/go", "gc pauses")
+        assert cache.get(key, ClassifiedSummary) is None
+
+        summary = ClassifiedSummary(chain_of_thought="...", label="OPEN", summary="GC pauses")
+        cache.put(key, summary, total_tokens=120)
+
+        # a new prompt template is a different entry, not a stale hit
+        assert cache.get(cache.key("gpt-4o-mini", "prompt v2", ClassifiedSummary, "golang/go", "gc pauses"), ClassifiedSummary) is None
+
+        restarted = ClassificationCache(path)
+        assert restarted.get(key, ClassifiedSummary) == summary
+        assert restarted.stats() == {"hits": 1, "misses": 0, "hit_rate": 1.0, "tokens_saved": 120, "tokens_spent": 0}
+
+def test_answer_cache():
+    cache = AnswerCache(threshold=0.9, ttl_seconds=60)
+    cache.put([1.0, 0.0, 0.0], "pods can't reach services", "kubernetes/kubernetes", latency=3.0)
+    cache.put([0.0, 1.0, 0.0], "slow builds", "rust-lang/rust", latency=2.0)
+
+    # a close paraphrase hits, a different question misses
+    assert cache.get([0.95, 0.1, 0.0], ["kubernetes/kubernetes"]) == "pods can't reach services"
+    assert cache.get([0.5, 0.5, 0.7], ["kubernetes/kubernetes"]) is None
+    # only answers from the repos the question resolves to are considered, the
+    # way cached_answer resolves them, and a question resolving to none misses
+    repos = RepoIndex(DEFAULT_REPOS)
+    assert repos.named("Why is Go's gc slow?") == ["golang/go"]
+    assert cache.get([0.0, 1.0, 0.0], repos.named("Why are k8s builds slow?", common=False)) is None
+    assert cache.get([0.0, 1.0, 0.0], repos.named("Why are builds slow?", common=False)) is None
+    assert cache.get([0.0, 1.0, 0.0], repos.named("Why are rustc builds slow?", common=False)) == "slow builds"
+
+    cache.invalidate("kubernetes/kubernetes")
+    assert cache.get([1.0, 0.0, 0.0], ["kubernetes/kubernetes"]) is None
+    assert cache.stats() == {
+        "size": 1,
+        "hits": 2,
+        "misses": 4,
+        "hit_rate": 2 / 6,
+        "latency_saved_seconds": 5.0,
+        "invalidations": 1,
+    }
+
+    class StampPool:
+        def __init__(self, stamps):
+            self.stamps = stamps
+
+        def connection(self):
+            return self
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+        async def execute(self, query):
+            return self
+
+        async def fetchall(self):
+            return [{"repo_name": repo, "ingested_at": at} for repo, at in self.stamps.items()]
+
+    # a reset that doesn't load rust-lang/rust again drops its stamp and answers
+    cache.poll_interval = 0
+    cache.put([0.0, 0.0, 1.0], "go answer", "golang/go", latency=1.0)
+    run(cache.refresh(StampPool({"golang/go": 1, "rust-lang/rust": 1})))
+    run(cache.refresh(StampPool({"golang/go": 1})))
+    assert cache.get([0.0, 1.0, 0.0], ["rust-lang/rust"]) is None
+    assert cache.get([0.0, 0.0, 1.0], ["golang/go"]) == "go answer"
+
+def test_local_index_search():
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(40, 64)).astype(np.float32)
+    repos = ["golang/go", "rust-lang/rust"]
+    for dtype in ["float32", "float16", "int8"]:
+        with tempfile.TemporaryDirectory() as tmp:
+            builder = LocalIndexBuilder(tmp, "github_issue_summaries", dtype)
+            for i, embedding in enumerate(embeddings):
+                builder.add({"issue_id": i, "repo_name": repos[i % 2], "text": f"issue {i}"}, embedding)
+            builder.finish()
+            backend = LocalSearch(tmp)
+
+            # the nearest neighbour of a stored vector is itself, within its repo only
+            rows = run(backend.search("github_issue_summaries", "rust-lang/rust", embeddings[7], 5))
+            assert rows[0].issue_id == 7 and abs(rows[0].distance) < 0.01, dtype
+            assert [row.distance for row in rows] == sorted(row.distance for row in rows)
+            assert len(rows) == 5 and all(row.repo_name == "rust-lang/rust" for row in rows)
+
+            tool = SearchSummaries.model_validate(
+                {"query": None, "repo": "golang/go"}, context={"repos": repos}
+            )
+            rows = run(tool.execute(backend, 3))
+            assert [row.issue_id for row in rows] == [0, 2, 4]
+            assert rows[0].text == "issue 0" and rows[0].distance is None
+            assert run(backend.search("github_issue_summaries", "unknown/repo", embeddings[0], 5)) == []
+
+def test_local_keyword_search():
+    texts = [
+        "Cohere provider fails on next.js 14 edge runtime",
+        "Streaming breaks with the Cohere SDK",
+        "Image optimization is slow",
+        "cohere cohere cohere: rate limits",
+        "Middleware redirect loop",
+    ]
+    rng = np.random.default_rng(1)
+    embeddings = rng.normal(size=(len(texts), 16)).astype(np.float32)
+    with tempfile.TemporaryDirectory() as tmp:
+        builder = LocalIndexBuilder(tmp, "github_issues")
+        for i, (text, embedding) in enumerate(zip(texts, embeddings)):
+            start_ts = datetime(2024, i + 1, 1, tzinfo=timezone.utc)
+            builder.add(
+                {"issue_id": i, "repo_name": "vercel/next.js", "text": text, "start_ts": start_ts},
+                embedding,
+            )
+        builder.add({"issue_id": 99, "repo_name": "golang/go", "text": "cohere"}, embeddings[0])
+        builder.finish()
+        backend = LocalSearch(tmp)
+
+        assert run(backend.count("github_issues", "vercel/next.js", "Cohere")) == 3
+        assert run(backend.count("github_issues", "vercel/next.js", "cohere streaming")) == 1
+        assert run(backend.count("github_issues", "vercel/next.js", "anthropic")) == 0
+
+        rows = run(backend.search("github_issues", "vercel/next.js", None, 10, keywords="cohere"))
+        assert [row.issue_id for row in rows] == [3, 1, 0]
+        assert rows[0].start_ts == datetime(2024, 4, 1, tzinfo=timezone.utc)
+        # fused with the vector ranking, a row in both rankings beats one in either
+        rows = run(backend.search("github_issues", "vercel/next.js", embeddings[1], 2, keywords="cohere"))
+        assert rows[0].issue_id == 1
+
+        # time bounds apply to counts, keyword, vector and plain scans alike
+        since, until = datetime(2024, 2, 1), datetime(2024, 4, 1, tzinfo=timezone.utc)
+        assert run(backend.count("github_issues", "vercel/next.js", "cohere", since, until)) == 1
+        rows = run(backend.search("github_issues", "vercel/next.js", embeddings[0], 10, start=since, end=until))
+        assert sorted(row.issue_id for row in rows) == [1, 2]
+        rows = run(backend.search("github_issues", "vercel/next.js", None, 10, start=datetime(2024, 4, 1)))
+        assert [row.issue_id for row in rows] == [3, 4]
+
+    assert reciprocal_rank_fusion([[1, 2, 3], [3, 1]], limit=2) == [1, 3]
+
+def test_local_issue_metrics():
+    day = 86400
+    issues = [
+        # (opened, seconds to close, seconds to first response)
+        (datetime(2024, 1, 5, tzinfo=timezone.utc), 2 * day, 3600),
+        (datetime(2024, 1, 20, tzinfo=timezone.utc), 20 * day, None),
+        (datetime(2024, 1, 31, 23, tzinfo=timezone.utc), None, 7200),
+        (datetime(2024, 3, 2, tzinfo=timezone.utc), None, None),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        builder = LocalIndexBuilder(tmp, "github_issues")
+        for i, (opened, to_close, to_respond) in enumerate(issues):
+            row = {
+                "issue_id": i,
+                "repo_name": "scipy/scipy",
+                "text": "",
+                "start_ts": opened,
+                "end_ts": to_close and datetime.fromtimestamp(opened.timestamp() + to_close, timezone.utc),
+                "first_response_ts": to_respond and datetime.fromtimestamp(opened.timestamp() + to_respond, timezone.utc),
+            }
+            builder.add(row, np.ones(4, dtype=np.float32))
+        builder.finish()
+        backend = LocalSearch(tmp)
+
+        january, february, march = run(backend.metrics("scipy/scipy"))
+        assert january["month"] == datetime(2024, 1, 1, tzinfo=timezone.utc)
+        # closures count in the month they happened, still_open by opening month
+        assert (january["opened"], january["closed"], january["still_open"]) == (3, 1, 1)
+        assert (february["opened"], february["closed"], february["still_open"]) == (0, 1, 0)
+        assert january["avg_days_to_close"] == 11 and january["p50_days_to_close"] == 11
+        assert january["responded"] == 2 and january["avg_hours_to_first_response"] == 1.5
+        assert [row["open_backlog"] for row in (january, february, march)] == [2, 1, 2]
+        assert february["avg_days_to_close"] is None and march["avg_days_to_close"] is None
+
+        # a bounded range keeps the months it overlaps, with the backlog carried in
+        rows = run(backend.metrics("scipy/scipy", datetime(2024, 1, 15), datetime(2024, 3, 1)))
+        assert [row["month"].month for row in rows] == [1, 2]
+        rows = run(backend.metrics("scipy/scipy", datetime(2024, 2, 1)))
+        assert [row["open_backlog"] for row in rows] == [1, 2]
+        assert run(backend.metrics("golang/go")) == []
+
+def test_parse_issue_first_response():
+    def event(action, author, day):
+        return {"action": action, "author": author, "datetime": f"2024-01-{day:02d}T00:00:00Z"}
+
+    # no opened event: the first comment opens the issue, and its author's
+    # follow-ups aren't a response
+    issue = parse_issue(
+        {
+            "issue_id": 1,
+            "repo": "scipy/scipy",
+            "content": "",
+            "events": [
+                event("created", "alice", 1),
+                event("created", "alice", 2),
+                event("created", "bob", 3),
+                event("closed", "bob", 4),
+            ],
+        }
+    )
+    assert issue.start_ts == datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert issue.first_response_ts == datetime(2024, 1, 3, tzinfo=timezone.utc)
+    assert issue.end_ts == datetime(2024, 1, 4, tzinfo=timezone.utc)
+
+def test_ingest_checkpoint_resume():
+    class CheckpointPool:
+        # just enough of a connection pool for IngestCheckpoint
+        def __init__(self):
+            self.row = None
+            self.saved = []
+
+        def connection(self):
+            return self
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+        async def execute(self, query, params):
+            if query.lstrip().startswith("INSERT"):
+                self.row = {"state": params[1].obj, "issues_read": params[2]}
+                self.saved.append(params[2])
+            return self
+
+        async def fetchone(self):
+            return self.row
+
+    async def ingest(checkpoint, issues):
+        # each issue is written right after it is read
+        for _ in range(issues):
+            state = {"position": checkpoint.issues_read + 1} if checkpoint.should_record() else None
+            await checkpoint.read(checkpoint.issues_read, state, writes=1)
+            await checkpoint.written([checkpoint.issues_read - 1])
+
+    pool = CheckpointPool()
+    run(ingest(IngestCheckpoint(pool, "test", every=2), 10))
+    assert pool.saved == [2, 4, 6, 8, 10]
+
+    pool = CheckpointPool()
+    run(ingest(IngestCheckpoint(pool, "test", every=2), 5))
+    resumed = IngestCheckpoint(pool, "test", every=2)
+    assert run(resumed.load()) == {"position": 4}
+    # a resumed run keeps checkpointing from where the last one stopped
+    run(ingest(resumed, 6))
+    assert pool.saved == [2, 4, 6, 8, 10]
+
+def test_sql_allowlist():
+    query = validate_sql(
+        """
+        WITH monthly AS (
+            SELECT date_trunc('month', start_ts) AS month, count(*) AS opened
+            FROM github_issues i
+            WHERE i.repo_name = 'scipy/scipy' AND start_ts > now() - interval '6 months'
+            GROUP BY 1
+        )
+        SELECT month, opened FROM monthly ORDER BY month;
+        """
+    )
+    assert query.startswith("WITH monthly AS")
+    validate_sql(
+        "SELECT repo_name AS repo, count(*) AS n FROM github_issues GROUP BY repo ORDER BY n DESC"
+    )
+
+    rejected = [
+        "DELETE FROM github_issues",
+        "SELECT 1; DROP TABLE github_issues",
+        "SELECT usename, passwd FROM pg_shadow",
+        "SELECT issue_id, embedding FROM github_issues",
+        "SELECT * FROM github_issues",
+        "SELECT issue_id INTO scratch FROM github_issues",
+        "SELECT issue_id FROM github_issues FOR UPDATE",
+        "SELECT pg_sleep(60)",
+        "SELECT pg_read_file('/etc/passwd')",
+        "SELEC issue_id FROM github_issues",
+        # aliases, column lists and whole rows that would reach the embeddings
+        "SELECT issue_id AS embedding, embedding FROM github_issues",
+        "SELECT content_hash AS x, 1 AS content_hash FROM github_issues",
+        "SELECT x.embedding FROM github_issues x(embedding)",
+        "SELECT i FROM github_issues i",
+        "SELECT to_json(i) FROM github_issues i",
+    ]
+    for query in rejected:
+        try:
+            validate_sql(query)
+        except ValueError:
+            continue
+        raise AssertionError(f"accepted {query!r}")
+
+def test_compact_vector_storage():
+    # The coarse search has to repeat the indexed expression verbatim, or the
+    # planner can't use the compact index
+    for storage, expression in [
+        ("halfvec", "embedding::halfvec(1536)"),
+        ("binary", "binary_quantize(embedding)::bit(1536)"),
+    ]:
+        index = hnsw_index_sql("github_issues", "golang/go", storage).as_string(None)
+        assert f"(({expression}) " in index
+        for query in [
+            search_query("github_issues", True, storage=storage),
+            text_search_query(HYBRID_SEARCH_SQL, "github_issues", storage=storage),
+        ]:
+            query = query.as_string(None)
+            assert f"ORDER BY {expression} " in query
+            assert "%(rerank_candidates)s" in query
+            assert "ORDER BY embedding <=> %(embedding)b" in query or "AS distance" in query
+
+    query = search_query("github_issues", True, storage="full").as_string(None)
+    assert "rerank_candidates" not in query
+
+def test_parallel_tool_execution():
+    class SlowBackend:
+        async def search(self, table_name, repo_name, embedding, limit, *args):
+            await asyncio.sleep(5 if repo_name == "golang/go" else 0.2)
+            return [SearchHit(i, repo_name, f"{repo_name} {i}", None, None, None, None) for i in range(3)]
+
+    repos = ["rust-lang/rust", "scipy/scipy", "golang/go"]
+    tools = [
+        SearchIssues.model_validate({"query": None, "repo": repo, "keywords": "panic"}, context={"repos": repos})
+        for repo in ["rust-lang/rust", "scipy/scipy", "scipy/scipy", "golang/go"]
+    ]
+    started = time.perf_counter()
+    results = run(execute_tools(tools, SlowBackend(), limit=3, timeout=1))
+    # concurrent, so about as long as one search; the slow one is cancelled
+    assert time.perf_counter() - started < 1.5
+    assert [tool.repo for tool, _ in results] == repos
+    assert isinstance(results[2][1], asyncio.TimeoutError)
+
+    issues = merge_issues([result for _, result in results[:2]] + [results[0][1]])
+    assert [(row.repo_name[:4], row.issue_id) for row in issues] == [
+        ("rust", 0), ("scip", 0), ("rust", 1), ("scip", 1), ("rust", 2), ("scip", 2)
+    ]
+
+def test_no_tool_calls():
+    # the tool-selection model answering without a tool call
+    async def no_tools(question, repos):
+        return []
+
+    selected = agents_data_models.one_step_agent_async
+    agents_data_models.one_step_agent_async = no_tools
+    try:
+        tools = run(select_tools("What breaks when upgrading kubernetes?", DEFAULT_REPOS))
+        assert [(type(tool), tool.repo) for tool in tools] == [(SearchSummaries, "kubernetes/kubernetes")]
+        assert tools[0].query == "What breaks when upgrading kubernetes?"
+
+        async def first_event():
+            stream = agents_data_models.answer_question_stream("What breaks most often?", DEFAULT_REPOS, None)
+            return await stream.__anext__()
+
+        # a question naming no repo fails with a reason, not an IndexError
+        try:
+            run(first_event())
+        except ValueError as e:
+            assert "which repo" in str(e)
+        else:
+            raise AssertionError("answered a question without tools or a repo")
+    finally:
+        agents_data_models.one_step_agent_async = selected
+
+def test_context_packing():
+    class WordEncoding:
+        def encode_ordinary(self, text):
+            return text.split()
+
+        def decode(self, tokens):
+            return " ".join(tokens)
+
+    packer = ContextPacker(token_budget=300, issue_tokens=100)
+    packer._encoding = WordEncoding()
+
+    def hit(issue_id, text, distance):
+        return SearchHit(issue_id, "kubernetes/kubernetes", text, None, None, None, distance)
+
+    filler = " ".join(f"Unrelated log line number {i} from the kubelet." for i in range(200))
+    hits = [
+        hit(1, "Pods lose DNS resolution after the CoreDNS upgrade to 1.11", 0.10),
+        hit(2, "Pods lose DNS resolution after the CoreDNS upgrade to 1.11 again", 0.11),
+        hit(3, f"Service endpoints flap under load. {filler} The endpoint slice controller drops pods. {filler}", 0.20),
+        hit(4, "NetworkPolicy blocks traffic between namespaces", 0.30),
+    ] + [hit(10 + i, f"Issue {i}: " + " ".join(f"word{i}_{j}" for j in range(90)), 0.5) for i in range(10)]
+
+    packed = packer.pack(hits, "why does the endpoint slice controller drop pods")
+    ids = [row.issue_id for row in packed]
+    # the near-duplicate of the best hit is dropped, the rest keep MMR order
+    assert ids[:3] == [1, 3, 4] and 2 not in ids
+    # the long issue keeps its opening sentence and the one about the question
+    excerpt = packed[1].text
+    assert excerpt.startswith("Service endpoints flap under load.")
+    assert "The endpoint slice controller drops pods." in excerpt
+    assert len(excerpt.split()) <= 100
+    # and the whole context stays within the budget
+    assert sum(len(row.text.split()) for row in packed) <= 300
+    assert packer.stats()["duplicates"] == 1
+
+def test_single_flight():
+    flights = SingleFlight()
+    runs = []
+
+    async def answer(question):
+        runs.append(question)
+        await asyncio.sleep(0.05)
+        if question == "broken":
+            raise RuntimeError(question)
+        return f"answer to {question}"
+
+    async def ask_all():
+        asked = [flights.do(q, lambda q=q: answer(q)) for q in ["pods", "pods", "pods", "dns"]]
+        answers = await asyncio.gather(*asked)
+        failed = await asyncio.gather(
+            *[flights.do("broken", lambda: answer("broken")) for _ in range(3)],
+            return_exceptions=True,
+        )
+        # the first caller hanging up doesn't cancel the call for the others
+        first = asyncio.ensure_future(flights.do("late", lambda: answer("late")))
+        second = asyncio.ensure_future(flights.do("late", lambda: answer("late")))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return answers, failed, await second
+
+    answers, failed, late = run(ask_all())
+    assert answers == ["answer to pods"] * 3 + ["answer to dns"]
+    assert all(isinstance(e, RuntimeError) for e in failed) and late == "answer to late"
+    assert runs == ["pods", "dns", "broken", "late"]
+    assert flights.stats() == {"calls": 4, "shared": 5, "in_flight": 0}
+
+    async def tokens():
+        for token in ["a", "b", "c"]:
+            await asyncio.sleep(0.02)
+            yield token
+
+    async def subscribe(delay):
+        await asyncio.sleep(delay)
+        return [token async for token in flights.stream("pods", tokens)]
+
+    async def stream_all():
+        # the late subscriber replays what it missed
+        return await asyncio.gather(subscribe(0), subscribe(0.03))
+
+    assert run(stream_all()) == [["a", "b", "c"], ["a", "b", "c"]]
+    assert flights.stats() == {"calls": 5, "shared": 6, "in_flight": 0}
+
+def test_embedding_batcher_packing():
+    batcher = EmbeddingBatcher(max_inputs=3, max_tokens=100)
+    # bounded by input count
+    assert batcher.pack([1, 1, 1, 1, 1, 1, 1]) == [[0, 1, 2], [3, 4, 5], [6]]
+    # bounded by token budget, order preserved
+    assert batcher.pack([60, 30, 20, 90, 100]) == [[0, 1], [2], [3], [4]]
+    assert batcher.pack([]) == []
+
                                      
 async def test_embedding_search_with_sql(query):
-    conn = await get_conn()
+    backend = await get_search_backend()
     limit = 10
-    resp_cur = await SearchSummaries(query=query, repo="kubernetes/kubernetes").execute(
-        conn, limit
+    rows = await SearchSummaries(query=query, repo="kubernetes/kubernetes").execute(
+        backend, limit
     )
-    for buff in resp_cur:
-        row = {}
-        c = 0
-        for col in resp_cur.description:
-            row.update({str(col[0]): buff[c]})
-            c += 1
-        print(row["text"])
+    for row in rows:
+        print(row.text)
+
+async def test_search_uses_hnsw_index():
+    pool = await get_pool()
+    embedding = await embed_query("endpoint connectivity between pods")
+    for table_name in ["github_issues", "github_issue_summaries"]:
+        assert await search_uses_index(
+            pool, table_name, "kubernetes/kubernetes", embedding
+        ), f"{table_name} search is not using its HNSW index"
 
 async def test_one_step_agent(query):
     #query = "What are the main issues people face with endpoint connectivity between different pods in kubernetes?"
-    repos = [
-        "rust-lang/rust",
-        "kubernetes/kubernetes",
-        "apache/spark",
-        "golang/go",
-        "tensorflow/tensorflow",
-        "MicrosoftDocs/azure-docs",
-        "pytorch/pytorch",
-        "Microsoft/TypeScript",
-        "python/cpython",
-        "facebook/react",
-        "django/django",
-        "rails/rails",
-        "bitcoin/bitcoin",
-        "nodejs/node",
-        "ocaml/opam-repository",
-        "apache/airflow",
-        "scipy/scipy",
-        "vercel/next.js",
-    ]
+    repos = DEFAULT_REPOS
 
-    resp = one_step_agent(query, repos)
+    resp = await one_step_agent_async(query, repos)
 
-    conn = await get_conn()
+    backend = await get_search_backend()
     limit = 10
     print(resp)
     tools = [tool for tool in resp]
     print(tools)
     #> [SearchSummaries(query='endpoint connectivity pods kubernetes', repo='kubernetes/kubernetes')]
 
-    result = await tools[0].execute(conn, limit)
+    results = []
+    # failed tools are left out of the prompt, as answer_question does
+    for tool, result in await execute_tools(tools, backend, limit):
+        if isinstance(result, Exception):
+            print(f"{type(tool).__name__} for {tool.repo} failed: {result!r}")
+        else:
+            results.append((tool, result))
+    assert results
 
-    summary = summarize_content(result, query)
+    summary = await summarize_content_async([], query, results_messages(results, query))
     #> Users face endpoint connectivity issues in Kubernetes potentially due to networking setup errors with plugins like Calico, misconfigured network interfaces, and lack of clear documentation that hinders proper setup and troubleshooting. Proper handling of these aspects is essential for ensuring connectivity between different pods.
     
     return summary.summary
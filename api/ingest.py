@@ -1,19 +1,50 @@
-from datasets import load_dataset
+from argparse import ArgumentParser
+from datasets import load_dataset, IterableDataset
 from datetime import datetime
-from openai import AsyncOpenAI
-from asyncio import run, Semaphore
+from asyncio import run, Semaphore, Queue, create_task, gather, to_thread, wait_for
+from asyncio import TimeoutError as QueueTimeout
+from tqdm import tqdm
 from tqdm.asyncio import tqdm_asyncio as asyncio
 from textwrap import dedent
-from instructor import from_openai
 from jinja2 import Template
-from pgvector.psycopg2 import register_vector
-from psycopg2.extras import execute_batch
-import json
+from pgvector.psycopg import Vector
+from psycopg import sql
+from psycopg.types.json import Jsonb
 from dotenv import load_dotenv
 from pydantic import BaseModel
-from typing import Literal, Any, Optional
+from typing import Literal, Any, Optional, Callable, Awaitable
+
+# load environment variables before modules read their config; .env wins over
+# the shell only when ingesting, not when another module imports this one
+load_dotenv(dotenv_path=".env", override=__name__ == "__main__")
+
+from db import get_pool
+from llm import get_async_instructor
+from embeddings import EmbeddingBatcher
+from classification_cache import ClassificationCache
+from search import (
+    hnsw_index_sql,
+    repo_hnsw_index_name,
+    text_index_sql,
+    HNSW_INDEXES,
+    VECTOR_STORAGE,
+)
+from local_index import LocalIndexBuilder, build_from_postgres
+from metrics import METRICS_SETUP_SQL, refresh_issue_metrics
+from repo_index import DEFAULT_REPOS, load_repo_catalog
+import hashlib
+import json
 import os
-import psycopg2
+import time
+
+
+# Ingestion trades a little latency for fuller requests than the query path
+embedding_batcher = EmbeddingBatcher(max_wait=0.5)
+# Classifications survive re-runs and re-ingests, so only new or changed
+# issue text costs a chat completion
+classification_cache = ClassificationCache(
+    os.getenv("CLASSIFICATION_CACHE_PATH", "classification_cache.sqlite")
+)
 
 
 class ClassifiedSummary(BaseModel):
@@ -27,7 +58,10 @@ class ProcessedIssue(BaseModel):
     text: str
     label: Literal["OPEN", "CLOSED"]
     repo_name: str
+    start_ts: datetime
+    end_ts: Optional[datetime]
     embedding: Optional[list[float]]
+    content_hash: Optional[str] = None
 
 
 class GithubIssue(BaseModel):
@@ -38,134 +72,180 @@ class GithubIssue(BaseModel):
     start_ts: datetime
     end_ts: Optional[datetime]
     embedding: Optional[list[float]]
+    first_response_ts: Optional[datetime] = None
+
+    @property
+    def content_hash(self) -> str:
+        # Everything that feeds the stored row, summary and embedding
+        content = json.dumps(
+            [
+                self.repo_name,
+                self.text,
+                self.metadata,
+                self.end_ts and self.end_ts.isoformat(),
+                self.first_response_ts and self.first_response_ts.isoformat(),
+            ],
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode()).hexdigest()
 
 
-def get_issues(n: int, repos: list[str]):
+def issue_stream(n: int, repos: list[str], state: Optional[dict] = None) -> IterableDataset:
     dataset = (
         load_dataset("bigcode/the-stack-github-issues", split="train", streaming=True)
         .filter(lambda x: x["repo"] in repos)
         .take(n)
     )
+    if state is not None:
+        dataset.load_state_dict(state)
+    return dataset
+
+
+def get_issues(n: int, repos: list[str], state: Optional[dict] = None):
+    for row in issue_stream(n, repos, state):
+        yield parse_issue(row)
+
+
+def parse_issue(row: dict) -> GithubIssue:
+    start_time = None
+    end_time = None
+    first_response_time = None
+    opener = None
+    for event in row["events"]:
+        event_type = event["action"]
+        timestamp = event["datetime"]
+        timestamp = timestamp.replace("Z", "+00:00")
+
+        if event_type == "opened":
+            start_time = datetime.fromisoformat(timestamp)
+            opener = event.get("author")
+
+        elif event_type == "closed":
+            end_time = datetime.fromisoformat(timestamp)
+
+        # Small Fall Back here - Some issues have no Creation event
+        elif event_type == "created" and not start_time:
+            start_time = datetime.fromisoformat(timestamp)
+            # the first comment stands in for the issue, so its author is the opener
+            opener = event.get("author")
+
+        # First comment by someone other than the author of the issue
+        elif (
+            event_type == "created"
+            and not first_response_time
+            and (opener is None or event.get("author") != opener)
+        ):
+            first_response_time = datetime.fromisoformat(timestamp)
+
+        elif event_type == "reopened" and not start_time:
+            start_time = datetime.fromisoformat(timestamp)
+
+    return GithubIssue(
+        issue_id=row["issue_id"],
+        metadata={},
+        text=row["content"],
+        repo_name=row["repo"],
+        start_ts=start_time,
+        end_ts=end_time,
+        first_response_ts=first_response_time,
+        embedding=None,
+    )
+
 
-    for row in dataset:
-        start_time = None
-        end_time = None
-        for event in row["events"]:
-            event_type = event["action"]
-            timestamp = event["datetime"]
-            timestamp = timestamp.replace("Z", "+00:00")
-
-            if event_type == "opened":
-                start_time = datetime.fromisoformat(timestamp)
-
-            elif event_type == "closed":
-                end_time = datetime.fromisoformat(timestamp)
-
-            # Small Fall Back here - Some issues have no Creation event
-            elif event_type == "created" and not start_time:
-                start_time = datetime.fromisoformat(timestamp)
-
-            elif event_type == "reopened" and not start_time:
-                start_time = datetime.fromisoformat(timestamp)
-
-        yield GithubIssue(
-            issue_id=row["issue_id"],
-            metadata={},
-            text=row["content"],
-            repo_name=row["repo"],
-            start_ts=start_time,
-            end_ts=end_time,
-            embedding=None,
+CLASSIFY_MODEL = "gpt-4o-mini"
+CLASSIFY_SYSTEM_PROMPT = "You are a helpful assistant that classifies and summarizes GitHub issues. When summarizing the issues, make sure to expand on specific accronyms and add additional explanation where necessary."
+CLASSIFY_USER_TEMPLATE = dedent(
+    """
+    Repo Name: {{ repo_name }}
+    Issue Text: {{ issue_text}}
+    """
+)
+
+
+async def classify_issue(issue: GithubIssue) -> ProcessedIssue:
+    cache_key = ClassificationCache.key(
+        CLASSIFY_MODEL,
+        CLASSIFY_SYSTEM_PROMPT + CLASSIFY_USER_TEMPLATE,
+        ClassifiedSummary,
+        issue.repo_name,
+        issue.text,
+    )
+    classification = classification_cache.get(cache_key, ClassifiedSummary)
+    if classification is None:
+        client = get_async_instructor()
+        classification, completion = await client.chat.completions.create_with_completion(
+            response_model=ClassifiedSummary,
+            messages=[
+                {
+                    "role": "system",
+                    "content": CLASSIFY_SYSTEM_PROMPT,
+                },
+                {
+                    "role": "user",
+                    "content": Template(CLASSIFY_USER_TEMPLATE).render(
+                        repo_name=issue.repo_name, issue_text=issue.text
+                    ),
+                },
+            ],
+            model=CLASSIFY_MODEL,
         )
+        usage = completion.usage
+        classification_cache.put(cache_key, classification, usage.total_tokens if usage else 0)
+
+    return ProcessedIssue(
+        issue_id=issue.issue_id,
+        repo_name=issue.repo_name,
+        text=classification.summary,
+        label=classification.label,
+        start_ts=issue.start_ts,
+        end_ts=issue.end_ts,
+        embedding=None,
+        content_hash=issue.content_hash,
+    )
+
+
+async def embed_item(item):
+    # Concurrent calls are packed into shared requests by the batcher
+    item.embedding = await embedding_batcher.embed(item.text)
+    return item
 
 
 async def batch_classify_issue(
     batch: list[GithubIssue], max_concurrent_requests: int = 20
 ) -> list[ProcessedIssue]:
-    async def classify_issue(issue: GithubIssue, semaphore: Semaphore):
-        client = from_openai(AsyncOpenAI())
+    async def classify_with_limit(issue: GithubIssue, semaphore: Semaphore):
         async with semaphore:
-            classification = await client.chat.completions.create(
-                response_model=ClassifiedSummary,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "You are a helpful assistant that classifies and summarizes GitHub issues. When summarizing the issues, make sure to expand on specific accronyms and add additional explanation where necessary.",
-                    },
-                    {
-                        "role": "user",
-                        "content": Template(
-                            dedent(
-                                """
-                            Repo Name: {{ repo_name }}
-                            Issue Text: {{ issue_text}}
-                            """
-                            )
-                        ).render(repo_name=issue.repo_name, issue_text=issue.text),
-                    },
-                ],
-                model="gpt-4o-mini",
-            )
-            return ProcessedIssue(
-                issue_id=issue.issue_id,
-                repo_name=issue.repo_name,
-                text=classification.summary,
-                label=classification.label,
-                embedding=None,
-            )
+            return await classify_issue(issue)
 
     semaphore = Semaphore(max_concurrent_requests)
-    coros = [classify_issue(item, semaphore) for item in batch]
+    coros = [classify_with_limit(item, semaphore) for item in batch]
     results = await asyncio.gather(*coros)
     return results
 
 
-async def batch_embeddings(
-    data: list[ProcessedIssue],
-    max_concurrent_calls: int = 20,
-) -> list[ProcessedIssue]:
-    oai = AsyncOpenAI()
+async def batch_embeddings(data: list[ProcessedIssue]) -> list[ProcessedIssue]:
+    embeddings = await embedding_batcher.embed_many([item.text for item in data])
+    for item, embedding in zip(data, embeddings):
+        item.embedding = embedding
+    return data
 
-    async def embed_row(
-        item: ProcessedIssue,
-        semaphore: Semaphore,
-    ):
-        async with semaphore:
-            input_text = item.text if len(item.text) < 8000 else item.text[:6000]
-            embedding = (
-                (
-                    await oai.embeddings.create(
-                        input=input_text, model="text-embedding-3-small"
-                    )
-                )
-                .data[0]
-                .embedding
-            )
-            item.embedding = embedding
-            return item
-
-    semaphore = Semaphore(max_concurrent_calls)
-    coros = [embed_row(item, semaphore) for item in data]
-    results = await asyncio.gather(*coros)
-    return results
-
-async def get_conn():
-    conn = psycopg2.connect(os.getenv('SUPABASE_URI'))
-
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT NOW();")
-
-    register_vector(conn)
-    
-    return conn
-
-async def setup_db(conn):
+async def setup_db(conn, reset: bool = True):
     init_sql = """
     CREATE EXTENSION IF NOT EXISTS vector CASCADE;
+    CREATE EXTENSION IF NOT EXISTS btree_gin;
 
+    {% if reset %}
     DROP TABLE IF EXISTS github_issue_summaries CASCADE;
     DROP TABLE IF EXISTS github_issues CASCADE;
+    DROP TABLE IF EXISTS ingest_checkpoints;
+    -- stamps of repos this run doesn't load again would keep them in the catalog
+    DROP TABLE IF EXISTS repo_ingest_stamps;
+    {% endif %}
+
+    DO $$ BEGIN
+        CREATE TYPE issue_label AS ENUM ('OPEN', 'CLOSED');
+    EXCEPTION WHEN duplicate_object THEN NULL;
+    END $$;
 
     CREATE TABLE IF NOT EXISTS github_issues (
         issue_id INTEGER,
@@ -174,117 +254,758 @@ async def setup_db(conn):
         repo_name TEXT,
         start_ts TIMESTAMPTZ NOT NULL,
         end_ts TIMESTAMPTZ,
-        embedding VECTOR(1536) NOT NULL
+        embedding VECTOR(1536) NOT NULL,
+        content_hash TEXT,
+        first_response_ts TIMESTAMPTZ
     );
+    ALTER TABLE github_issues ADD COLUMN IF NOT EXISTS content_hash TEXT;
+    ALTER TABLE github_issues ADD COLUMN IF NOT EXISTS first_response_ts TIMESTAMPTZ;
 
-    CREATE INDEX github_issue_embedding_idx
-    ON github_issues
-    USING hnsw (embedding vector_l2_ops);
+    -- Vector indexes are per repo (build_vector_indexes); the old table-wide
+    -- one only slows down writes
+    DROP INDEX IF EXISTS {{ issues_index }};
+    {{ issues_text_index }}
 
     -- Create a Hypertable that breaks it down by 1 month intervals
-    SELECT create_hypertable('github_issues', 'start_ts', chunk_time_interval => INTERVAL '1 month');
+    SELECT create_hypertable('github_issues', 'start_ts', chunk_time_interval => INTERVAL '1 month', if_not_exists => TRUE);
 
-    CREATE UNIQUE INDEX ON github_issues (issue_id, start_ts);
+    CREATE UNIQUE INDEX IF NOT EXISTS github_issues_issue_id_start_ts_idx ON github_issues (issue_id, start_ts);
 
-    CREATE TABLE github_issue_summaries (
+    {{ metrics_view }}
+
+    -- Summaries from before they carried start_ts can't be turned into a
+    -- hypertable in place; drop them so this run rebuilds them (the
+    -- classifications come from the local cache)
+    DO $$ BEGIN
+        IF to_regclass('github_issue_summaries') IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'github_issue_summaries' AND column_name = 'start_ts'
+        ) THEN
+            DROP TABLE github_issue_summaries;
+        END IF;
+    END $$;
+
+    CREATE TABLE IF NOT EXISTS github_issue_summaries (
         issue_id INTEGER,
         text TEXT,
         label issue_label NOT NULL,
         repo_name TEXT,
-        embedding VECTOR(1536) NOT NULL
+        start_ts TIMESTAMPTZ NOT NULL,
+        end_ts TIMESTAMPTZ,
+        embedding VECTOR(1536) NOT NULL,
+        content_hash TEXT
+    );
+
+    -- Same 1 month chunks as github_issues, so time-bounded searches skip
+    -- chunks in both tables
+    SELECT create_hypertable('github_issue_summaries', 'start_ts', chunk_time_interval => INTERVAL '1 month', if_not_exists => TRUE);
+
+    CREATE UNIQUE INDEX IF NOT EXISTS github_issue_summaries_issue_id_start_ts_idx ON github_issue_summaries (issue_id, start_ts);
+
+    DROP INDEX IF EXISTS {{ summaries_index }};
+    {{ summaries_text_index }}
+
+    -- Position in the dataset stream up to which every issue has been written
+    CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+        name TEXT PRIMARY KEY,
+        state JSONB NOT NULL,
+        issues_read INTEGER NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
     );
 
-    CREATE INDEX github_issue_summaries_embedding_idx
-    ON github_issue_summaries
-    USING hnsw (embedding vector_l2_ops);
+    -- Bumped whenever a repo's rows change, so the API can drop cached answers
+    CREATE TABLE IF NOT EXISTS repo_ingest_stamps (
+        repo_name TEXT PRIMARY KEY,
+        ingested_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
     """
-    cur = conn.cursor()
-    cur.execute(init_sql)
+    await conn.execute(
+        Template(init_sql).render(
+            reset=reset,
+            issues_index=HNSW_INDEXES["github_issues"],
+            summaries_index=HNSW_INDEXES["github_issue_summaries"],
+            issues_text_index=text_index_sql("github_issues"),
+            summaries_text_index=text_index_sql("github_issue_summaries"),
+            metrics_view=METRICS_SETUP_SQL,
+        )
+    )
 
-async def process_issues(n_issues: int, repos: list[str], conn):
-    issues = list(get_issues(n_issues, repos))
-    await insert_github_issues(conn, issues)
-    await insert_github_issue_summaries(conn, issues)
 
+async def load_content_hashes(pool, repos: list[str]) -> dict[tuple[int, datetime], str]:
+    # Only issues whose row and summary were both written for the same content
+    # count as done; a crash between the two writes gets redone
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            """
+            SELECT i.issue_id, i.start_ts, i.content_hash
+            FROM github_issues i
+            JOIN github_issue_summaries s
+              ON s.issue_id = i.issue_id AND s.start_ts = i.start_ts
+             AND s.content_hash = i.content_hash
+            WHERE i.repo_name = ANY(%s)
+            """,
+            (repos,),
+        )
+        return {
+            (row["issue_id"], row["start_ts"]): row["content_hash"]
+            for row in await cur.fetchall()
+        }
 
-async def insert_github_issues(conn, issues: list[GithubIssue]):
-    insert_query = """
-        INSERT INTO github_issues (issue_id, metadata, text, repo_name, start_ts, end_ts, embedding)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
+
+class IngestCheckpoint:
+    """
+    Tracks which issues read from the stream have been fully written (issue
+    row and summary) and persists the dataset state_dict at the furthest
+    position before which nothing is still in flight.
     """
 
-    embedded_issues = await batch_embeddings(issues)
-    cur = conn.cursor()
-
-    execute_batch(cur, 
-        insert_query,
-        [
-            (
-                item.issue_id,
-                json.dumps(item.metadata),
-                item.text,
-                item.repo_name,
-                item.start_ts,
-                item.end_ts,
-                item.embedding,
+    def __init__(self, pool, name: str, every: int = 100):
+        self.pool = pool
+        self.name = name
+        self.every = every
+        self.issues_read = 0
+        self._seqs: dict[int, list[int]] = {}
+        self._remaining: dict[int, int] = {}
+        self._states: dict[int, dict] = {}
+        self._low_water = -1
+
+    async def load(self) -> Optional[dict]:
+        async with self.pool.connection() as conn:
+            cur = await conn.execute(
+                "SELECT state, issues_read FROM ingest_checkpoints WHERE name = %s",
+                (self.name,),
+            )
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        self.issues_read = row["issues_read"]
+        # everything before the saved position was written by the last run
+        self._low_water = self.issues_read - 1
+        return row["state"]
+
+    def should_record(self) -> bool:
+        return (self.issues_read + 1) % self.every == 0
+
+    async def read(self, issue_id: int, state: Optional[dict], writes: int):
+        seq = self.issues_read
+        self.issues_read += 1
+        self._remaining[seq] = writes
+        if writes:
+            self._seqs.setdefault(issue_id, []).append(seq)
+        if state is not None:
+            self._states[seq] = state
+        await self._advance()
+
+    async def written(self, issue_ids: list[int]):
+        for issue_id in issue_ids:
+            seqs = self._seqs[issue_id]
+            self._remaining[seqs[0]] -= 1
+            if self._remaining[seqs[0]] == 0:
+                seqs.pop(0)
+                if not seqs:
+                    del self._seqs[issue_id]
+        await self._advance()
+
+    async def _advance(self):
+        while self._remaining.get(self._low_water + 1) == 0:
+            del self._remaining[self._low_water + 1]
+            self._low_water += 1
+
+        durable = [seq for seq in self._states if seq <= self._low_water]
+        if not durable:
+            return
+        seq = max(durable)
+        state = self._states[seq]
+        for done in durable:
+            del self._states[done]
+        await self.save(state, seq + 1)
+
+    async def save(self, state: dict, issues_read: int):
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                """
+                INSERT INTO ingest_checkpoints (name, state, issues_read, updated_at)
+                VALUES (%s, %s, %s, NOW())
+                ON CONFLICT (name) DO UPDATE
+                SET state = EXCLUDED.state,
+                    issues_read = EXCLUDED.issues_read,
+                    updated_at = EXCLUDED.updated_at
+                """,
+                (self.name, Jsonb(state), issues_read),
             )
-            for item in embedded_issues
-        ])
-    conn.commit()
-    print("GitHub issues inserted successfully.")
 
+    async def clear(self):
+        async with self.pool.connection() as conn:
+            await conn.execute("DELETE FROM ingest_checkpoints WHERE name = %s", (self.name,))
+
+
+def checkpoint_name(n_issues: int, repos: list[str]) -> str:
+    # A checkpoint only resumes the exact same filtered stream
+    key = hashlib.sha256(json.dumps([n_issues, sorted(repos)]).encode()).hexdigest()[:16]
+    return f"bigcode/the-stack-github-issues:{key}"
+
+
+# Marks the end of a stream in the pipeline queues
+_DONE = object()
+
+
+async def run_all(*coros):
+    # Like gather, but a failure cancels the siblings instead of leaving them
+    # running against queues nobody drains
+    tasks = [create_task(coro) for coro in coros]
+    try:
+        return await gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def read_issues(
+    dataset: IterableDataset,
+    outboxes: list[Queue],
+    checkpoint: IngestCheckpoint,
+    known_hashes: dict[tuple[int, datetime], str],
+):
+    # The HF streaming dataset is a blocking iterator, so pull one row at a
+    # time off the event loop; the bounded outboxes throttle how far ahead we read
+    rows = iter(dataset)
+
+    def next_issue():
+        # state_dict() must be taken on the same thread, right after the row
+        row = next(rows, None)
+        if row is None:
+            return None, None
+        state = dataset.state_dict() if checkpoint.should_record() else None
+        return parse_issue(row), state
+
+    while True:
+        issue, state = await to_thread(next_issue)
+        if issue is None:
+            break
+        unchanged = known_hashes.get((issue.issue_id, issue.start_ts)) == issue.content_hash
+        # an unchanged issue has nothing left to write
+        await checkpoint.read(issue.issue_id, state, writes=0 if unchanged else 2)
+        if unchanged:
+            continue
+        for outbox in outboxes:
+            await outbox.put(issue)
+    for outbox in outboxes:
+        await outbox.put(_DONE)
+
+
+async def run_stage(
+    inbox: Queue,
+    outboxes: list[Queue],
+    handle: Callable[[Any], Awaitable[Any]],
+    concurrency: int,
+):
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                await inbox.put(_DONE)  # let the sibling workers see it too
+                return
+            result = await handle(item)
+            for outbox in outboxes:
+                await outbox.put(result)
+
+    await run_all(*[worker() for _ in range(concurrency)])
+    for outbox in outboxes:
+        await outbox.put(_DONE)
+
+
+async def write_batches(
+    inbox: Queue,
+    write: Callable[[list], Awaitable[None]],
+    batch_size: int,
+    flush_interval: float,
+    progress: tqdm,
+) -> tuple[int, float]:
+    # Flush on a full batch, on end of stream, or when the stream goes quiet
+    # for flush_interval seconds so rows keep landing during slow stretches.
+    # Returns rows written and seconds spent inside write().
+    batch = []
+    done = False
+    rows_written = 0
+    write_seconds = 0.0
+    while not done:
+        try:
+            item = await wait_for(inbox.get(), timeout=flush_interval)
+        except QueueTimeout:
+            item = None
+
+        if item is _DONE:
+            done = True
+        elif item is not None:
+            batch.append(item)
+
+        if batch and (len(batch) >= batch_size or done or item is None):
+            start = time.perf_counter()
+            await write(batch)
+            write_seconds += time.perf_counter() - start
+            rows_written += len(batch)
+            progress.update(len(batch))
+            batch = []
+    return rows_written, write_seconds
+
+
+async def stamp_repos(pool, repo_names: set[str]):
+    async with pool.connection() as conn:
+        await conn.execute(
+            """
+            INSERT INTO repo_ingest_stamps (repo_name, ingested_at)
+            SELECT unnest(%s::text[]), NOW()
+            ON CONFLICT (repo_name) DO UPDATE SET ingested_at = EXCLUDED.ingested_at
+            """,
+            [sorted(repo_names)],
+        )
 
-async def insert_github_issue_summaries(conn, issues: list[GithubIssue]):
-    insert_query = """
-    INSERT INTO github_issue_summaries (issue_id, text, label, embedding,repo_name)
-    VALUES (%s, %s, %s, %s, %s)
-    """
-    
-    summarized_issues = await batch_classify_issue(issues)
-    embedded_summaries = await batch_embeddings(summarized_issues)
-    cur = conn.cursor()
-    
-    execute_batch(cur,
-        insert_query,
-        [
-            (item.issue_id, item.text, item.label, item.embedding, item.repo_name)
-            for item in embedded_summaries
-        ],
+
+async def process_issues(
+    n_issues: int,
+    repos: list[str],
+    pool,
+    incremental: bool = False,
+    bulk: bool = False,
+    checkpoint_every: int = 100,
+    classify_concurrency: int = 20,
+    embed_concurrency: int = 256,
+    queue_size: int = 64,
+    batch_size: int = 50,
+    flush_interval: float = 2.0,
+    local_index: Optional[dict[str, LocalIndexBuilder]] = None,
+):
+    # Each embed worker holds one item; the batcher packs whatever the workers
+    # have in flight into shared requests, so concurrency is the batch ceiling.
+    # dataset reader -> embed -> github_issues writer
+    #                \-> classify -> embed -> github_issue_summaries writer
+    checkpoint = IngestCheckpoint(pool, checkpoint_name(n_issues, repos), checkpoint_every)
+    state = None
+    known_hashes = {}
+    if incremental:
+        state = await checkpoint.load()
+        known_hashes = await load_content_hashes(pool, repos)
+        if state is not None:
+            print(f"Resuming after {checkpoint.issues_read} issues")
+    dataset = issue_stream(n_issues, repos, state)
+
+    async def write_issues(batch: list[GithubIssue]):
+        if bulk:
+            await copy_github_issues(pool, batch, upsert=incremental)
+        else:
+            await insert_github_issues(pool, batch)
+        await checkpoint.written([item.issue_id for item in batch])
+        await stamp_repos(pool, {item.repo_name for item in batch})
+        if local_index:
+            for item in batch:
+                local_index["github_issues"].add(
+                    {**item.model_dump(), "content_hash": item.content_hash}, item.embedding
+                )
+
+    async def write_summaries(batch: list[ProcessedIssue]):
+        if bulk:
+            await copy_github_issue_summaries(pool, batch, upsert=incremental)
+        else:
+            await insert_github_issue_summaries(pool, batch)
+        await checkpoint.written([item.issue_id for item in batch])
+        await stamp_repos(pool, {item.repo_name for item in batch})
+        if local_index:
+            for item in batch:
+                local_index["github_issue_summaries"].add(item.model_dump(), item.embedding)
+
+    issues_to_embed = Queue(queue_size)
+    issues_to_classify = Queue(queue_size)
+    summaries_to_embed = Queue(queue_size)
+    issues_to_write = Queue(queue_size)
+    summaries_to_write = Queue(queue_size)
+
+    with tqdm(desc="github_issues", unit="row") as issues_progress, tqdm(
+        desc="github_issue_summaries", unit="row"
+    ) as summaries_progress:
+        results = await run_all(
+            read_issues(
+                dataset, [issues_to_embed, issues_to_classify], checkpoint, known_hashes
+            ),
+            run_stage(issues_to_embed, [issues_to_write], embed_item, embed_concurrency),
+            run_stage(
+                issues_to_classify,
+                [summaries_to_embed],
+                classify_issue,
+                classify_concurrency,
+            ),
+            run_stage(
+                summaries_to_embed, [summaries_to_write], embed_item, embed_concurrency
+            ),
+            write_batches(
+                issues_to_write,
+                write_issues,
+                batch_size,
+                flush_interval,
+                issues_progress,
+            ),
+            write_batches(
+                summaries_to_write,
+                write_summaries,
+                batch_size,
+                flush_interval,
+                summaries_progress,
+            ),
+        )
+    # The stream is exhausted; the next incremental run starts from the top and
+    # relies on content hashes to skip what's already there
+    await checkpoint.clear()
+    print(f"Embedding requests: {embedding_batcher.stats()}")
+    print(f"Classification cache: {classification_cache.stats()}")
+    mode = "COPY" if bulk else "INSERT"
+    for table_name, (rows, seconds) in zip(
+        ["github_issues", "github_issue_summaries"], results[-2:]
+    ):
+        rate = rows / seconds if seconds else 0.0
+        print(f"{table_name}: {rows} rows via {mode} in {seconds:.2f}s ({rate:.0f} rows/s)")
+
+
+ISSUE_COLUMNS = [
+    "issue_id",
+    "metadata",
+    "text",
+    "repo_name",
+    "start_ts",
+    "end_ts",
+    "embedding",
+    "content_hash",
+    "first_response_ts",
+]
+ISSUE_COPY_TYPES = [
+    "int4",
+    "jsonb",
+    "text",
+    "text",
+    "timestamptz",
+    "timestamptz",
+    "vector",
+    "text",
+    "timestamptz",
+]
+ISSUES_ON_CONFLICT = """
+    ON CONFLICT (issue_id, start_ts) DO UPDATE
+    SET metadata = EXCLUDED.metadata,
+        text = EXCLUDED.text,
+        repo_name = EXCLUDED.repo_name,
+        end_ts = EXCLUDED.end_ts,
+        embedding = EXCLUDED.embedding,
+        content_hash = EXCLUDED.content_hash,
+        first_response_ts = EXCLUDED.first_response_ts
+    WHERE github_issues.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+"""
+
+SUMMARY_COLUMNS = [
+    "issue_id",
+    "text",
+    "label",
+    "embedding",
+    "repo_name",
+    "start_ts",
+    "end_ts",
+    "content_hash",
+]
+# issue_label's binary input is its label text
+SUMMARY_COPY_TYPES = ["int4", "text", "text", "vector", "text", "timestamptz", "timestamptz", "text"]
+SUMMARIES_ON_CONFLICT = """
+    ON CONFLICT (issue_id, start_ts) DO UPDATE
+    SET text = EXCLUDED.text,
+        label = EXCLUDED.label,
+        embedding = EXCLUDED.embedding,
+        repo_name = EXCLUDED.repo_name,
+        end_ts = EXCLUDED.end_ts,
+        content_hash = EXCLUDED.content_hash
+    WHERE github_issue_summaries.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+"""
+
+
+def issue_row(item: GithubIssue) -> tuple:
+    return (
+        item.issue_id,
+        Jsonb(item.metadata),
+        item.text,
+        item.repo_name,
+        item.start_ts,
+        item.end_ts,
+        Vector(item.embedding),
+        item.content_hash,
+        item.first_response_ts,
     )
-    conn.commit()
-    print("GitHub issue summaries inserted successfully.")
-
-
-async def main():
-    repos = [
-        "rust-lang/rust",
-        "kubernetes/kubernetes",
-        "apache/spark",
-        "golang/go",
-        "tensorflow/tensorflow",
-        "MicrosoftDocs/azure-docs",
-        "pytorch/pytorch",
-        "Microsoft/TypeScript",
-        "python/cpython",
-        "facebook/react",
-        "django/django",
-        "rails/rails",
-        "bitcoin/bitcoin",
-        "nodejs/node",
-        "ocaml/opam-repository",
-        "apache/airflow",
-        "scipy/scipy",
-        "vercel/next.js",
-    ]
-    conn = await get_conn()
-    await setup_db(conn)
-    n_issues = 400
-    await process_issues(n_issues, repos, conn)
 
 
-if __name__ == "__main__":
-    load_dotenv(dotenv_path=".env", override=True)
-    run(main())
+def summary_row(item: ProcessedIssue) -> tuple:
+    return (
+        item.issue_id,
+        item.text,
+        item.label,
+        Vector(item.embedding),
+        item.repo_name,
+        item.start_ts,
+        item.end_ts,
+        item.content_hash,
+    )
+
+
+def insert_sql(table_name: str, columns: list[str], on_conflict: str) -> sql.Composed:
+    return sql.SQL("INSERT INTO {} ({}) VALUES ({}) ").format(
+        sql.Identifier(table_name),
+        sql.SQL(", ").join(map(sql.Identifier, columns)),
+        sql.SQL(", ").join(sql.Placeholder() * len(columns)),
+    ) + sql.SQL(on_conflict)
+
+
+async def insert_github_issues(pool, issues: list[GithubIssue]):
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            cur = conn.cursor()
+            await cur.executemany(
+                insert_sql("github_issues", ISSUE_COLUMNS, ISSUES_ON_CONFLICT),
+                [issue_row(item) for item in issues],
+            )
+
+
+async def insert_github_issue_summaries(pool, summaries: list[ProcessedIssue]):
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            cur = conn.cursor()
+            await cur.executemany(
+                insert_sql("github_issue_summaries", SUMMARY_COLUMNS, SUMMARIES_ON_CONFLICT),
+                [summary_row(item) for item in summaries],
+            )
+
+
+async def copy_rows(conn, table_name: str, columns: list[str], types: list[str], rows: list[tuple]):
+    query = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT BINARY)").format(
+        sql.Identifier(table_name), sql.SQL(", ").join(map(sql.Identifier, columns))
+    )
+    async with conn.cursor() as cur:
+        async with cur.copy(query) as copy:
+            copy.set_types(types)
+            for row in rows:
+                await copy.write_row(row)
+
+
+async def copy_with_upsert(
+    conn,
+    table_name: str,
+    columns: list[str],
+    types: list[str],
+    rows: list[tuple],
+    on_conflict: str,
+):
+    # COPY can't resolve conflicts, so land the batch in a temp table and
+    # upsert from there
+    staging = f"{table_name}_staging"
+    await conn.execute(
+        sql.SQL("CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP").format(
+            sql.Identifier(staging), sql.Identifier(table_name)
+        )
+    )
+    await copy_rows(conn, staging, columns, types, rows)
+    column_list = sql.SQL(", ").join(map(sql.Identifier, columns))
+    await conn.execute(
+        sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {} ").format(
+            sql.Identifier(table_name), column_list, column_list, sql.Identifier(staging)
+        )
+        + sql.SQL(on_conflict)
+    )
+
+
+async def copy_github_issues(pool, issues: list[GithubIssue], upsert: bool = False):
+    rows = [issue_row(item) for item in issues]
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            if upsert:
+                await copy_with_upsert(
+                    conn, "github_issues", ISSUE_COLUMNS, ISSUE_COPY_TYPES, rows, ISSUES_ON_CONFLICT
+                )
+            else:
+                await copy_rows(conn, "github_issues", ISSUE_COLUMNS, ISSUE_COPY_TYPES, rows)
+
+
+async def copy_github_issue_summaries(
+    pool, summaries: list[ProcessedIssue], upsert: bool = False
+):
+    rows = [summary_row(item) for item in summaries]
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            if upsert:
+                await copy_with_upsert(
+                    conn,
+                    "github_issue_summaries",
+                    SUMMARY_COLUMNS,
+                    SUMMARY_COPY_TYPES,
+                    rows,
+                    SUMMARIES_ON_CONFLICT,
+                )
+            else:
+                await copy_rows(
+                    conn, "github_issue_summaries", SUMMARY_COLUMNS, SUMMARY_COPY_TYPES, rows
+                )
 
 
-    
\ No newline at end of file
+async def vector_index_names(conn) -> list[str]:
+    cur = await conn.execute(
+        """
+        SELECT indexname FROM pg_indexes
+        WHERE schemaname = current_schema() AND tablename = ANY(%s) AND indexdef LIKE '%%USING hnsw%%'
+        """,
+        (list(HNSW_INDEXES),),
+    )
+    return [row["indexname"] for row in await cur.fetchall()]
+
+
+async def drop_vector_indexes(pool, keep: frozenset = frozenset()):
+    # Loading without the HNSW indexes avoids maintaining the graphs row by row
+    async with pool.connection() as conn:
+        for index_name in await vector_index_names(conn):
+            if index_name not in keep:
+                await conn.execute(
+                    sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(index_name))
+                )
+
+
+async def build_vector_indexes(
+    pool,
+    repos: list[str],
+    parallel_workers: int = 4,
+    maintenance_work_mem: str = "512MB",
+    storage: str = VECTOR_STORAGE,
+):
+    # One partial index per table and repo, so each search walks only its
+    # repo's graph. Existing indexes are kept, so this also adds the indexes
+    # for repos a load has just introduced; indexes of another storage mode
+    # are dropped, since searches no longer use them. pgvector builds HNSW in
+    # parallel; the graph also needs to fit in maintenance_work_mem or the
+    # build slows down sharply.
+    await drop_vector_indexes(
+        pool,
+        keep=frozenset(
+            repo_hnsw_index_name(table_name, repo_name, storage)
+            for table_name in HNSW_INDEXES
+            for repo_name in repos
+        ),
+    )
+    async with pool.connection() as conn:
+        for table_name in HNSW_INDEXES:
+            start = time.perf_counter()
+            for repo_name in repos:
+                async with conn.transaction():
+                    await conn.execute(
+                        """
+                        SELECT set_config('max_parallel_maintenance_workers', %s, true),
+                               set_config('maintenance_work_mem', %s, true),
+                               set_config('statement_timeout', '0', true)
+                        """,
+                        (str(parallel_workers), maintenance_work_mem),
+                    )
+                    await conn.execute(hnsw_index_sql(table_name, repo_name, storage))
+            print(
+                f"Built {storage} HNSW indexes on {table_name} for {len(repos)} repos "
+                f"in {time.perf_counter() - start:.1f}s"
+            )
+
+
+async def main(
+    incremental: bool,
+    n_issues: int,
+    bulk: bool,
+    defer_index: bool,
+    index_workers: int,
+    local_index: Optional[str] = None,
+    local_index_dtype: str = "float32",
+    repos: list[str] = DEFAULT_REPOS,
+    vector_storage: str = VECTOR_STORAGE,
+):
+    pool = await get_pool()
+    async with pool.connection() as conn:
+        await setup_db(conn, reset=not incremental)
+    # Every repo loaded before or in this run gets its own vector index
+    indexed_repos = sorted(set(await load_repo_catalog(pool)) | set(repos))
+    if defer_index:
+        await drop_vector_indexes(pool)
+    else:
+        await build_vector_indexes(
+            pool, indexed_repos, parallel_workers=index_workers, storage=vector_storage
+        )
+    # A full load writes the local index from the pipeline itself; an
+    # incremental one only sees changed issues, so it re-exports the tables
+    builders = None
+    if local_index and not incremental:
+        builders = {
+            table_name: LocalIndexBuilder(local_index, table_name, local_index_dtype)
+            for table_name in HNSW_INDEXES
+        }
+    await process_issues(
+        n_issues, repos, pool, incremental=incremental, bulk=bulk, local_index=builders
+    )
+    if defer_index:
+        await build_vector_indexes(
+            pool, indexed_repos, parallel_workers=index_workers, storage=vector_storage
+        )
+    await refresh_issue_metrics(pool)
+    if builders:
+        for builder in builders.values():
+            builder.finish()
+    elif local_index:
+        await build_from_postgres(local_index, local_index_dtype, hnsw=False)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="keep existing tables, skip unchanged issues and resume from the last checkpoint",
+    )
+    parser.add_argument("--n-issues", type=int, default=400)
+    parser.add_argument(
+        "--bulk", action="store_true", help="load rows with binary COPY instead of INSERT"
+    )
+    parser.add_argument(
+        "--defer-index",
+        action="store_true",
+        help="drop the HNSW indexes during the load and rebuild them afterwards",
+    )
+    parser.add_argument("--index-workers", type=int, default=4)
+    parser.add_argument(
+        "--vector-storage",
+        choices=["full", "halfvec", "binary"],
+        default=VECTOR_STORAGE,
+        help="what the HNSW indexes are built on; must match the API's VECTOR_STORAGE",
+    )
+    parser.add_argument(
+        "--local-index",
+        metavar="PATH",
+        help="also write the in-process search index (see local_index.py) to PATH",
+    )
+    parser.add_argument(
+        "--local-index-dtype", choices=["float32", "float16", "int8"], default="float32"
+    )
+    parser.add_argument(
+        "--repos",
+        nargs="+",
+        default=DEFAULT_REPOS,
+        metavar="OWNER/REPO",
+        help="repos to load; the API serves whichever repos are in the database",
+    )
+    args = parser.parse_args()
+
+    run(
+        main(
+            args.incremental,
+            args.n_issues,
+            args.bulk,
+            args.defer_index,
+            args.index_workers,
+            args.local_index,
+            args.local_index_dtype,
+            args.repos,
+            args.vector_storage,
+        )
+    )
@@ -0,0 +1,48 @@
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from typing import Optional
+import httpx
+import instructor
+import os
+
+
+# Keep-alive connections are reused across requests so each LLM/embedding call
+# skips the TCP+TLS handshake to api.openai.com.
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.getenv("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "60"))
+
+_async_openai: Optional[AsyncOpenAI] = None
+_instructor_clients: dict[instructor.Mode, instructor.AsyncInstructor] = {}
+
+
+def get_async_openai() -> AsyncOpenAI:
+    global _async_openai
+    if _async_openai is None:
+        _async_openai = AsyncOpenAI(
+            timeout=OPENAI_TIMEOUT,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=OPENAI_MAX_CONNECTIONS,
+                    max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+                    keepalive_expiry=60,
+                ),
+            ),
+        )
+    return _async_openai
+
+
+def get_async_instructor(
+    mode: instructor.Mode = instructor.Mode.TOOLS,
+) -> instructor.AsyncInstructor:
+    # instructor clients are thin wrappers, one per mode over the same AsyncOpenAI
+    if mode not in _instructor_clients:
+        _instructor_clients[mode] = instructor.from_openai(get_async_openai(), mode=mode)
+    return _instructor_clients[mode]
+
+
+async def close_clients():
+    global _async_openai
+    if _async_openai is not None:
+        await _async_openai.close()
+        _async_openai = None
+    _instructor_clients.clear()
@@ -0,0 +1,485 @@
+# In-process alternative to the Postgres vector search. Each table is stored as
+# one matrix of unit-normalized embeddings, rows grouped by repo_name so a
+# repo's partition is a contiguous slice, memory-mapped from an .npy file.
+# Build from the database with
+#   python local_index.py --dtype float16
+# or pass --local-index to ingest.py to write it while ingesting.
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from asyncio import run
+from search import (
+    TABLE_METRICS,
+    HYBRID_CANDIDATES,
+    IterativeScan,
+    SearchHit,
+    reciprocal_rank_fusion,
+)
+from typing import Literal, Optional
+import json
+import math
+import numpy as np
+import os
+import re
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+Dtype = Literal["float32", "float16", "int8"]
+
+# Rows per matmul, bounds the float32 temporaries for quantized partitions
+SCAN_BLOCK_ROWS = 65536
+
+# Keeps dotted and dashed names whole: "next.js", "gpt-4o", "k8s.io"
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[._-][a-z0-9]+)*")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Inverted index over row text for keyword search without Postgres. Like
+    websearch_to_tsquery without operators, a row matches only if it has every
+    query term; matches are ranked by BM25. Terms are not stemmed.
+    """
+
+    def __init__(self, texts: list[Optional[str]], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: dict[str, dict[int, int]] = {}
+        lengths = []
+        for i, text in enumerate(texts):
+            tokens = tokenize(text or "")
+            lengths.append(len(tokens))
+            for token in tokens:
+                postings = self.postings.setdefault(token, {})
+                postings[i] = postings.get(i, 0) + 1
+        self.lengths = lengths
+        self.average_length = sum(lengths) / len(lengths) if lengths else 0.0
+
+    def matches(self, terms: list[str], start: int, end: int) -> list[int]:
+        if not terms:
+            return []
+        # intersect starting from the rarest term
+        postings = sorted((self.postings.get(term, {}) for term in set(terms)), key=len)
+        return [
+            i for i in postings[0] if start <= i < end and all(i in p for p in postings[1:])
+        ]
+
+    def rank(self, terms: list[str], start: int, end: int, limit: Optional[int]) -> list[int]:
+        rows = self.matches(terms, start, end)
+        scores = dict.fromkeys(rows, 0.0)
+        for term in set(terms):
+            postings = self.postings.get(term, {})
+            idf = math.log(1 + (len(self.lengths) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i in rows:
+                tf = postings[i]
+                norm = 1 - self.b + self.b * self.lengths[i] / self.average_length
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return sorted(rows, key=scores.get, reverse=True)[:limit]
+
+
+class LocalIndexBuilder:
+    """
+    Collects rows and their embeddings for one table, then writes the index
+    files: vectors.npy (float32, float16, or int8 with a per-row scale in
+    scales.npy), rows.jsonl in the same order without embeddings, and
+    meta.json with each repo's [start, end) slice.
+    """
+
+    def __init__(self, directory: str, table_name: str, dtype: Dtype = "float32"):
+        if TABLE_METRICS[table_name] != "cosine":
+            raise ValueError(f"Local index only supports cosine, not {TABLE_METRICS[table_name]}")
+        self.directory = os.path.join(directory, table_name)
+        self.table_name = table_name
+        self.dtype = dtype
+        self._rows: dict[str, list[tuple[dict, np.ndarray]]] = {}
+
+    def add(self, row: dict, embedding):
+        row = {key: value for key, value in row.items() if key != "embedding"}
+        self._rows.setdefault(row["repo_name"], []).append(
+            (row, np.asarray(embedding, dtype=np.float32))
+        )
+
+    def finish(self, hnsw: bool = False) -> dict:
+        os.makedirs(self.directory, exist_ok=True)
+        repos, rows, vectors = {}, [], []
+        for repo_name in sorted(self._rows):
+            start = len(rows)
+            for row, embedding in self._rows[repo_name]:
+                rows.append(row)
+                vectors.append(embedding)
+            repos[repo_name] = [start, len(rows)]
+
+        matrix = np.stack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        if self.dtype == "int8":
+            scales = np.abs(matrix).max(axis=1, initial=0) / 127
+            np.save(os.path.join(self.directory, "scales.npy"), scales.astype(np.float32))
+            stored = np.round(matrix / scales[:, None]).astype(np.int8)
+        else:
+            stored = matrix.astype(self.dtype)
+        np.save(os.path.join(self.directory, "vectors.npy"), stored)
+
+        with open(os.path.join(self.directory, "rows.jsonl"), "w") as f:
+            for row in rows:
+                f.write(json.dumps(row, default=_json_default) + "\n")
+
+        if hnsw:
+            build_hnsw(self.directory, matrix, repos)
+
+        meta = {
+            "table_name": self.table_name,
+            "dtype": self.dtype,
+            "dimensions": int(matrix.shape[1]),
+            "repos": repos,
+            "hnsw": hnsw,
+        }
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        return meta
+
+
+def utc_datetime64(value: Optional[datetime]) -> np.datetime64:
+    # naive datetimes are taken to be UTC, like timestamptz does with no zone
+    if value is None:
+        return np.datetime64("NaT")
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, "us")
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't store {type(value).__name__} in rows.jsonl")
+
+
+def build_hnsw(directory: str, matrix: np.ndarray, repos: dict, m: int = 16, ef_construction: int = 64):
+    # Same m / ef_construction defaults as pgvector; one graph per repo partition
+    if hnswlib is None:
+        raise ImportError("hnsw=True needs the optional hnswlib package")
+    os.makedirs(os.path.join(directory, "hnsw"), exist_ok=True)
+    for i, (start, end) in enumerate(repos.values()):
+        graph = hnswlib.Index(space="ip", dim=matrix.shape[1])
+        graph.init_index(max_elements=max(end - start, 1), M=m, ef_construction=ef_construction)
+        graph.add_items(matrix[start:end], np.arange(start, end))
+        graph.save_index(os.path.join(directory, "hnsw", f"{i}.bin"))
+
+
+class LocalIndex:
+    """
+    One table's index, memory-mapped read-only. Exact search is a blocked
+    dot product over the repo's slice followed by argpartition; with an HNSW
+    graph and ef_search set, the graph is searched instead.
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.repos = {repo: tuple(bounds) for repo, bounds in self.meta["repos"].items()}
+        self.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        self.scales = None
+        if self.meta["dtype"] == "int8":
+            self.scales = np.load(os.path.join(directory, "scales.npy"), mmap_mode="r")
+        with open(os.path.join(directory, "rows.jsonl")) as f:
+            self.rows = [json.loads(line) for line in f]
+        self.start_ts = np.array(
+            [
+                utc_datetime64(parse_timestamp(row.get("start_ts")))
+                for row in self.rows
+            ],
+            dtype="datetime64[us]",
+        )
+
+        self._bm25 = None
+        self.graphs = {}
+        if self.meta["hnsw"] and hnswlib is not None:
+            for i, (repo, (start, end)) in enumerate(self.repos.items()):
+                graph = hnswlib.Index(space="ip", dim=self.meta["dimensions"])
+                graph.load_index(
+                    os.path.join(directory, "hnsw", f"{i}.bin"), max_elements=max(end - start, 1)
+                )
+                self.graphs[repo] = graph
+
+    def scores(self, start: int, end: int, query: np.ndarray) -> np.ndarray:
+        scores = np.empty(end - start, dtype=np.float32)
+        for block in range(start, end, SCAN_BLOCK_ROWS):
+            stop = min(block + SCAN_BLOCK_ROWS, end)
+            vectors = self.vectors[block:stop]
+            if vectors.dtype != np.float32:
+                vectors = vectors.astype(np.float32)
+            block_scores = vectors @ query
+            if self.scales is not None:
+                block_scores *= self.scales[block:stop]
+            scores[block - start : stop - start] = block_scores
+        return scores
+
+    def distances(self, indices: list[int], query: np.ndarray) -> np.ndarray:
+        # Cosine distances of a few rows, as pgvector's <=> reports them
+        vectors = self.vectors[np.asarray(indices, dtype=np.int64)].astype(np.float32)
+        scores = vectors @ query
+        if self.scales is not None:
+            scores *= self.scales[np.asarray(indices, dtype=np.int64)]
+        return 1 - scores
+
+    def hit(self, i: int, distance: Optional[float] = None) -> SearchHit:
+        row = self.rows[i]
+        return SearchHit(
+            row["issue_id"],
+            row["repo_name"],
+            row.get("text"),
+            row.get("label"),
+            parse_timestamp(row.get("start_ts")),
+            parse_timestamp(row.get("end_ts")),
+            distance,
+        )
+
+    @property
+    def bm25(self) -> BM25Index:
+        # built on first keyword query; vector-only deployments never pay for it
+        if self._bm25 is None:
+            self._bm25 = BM25Index([row.get("text") for row in self.rows])
+        return self._bm25
+
+    def time_mask(
+        self, start: int, end: int, since: Optional[datetime], until: Optional[datetime]
+    ) -> Optional[np.ndarray]:
+        # Rows of [start, end) with since <= start_ts < until; None when unbounded
+        if since is None and until is None:
+            return None
+        start_ts = self.start_ts[start:end]
+        mask = np.ones(end - start, dtype=bool)
+        if since is not None:
+            mask &= start_ts >= utc_datetime64(since)
+        if until is not None:
+            mask &= start_ts < utc_datetime64(until)
+        return mask
+
+    def nearest(
+        self,
+        repo_name: str,
+        embedding: list[float],
+        limit: int,
+        ef_search: Optional[int],
+        mask: Optional[np.ndarray] = None,
+    ) -> list[int]:
+        start, end = self.repos.get(repo_name, (0, 0))
+        k = min(limit, end - start if mask is None else int(mask.sum()))
+        if k == 0:
+            return []
+
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+        graph = self.graphs.get(repo_name)
+        if graph is not None and ef_search is not None and mask is None:
+            graph.set_ef(max(ef_search, k))
+            return [int(i) for i in graph.knn_query(query, k=k)[0][0]]
+
+        # time-bounded searches scan exactly, so they always return k rows
+        scores = self.scores(start, end, query)
+        if mask is not None:
+            scores[~mask] = -np.inf
+        top = np.argpartition(-scores, k - 1)[:k]
+        return [int(i) + start for i in top[np.argsort(-scores[top])]]
+
+    def keyword_matches(
+        self, repo_name: str, keywords: str, mask: Optional[np.ndarray], limit: Optional[int] = None
+    ) -> list[int]:
+        start, end = self.repos.get(repo_name, (0, 0))
+        matches = self.bm25.rank(tokenize(keywords), start, end, limit=None)
+        if mask is not None:
+            matches = [i for i in matches if mask[i - start]]
+        return matches[:limit]
+
+    def search(
+        self,
+        repo_name: str,
+        embedding: Optional[list[float]],
+        limit: int,
+        ef_search: Optional[int] = None,
+        keywords: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> list[SearchHit]:
+        start, end = self.repos.get(repo_name, (0, 0))
+        mask = self.time_mask(start, end, since, until)
+        if keywords:
+            candidates = max(HYBRID_CANDIDATES, limit)
+            rankings = [self.keyword_matches(repo_name, keywords, mask, candidates)]
+            if embedding is not None:
+                rankings.append(self.nearest(repo_name, embedding, candidates, ef_search, mask))
+            indices = reciprocal_rank_fusion(rankings, limit)
+        elif embedding is not None:
+            indices = self.nearest(repo_name, embedding, limit, ef_search, mask)
+        else:
+            indices = range(start, end) if mask is None else np.flatnonzero(mask) + start
+            indices = indices[:limit]
+        if embedding is None or not len(indices):
+            return [self.hit(i) for i in indices]
+        query = np.asarray(embedding, dtype=np.float32)
+        distances = self.distances(indices, query / np.linalg.norm(query))
+        return [self.hit(i, float(d)) for i, d in zip(indices, distances)]
+
+    def count(
+        self,
+        repo_name: str,
+        keywords: str,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> int:
+        start, end = self.repos.get(repo_name, (0, 0))
+        mask = self.time_mask(start, end, since, until)
+        matches = self.bm25.matches(tokenize(keywords), start, end)
+        return len(matches) if mask is None else sum(bool(mask[i - start]) for i in matches)
+
+    def timestamps(self, column: str, start: int, end: int) -> np.ndarray:
+        return np.array(
+            [
+                utc_datetime64(parse_timestamp(row.get(column)))
+                for row in self.rows[start:end]
+            ],
+            dtype="datetime64[us]",
+        )
+
+    def metrics(
+        self,
+        repo_name: str,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+    ) -> list[dict]:
+        # Same rows as metrics.ISSUE_METRICS_SQL, computed from the repo's slice
+        start, end = self.repos.get(repo_name, (0, 0))
+        opened_at = self.start_ts[start:end]
+        closed_at = self.timestamps("end_ts", start, end)
+        to_close = (closed_at - opened_at) / np.timedelta64(1, "s")
+        to_respond = (
+            self.timestamps("first_response_ts", start, end) - opened_at
+        ) / np.timedelta64(1, "s")
+        months = opened_at.astype("datetime64[M]")
+        close_months = closed_at.astype("datetime64[M]")
+
+        def stat(values: np.ndarray, fn, scale: float) -> Optional[float]:
+            values = values[~np.isnan(values)]
+            return float(fn(values)) / scale if len(values) else None
+
+        rows, backlog = [], 0
+        all_months = np.concatenate([months, close_months])
+        for month in np.unique(all_months[~np.isnat(all_months)]):
+            selected = months == month
+            close, respond = to_close[selected], to_respond[selected]
+            # closed counts the month's closures, still_open the month's openings
+            opened, closed = int(selected.sum()), int((close_months == month).sum())
+            still_open = int(np.isnan(close).sum())
+            backlog += opened - closed
+            month_start = month.astype("datetime64[us]").item().replace(tzinfo=timezone.utc)
+            if since is not None and month < utc_datetime64(since).astype("datetime64[M]"):
+                continue
+            if until is not None and month.astype("datetime64[us]") >= utc_datetime64(until):
+                continue
+            rows.append(
+                {
+                    "month": month_start,
+                    "opened": opened,
+                    "closed": closed,
+                    "still_open": still_open,
+                    "open_backlog": backlog,
+                    "avg_days_to_close": stat(close, np.mean, 86400),
+                    "p50_days_to_close": stat(close, np.median, 86400),
+                    "p90_days_to_close": stat(close, lambda v: np.percentile(v, 90), 86400),
+                    "responded": int((~np.isnan(respond)).sum()),
+                    "avg_hours_to_first_response": stat(respond, np.mean, 3600),
+                    "p50_hours_to_first_response": stat(respond, np.median, 3600),
+                }
+            )
+        return rows
+
+
+class LocalSearch:
+    """
+    SearchBackend over the tables under `directory`. Scans are a few
+    milliseconds per repo, so they run inline on the event loop.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.indexes: dict[str, LocalIndex] = {}
+
+    def index(self, table_name: str) -> LocalIndex:
+        if table_name not in self.indexes:
+            self.indexes[table_name] = LocalIndex(os.path.join(self.directory, table_name))
+        return self.indexes[table_name]
+
+    async def search(
+        self,
+        table_name: str,
+        repo_name: str,
+        embedding: Optional[list[float]],
+        limit: int,
+        ef_search: Optional[int] = None,
+        iterative_scan: Optional[IterativeScan] = None,
+        keywords: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> list[SearchHit]:
+        # iterative_scan is a pgvector setting; exact scans always return limit rows
+        return self.index(table_name).search(
+            repo_name, embedding, limit, ef_search, keywords, start, end
+        )
+
+    async def count(
+        self,
+        table_name: str,
+        repo_name: str,
+        keywords: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> int:
+        return self.index(table_name).count(repo_name, keywords, start, end)
+
+    async def metrics(
+        self,
+        repo_name: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> list[dict]:
+        return self.index("github_issues").metrics(repo_name, start, end)
+
+    async def repos(self) -> list[str]:
+        return sorted(self.index("github_issues").repos)
+
+
+async def build_from_postgres(directory: str, dtype: Dtype, hnsw: bool):
+    from db import get_pool
+
+    pool = await get_pool()
+    for table_name in TABLE_METRICS:
+        builder = LocalIndexBuilder(directory, table_name, dtype)
+        async with pool.connection() as conn:
+            async with conn.transaction():
+                # server-side cursor, rows are streamed rather than fetched at once
+                cur = conn.cursor(name=f"export_{table_name}")
+                await cur.execute(f"SELECT * FROM {table_name}")
+                async for row in cur:
+                    builder.add(row, row["embedding"])
+        meta = builder.finish(hnsw)
+        print(f"{table_name}: {sum(end - start for start, end in meta['repos'].values())} rows")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--path", default=os.getenv("LOCAL_INDEX_PATH", "local_index"))
+    parser.add_argument("--dtype", choices=["float32", "float16", "int8"], default="float32")
+    parser.add_argument("--hnsw", action="store_true")
+    args = parser.parse_args()
+    load_dotenv()
+    run(build_from_postgres(args.path, args.dtype, args.hnsw))
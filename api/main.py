@@ -1,20 +1,57 @@
 from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from github import Github
 from dotenv import load_dotenv
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import uvicorn
 import requests
 import openai
 import os
+import json
 import re
 import markdown
-from eval import test_one_step_agent
 
 
-load_dotenv()  # load environment variables
-app = FastAPI()
+load_dotenv()  # load environment variables before modules read their config
+
+from db import close_pool, pool_stats
+from search import PostgresSearch, get_search_backend, search_flights
+from llm import close_clients
+from embeddings import (
+    embedding_cache,
+    embedding_batcher,
+    embedding_flights,
+    embed_query,
+    normalize_text,
+)
+from answer_cache import answer_cache
+from agents_data_models import answer_question, answer_question_stream
+from repo_index import get_repo_index
+from router import router
+from context import context_packer
+from singleflight import SingleFlight
+from time import perf_counter
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one connection pool (or local index) for the lifetime of the app, shared
+    # by every request
+    # the repo catalog is loaded up front too, so no request waits on it
+    await get_repo_index(await get_search_backend())
+    yield
+    await close_pool()
+    await close_clients()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Concurrent requests with the same normalized question share one run of the
+# pipeline; /chat/stream subscribers all receive the one run's events
+chat_flights = SingleFlight()
 
 # Enable CORS
 app.add_middleware(
@@ -38,15 +75,94 @@ class Message(BaseModel):
 def index():
     return {"message": "Hello, World!"}
 
+@app.get("/stats")
+def stats():
+    return {
+        "db_pool": pool_stats(),
+        "embedding_cache": embedding_cache.stats(),
+        "embedding_batcher": embedding_batcher.stats(),
+        "answer_cache": answer_cache.stats(),
+        "router": router.stats(),
+        "context_packer": context_packer.stats(),
+        "single_flight": {
+            "chat": chat_flights.stats(),
+            "embeddings": embedding_flights.stats(),
+            "search": search_flights.stats(),
+        },
+    }
+
+async def cached_answer(question: str):
+    backend = await get_search_backend()
+    if isinstance(backend, PostgresSearch):
+        # a local index only changes when it is rebuilt and the app restarted
+        await answer_cache.refresh(backend.pool)
+    # The question embedding goes through the embedding cache, and a hit here
+    # skips tool selection, search and summarization
+    embedding = await embed_query(question)
+    repos = await get_repo_index(backend)
+    # Looked up only under the repos the question names unambiguously; one
+    # that names none could be answered from any repo's entries otherwise
+    return backend, repos, embedding, answer_cache.get(embedding, repos.named(question, common=False))
+
 @app.post("/chat")
 async def chat(message: Message):
     # Mock response - in a real scenario, this would search the internal documentation
     # response = f"You asked about: {message.content}. This is a mock response from the internal documentation system."
     # return {"response": response}
-    res = await test_one_step_agent(message.content)
-        
+    res = await chat_flights.do(
+        ("chat", normalize_text(message.content)), lambda: answer(message.content)
+    )
     return {"response": res}
 
+async def answer(question: str) -> str:
+    start = perf_counter()
+    backend, repos, embedding, res = await cached_answer(question)
+    if res is None:
+        res, answered = await answer_question(question, repos, backend, embedding=embedding)
+        cache_answer(embedding, res, answered, perf_counter() - start)
+    return res
+
+def cache_answer(embedding: list[float], answer: str, repos: list[str], latency: float):
+    # Answers drawn from several repos aren't cached: they'd only be filed
+    # under one repo, and an ingest of the others would leave them stale
+    if len(repos) == 1:
+        answer_cache.put(embedding, answer, repos[0], latency)
+
+def sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.post("/chat/stream")
+async def chat_stream(message: Message):
+    # Server-Sent Events: repo_resolved, tool_failed*, issues_retrieved and/or
+    # metrics_retrieved, token*, done (or repo_resolved, issues_counted, done
+    # for counts); error if a stage fails after the response has started
+    async def events():
+        try:
+            async for event in chat_flights.stream(
+                ("stream", normalize_text(message.content)), lambda: answer_events(message.content)
+            ):
+                yield event
+        except Exception as e:
+            yield sse("error", {"detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def answer_events(question: str):
+    start = perf_counter()
+    backend, repos, embedding, res = await cached_answer(question)
+    if res is not None:
+        yield sse("done", {"response": res, "cached": True})
+        return
+    async for event, data in answer_question_stream(question, repos, backend, embedding=embedding):
+        if event == "done":
+            cache_answer(embedding, data["response"], data["repos"], perf_counter() - start)
+        yield sse(event, data)
+
 
 # function to convert string to list
 # used for formatting the chatgpt response
@@ -0,0 +1,125 @@
+from datetime import datetime
+from db import PREPARE_STATEMENTS
+from psycopg import sql
+from typing import Optional
+
+
+# Per-repo, per-month issue metrics over github_issues, bucketed by the month
+# an issue was opened. Timescale keeps it up to date as a continuous aggregate;
+# builds without continuous aggregates (the Apache-licensed TimescaleDB that
+# Supabase ships) get a plain materialized view that ingest refreshes.
+METRICS_VIEW = "github_issue_monthly_metrics"
+
+METRICS_SELECT_SQL = """
+SELECT
+    repo_name,
+    time_bucket(INTERVAL '1 month', start_ts) AS month,
+    count(*) AS opened,
+    count(end_ts) AS closed,
+    count(first_response_ts) AS responded,
+    avg(extract(epoch FROM end_ts - start_ts)) AS avg_seconds_to_close,
+    percentile_cont(0.5) WITHIN GROUP (ORDER BY extract(epoch FROM end_ts - start_ts)) AS p50_seconds_to_close,
+    percentile_cont(0.9) WITHIN GROUP (ORDER BY extract(epoch FROM end_ts - start_ts)) AS p90_seconds_to_close,
+    avg(extract(epoch FROM first_response_ts - start_ts)) AS avg_seconds_to_first_response,
+    percentile_cont(0.5) WITHIN GROUP (ORDER BY extract(epoch FROM first_response_ts - start_ts)) AS p50_seconds_to_first_response
+FROM github_issues
+GROUP BY repo_name, month
+"""
+
+METRICS_SETUP_SQL = f"""
+DO $$ BEGIN
+    IF to_regclass('{METRICS_VIEW}') IS NULL THEN
+        BEGIN
+            CREATE MATERIALIZED VIEW {METRICS_VIEW}
+            WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+            {METRICS_SELECT_SQL}
+            WITH NO DATA;
+            PERFORM add_continuous_aggregate_policy(
+                '{METRICS_VIEW}',
+                start_offset => NULL,
+                end_offset => INTERVAL '1 hour',
+                schedule_interval => INTERVAL '1 hour'
+            );
+        EXCEPTION WHEN OTHERS THEN
+            CREATE MATERIALIZED VIEW {METRICS_VIEW} AS
+            {METRICS_SELECT_SQL}
+            WITH NO DATA;
+        END;
+    END IF;
+END $$;
+CREATE INDEX IF NOT EXISTS {METRICS_VIEW}_repo_name_month_idx ON {METRICS_VIEW} (repo_name, month);
+"""
+
+# The view buckets by the month an issue was opened, so its closed count is how
+# many of that month's issues are closed by now. Closures are counted again by
+# the month they happened, which open_backlog (issues open at the end of the
+# month) needs; end_ts isn't the hypertable's time column, so that half can't
+# be a continuous aggregate and runs over the repo's issues instead. The window
+# runs over the repo's whole history before the time range is applied.
+ISSUE_METRICS_SQL = """
+WITH cohorts AS (
+    SELECT *
+    FROM {view}
+    WHERE repo_name = %(repo_name)s
+), closures AS (
+    SELECT time_bucket(INTERVAL '1 month', end_ts) AS month, count(*) AS closed
+    FROM github_issues
+    WHERE repo_name = %(repo_name)s AND end_ts IS NOT NULL
+    GROUP BY 1
+)
+SELECT *
+FROM (
+    SELECT
+        month,
+        coalesce(cohorts.opened, 0) AS opened,
+        coalesce(closures.closed, 0) AS closed,
+        coalesce(cohorts.opened - cohorts.closed, 0) AS still_open,
+        (sum(coalesce(cohorts.opened, 0) - coalesce(closures.closed, 0)) OVER (ORDER BY month))::bigint AS open_backlog,
+        avg_seconds_to_close / 86400 AS avg_days_to_close,
+        p50_seconds_to_close / 86400 AS p50_days_to_close,
+        p90_seconds_to_close / 86400 AS p90_days_to_close,
+        coalesce(responded, 0) AS responded,
+        avg_seconds_to_first_response / 3600 AS avg_hours_to_first_response,
+        p50_seconds_to_first_response / 3600 AS p50_hours_to_first_response
+    FROM cohorts
+    FULL JOIN closures USING (month)
+) monthly
+WHERE true{time_range}
+ORDER BY month
+"""
+
+
+async def refresh_issue_metrics(pool):
+    # CALL can't run inside a transaction, so this runs on its own after loading
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            "SELECT 1 FROM timescaledb_information.continuous_aggregates WHERE view_name = %s",
+            (METRICS_VIEW,),
+        )
+        if await cur.fetchone():
+            await conn.execute(f"CALL refresh_continuous_aggregate('{METRICS_VIEW}', NULL, NULL)")
+        else:
+            await conn.execute(f"REFRESH MATERIALIZED VIEW {METRICS_VIEW}")
+
+
+async def issue_metrics(
+    pool,
+    repo_name: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> list[dict]:
+    # A bounded range keeps every month it overlaps
+    conditions, params = [], {"repo_name": repo_name}
+    if start is not None:
+        conditions.append(sql.SQL(" AND month >= date_trunc('month', %(start)s::timestamptz)"))
+        params["start"] = start
+    if end is not None:
+        conditions.append(sql.SQL(" AND month < %(end)s"))
+        params["end"] = end
+    query = sql.SQL(ISSUE_METRICS_SQL).format(
+        view=sql.Identifier(METRICS_VIEW), time_range=sql.Composed(conditions)
+    )
+
+    async with pool.connection() as conn:
+        cur = await conn.execute(query, params, prepare=PREPARE_STATEMENTS)
+        return await cur.fetchall()
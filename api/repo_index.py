@@ -0,0 +1,201 @@
+from functools import lru_cache
+from psycopg import errors
+from rapidfuzz import fuzz, process, utils
+from typing import Optional, Union
+import numpy as np
+import os
+import re
+import time
+
+
+# Repos ingest loads when none are given; the API reads the catalog of what
+# was actually loaded from the database
+DEFAULT_REPOS = [
+    "rust-lang/rust",
+    "kubernetes/kubernetes",
+    "apache/spark",
+    "golang/go",
+    "tensorflow/tensorflow",
+    "MicrosoftDocs/azure-docs",
+    "pytorch/pytorch",
+    "Microsoft/TypeScript",
+    "python/cpython",
+    "facebook/react",
+    "django/django",
+    "rails/rails",
+    "bitcoin/bitcoin",
+    "nodejs/node",
+    "ocaml/opam-repository",
+    "apache/airflow",
+    "scipy/scipy",
+    "vercel/next.js",
+]
+
+# Other names people use for a repo, matched like the repo name itself
+REPO_ALIASES = {
+    "kubernetes/kubernetes": ["k8s", "kube", "kubectl"],
+    "golang/go": ["golang"],
+    "tensorflow/tensorflow": ["tf", "keras"],
+    "MicrosoftDocs/azure-docs": ["azure"],
+    "pytorch/pytorch": ["torch"],
+    "Microsoft/TypeScript": ["ts", "tsc"],
+    "python/cpython": ["python"],
+    "facebook/react": ["reactjs"],
+    "rails/rails": ["ruby on rails", "ror"],
+    "nodejs/node": ["nodejs", "node.js"],
+    "ocaml/opam-repository": ["opam", "ocaml"],
+    "apache/spark": ["pyspark"],
+    "vercel/next.js": ["nextjs"],
+    "rust-lang/rust": ["rustc", "cargo"],
+}
+
+# Repo names and aliases that are also everyday words ("bugs go unfixed",
+# "node pools"), so a question using one may not mean the repo at all
+COMMON_NAMES = {"go", "react", "node", "python", "ts", "rust", "spark", "rails", "torch", "cargo", "tf"}
+
+# Same cut-off find_closest_repo has always used on fuzzywuzzy's 0-100 score.
+# rapidfuzz's WRatio is the same scorer without the rounding, so scores are
+# rounded before comparing.
+MATCH_THRESHOLD = 80
+# Repos sharing the most trigrams with a name that get the full fuzzy score
+FUZZY_CANDIDATES = 32
+# The catalog is re-read from the database this often, picking up new repos
+REPO_CATALOG_TTL = float(os.getenv("REPO_CATALOG_TTL", "300"))
+
+WORD_PATTERN = re.compile(r"[a-z0-9][a-z0-9_.+#/-]*")
+
+
+def trigrams(text: str) -> set[str]:
+    # Padded like pg_trgm, so names shorter than three characters still have some
+    text = f"  {text} "
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+class RepoIndex:
+    """
+    Lookup structure over a catalog of 'owner/repo' names, built once. A
+    full name, bare repo name or alias resolves with a dict lookup; anything
+    else is fuzzy-scored against only the repos that share the most trigrams
+    with it, so lookups cost the same for 18 repos or 10k.
+    """
+
+    def __init__(
+        self,
+        repos: list[str],
+        aliases: dict[str, list[str]] = REPO_ALIASES,
+        common_names: set[str] = COMMON_NAMES,
+    ):
+        self.repos = list(dict.fromkeys(repos))
+        self.common_names = common_names
+        # normalized name -> repos answering to it; a bare name like "docs"
+        # can belong to several owners
+        self.names: dict[str, list[str]] = {}
+        for repo in self.repos:
+            name = repo.lower().split("/")[-1]
+            for key in [repo.lower(), name, *aliases.get(repo, [])]:
+                if repo not in self.names.setdefault(key, []):
+                    self.names[key].append(repo)
+        self.max_name_words = max((len(key.split()) for key in self.names), default=1)
+        postings: dict[str, list[int]] = {}
+        for i, repo in enumerate(self.repos):
+            for trigram in trigrams(repo.lower()):
+                postings.setdefault(trigram, []).append(i)
+        self.trigrams = {
+            trigram: np.asarray(ids, dtype=np.int32) for trigram, ids in postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.repos)
+
+    def __iter__(self):
+        return iter(self.repos)
+
+    def candidates(self, text: str, limit: int = FUZZY_CANDIDATES) -> list[str]:
+        # Repos sharing the most trigrams with text, most shared first
+        postings = [self.trigrams[t] for t in trigrams(text.lower()) if t in self.trigrams]
+        if not postings:
+            return []
+        counts = np.bincount(np.concatenate(postings), minlength=len(self.repos))
+        top = np.flatnonzero(counts)
+        if len(top) > limit:
+            top = top[np.argpartition(-counts[top], limit - 1)[:limit]]
+        top = top[np.argsort(-counts[top], kind="stable")]
+        return [self.repos[i] for i in top]
+
+    def match(self, query: str) -> Optional[str]:
+        # The repo find_closest_repo picks: exact names first, then the best
+        # fuzzy score of at least MATCH_THRESHOLD
+        if not query:
+            return None
+        exact = self.names.get(query.strip().lower())
+        if exact and len(exact) == 1:
+            return exact[0]
+        candidates = list(dict.fromkeys([*(exact or []), *self.candidates(query)]))
+        if not candidates:
+            return None
+        best_match = process.extractOne(
+            query, candidates, scorer=fuzz.WRatio, processor=utils.default_process
+        )
+        return best_match[0] if best_match and round(best_match[1]) >= MATCH_THRESHOLD else None
+
+    def named(self, question: str, common: bool = True) -> list[str]:
+        # Repos a question names outright, by full name, repo name or alias,
+        # as whole words so "go" doesn't match "good". common=False leaves out
+        # names in common_names, which only 'owner/name' makes certain
+        words = [word.rstrip(".") for word in WORD_PATTERN.findall(question.lower())]
+        found = []
+        for n in range(1, self.max_name_words + 1):
+            for i in range(len(words) - n + 1):
+                name = " ".join(words[i : i + n])
+                if not common and name in self.common_names:
+                    continue
+                for repo in self.names.get(name, ()):
+                    if repo not in found:
+                        found.append(repo)
+        return found
+
+    def shortlist(self, text: str, limit: int = FUZZY_CANDIDATES) -> list[str]:
+        # Small catalogs are listed whole; big ones are cut down to the repos
+        # the text names or resembles, for prompts and error messages
+        if len(self.repos) <= limit:
+            return self.repos
+        return list(dict.fromkeys([*self.named(text), *self.candidates(text, limit)]))[:limit]
+
+
+@lru_cache(maxsize=16)
+def _index_for(repos: tuple[str, ...]) -> RepoIndex:
+    return RepoIndex(list(repos))
+
+
+def as_repo_index(repos: Union[RepoIndex, list[str]]) -> RepoIndex:
+    # Plain lists (tests, benchmarks, scripts) get an index built once per list
+    return repos if isinstance(repos, RepoIndex) else _index_for(tuple(repos))
+
+
+async def load_repo_catalog(pool) -> list[str]:
+    # repo_ingest_stamps has a row per loaded repo; databases loaded before it
+    # existed fall back to scanning github_issues
+    async with pool.connection() as conn:
+        try:
+            cur = await conn.execute("SELECT repo_name FROM repo_ingest_stamps ORDER BY repo_name")
+            repos = [row["repo_name"] for row in await cur.fetchall()]
+        except errors.UndefinedTable:
+            repos = []
+        if not repos:
+            cur = await conn.execute(
+                "SELECT DISTINCT repo_name FROM github_issues ORDER BY repo_name"
+            )
+            repos = [row["repo_name"] for row in await cur.fetchall()]
+    return repos
+
+
+_index: Optional[RepoIndex] = None
+_loaded_at = 0.0
+
+
+async def get_repo_index(backend) -> RepoIndex:
+    global _index, _loaded_at
+    if _index is None or time.monotonic() - _loaded_at > REPO_CATALOG_TTL:
+        _index = RepoIndex(await backend.repos())
+        _loaded_at = time.monotonic()
+    return _index
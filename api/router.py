@@ -0,0 +1,247 @@
+from asyncio import Lock, gather
+from datetime import datetime, timedelta, timezone
+from dateutil.relativedelta import relativedelta
+from embeddings import embed_query
+from pydantic import BaseModel
+from repo_index import REPO_ALIASES, RepoIndex, as_repo_index
+from typing import Awaitable, Callable, Optional, Union
+import numpy as np
+import os
+import re
+
+
+# A route is taken only when the best intent beats the runner-up by
+# ROUTER_INTENT_MARGIN cosine similarity, and a repo the question doesn't name
+# is taken only when the best repo beats the runner-up by ROUTER_REPO_MARGIN.
+# Anything closer goes to the tool-selection LLM.
+ROUTER_INTENT_MARGIN = float(os.getenv("ROUTER_INTENT_MARGIN", "0.04"))
+ROUTER_REPO_MARGIN = float(os.getenv("ROUTER_REPO_MARGIN", "0.05"))
+
+# Example questions per tool; a question takes the tool of its most similar
+# examples. Only tools whose arguments the router can fill in appear here, so
+# counts (which need keywords) always go to the LLM.
+INTENT_EXAMPLES = {
+    "SearchIssues": [
+        "Show me the issues about memory leaks in the scheduler",
+        "Find bug reports where the build crashes on Windows",
+        "Which issues report this exact error message?",
+        "Get the original issues about flaky tests",
+        "Are there any open issues about the new release breaking imports?",
+    ],
+    "SearchSummaries": [
+        "What are the main problems people face with networking?",
+        "Summarize the common complaints about performance",
+        "What were the big features implemented recently?",
+        "What trends or patterns do you see in issues about installation?",
+        "Give me an overview of what users struggle with in the docs",
+    ],
+    "CountIssues": [
+        "How many issues mention segfaults?",
+        "Count the issues that reference the deprecated API",
+        "What is the number of issues reporting timeouts?",
+    ],
+    "IssueMetrics": [
+        "What is the average time to close issues?",
+        "How long does it take for issues to get a first response?",
+        "How has the open issue backlog changed over time?",
+        "How many issues were opened and closed each month?",
+        "Has the issue response time improved or worsened?",
+    ],
+}
+ROUTABLE_INTENTS = {"SearchIssues", "SearchSummaries", "IssueMetrics"}
+
+RELATIVE_RANGE = re.compile(
+    r"\b(?:last|past|previous)\s+(?:(\d+|a|one|two|three|six|twelve)\s+)?"
+    r"(day|week|month|quarter|year)s?\b"
+)
+SINCE_YEAR = re.compile(r"\b(?:since|after)\s+((?:19|20)\d\d)\b")
+IN_YEAR = re.compile(r"\bin\s+((?:19|20)\d\d)\b")
+THIS_PERIOD = re.compile(r"\bthis\s+(week|month|year)\b")
+# Words that put a time bound on a question; one the patterns above can't
+# turn into a range sends the question to the LLM
+TIME_WORDS = re.compile(
+    r"\b(?:since|before|after|between|until|ago|recent|recently|lately|yesterday|today|"
+    r"last|past|previous|(?:19|20)\d\d|january|february|march|april|june|july|"
+    r"august|september|october|november|december|q[1-4])\b"
+)
+NUMBER_WORDS = {"a": 1, "one": 1, "two": 2, "three": 3, "six": 6, "twelve": 12}
+UNITS = {
+    "day": relativedelta(days=1),
+    "week": relativedelta(weeks=1),
+    "month": relativedelta(months=1),
+    "quarter": relativedelta(months=3),
+    "year": relativedelta(years=1),
+}
+
+
+class Route(BaseModel):
+    tool: str
+    repo: str
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+    confidence: float
+
+
+def parse_time_range(
+    question: str, now: Optional[datetime] = None
+) -> Optional[tuple[Optional[datetime], Optional[datetime]]]:
+    """
+    (start, end) for the time range a question gives, (None, None) when it
+    gives none, and None when it mentions one this can't read.
+    """
+    now = now or datetime.now(timezone.utc)
+    question = question.lower()
+    if match := RELATIVE_RANGE.search(question):
+        count = match.group(1) or "1"
+        count = NUMBER_WORDS[count] if count in NUMBER_WORDS else int(count)
+        return now - UNITS[match.group(2)] * count, None
+    if match := THIS_PERIOD.search(question):
+        unit = match.group(1)
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        if unit == "week":
+            start -= timedelta(days=start.weekday())
+        elif unit == "month":
+            start = start.replace(day=1)
+        else:
+            start = start.replace(month=1, day=1)
+        return start, None
+    if match := SINCE_YEAR.search(question):
+        return datetime(int(match.group(1)), 1, 1, tzinfo=timezone.utc), None
+    if match := IN_YEAR.search(question):
+        year = int(match.group(1))
+        return (
+            datetime(year, 1, 1, tzinfo=timezone.utc),
+            datetime(year + 1, 1, 1, tzinfo=timezone.utc),
+        )
+    if TIME_WORDS.search(question):
+        return None
+    return None, None
+
+
+class Router:
+    """
+    Picks the tool and repo for a question without an LLM call, from the
+    question's embedding (already computed for the answer cache) against
+    embeddings of INTENT_EXAMPLES and of each repo's name and aliases. route() returns
+    None whenever it isn't confident, and the caller asks the LLM instead.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[str], Awaitable[list[float]]] = embed_query,
+        intent_margin: float = ROUTER_INTENT_MARGIN,
+        repo_margin: float = ROUTER_REPO_MARGIN,
+    ):
+        self.embed = embed
+        self.intent_margin = intent_margin
+        self.repo_margin = repo_margin
+        self.routed = 0
+        self.fallbacks: dict[str, int] = {}
+        self._intents: Optional[list[str]] = None
+        self._examples: Optional[np.ndarray] = None
+        self._repos: dict[str, np.ndarray] = {}
+        # stacked self._repos rows for the catalog last routed against
+        self._catalog: Optional[RepoIndex] = None
+        self._repo_matrix: Optional[np.ndarray] = None
+        self._lock: Optional[Lock] = None
+
+    async def _embed_all(self, texts: list[str]) -> np.ndarray:
+        # concurrent embed_query calls go out as one batched request
+        vectors = np.asarray(await gather(*(self.embed(text) for text in texts)), dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    async def _prepare(self, repos: RepoIndex):
+        if self._lock is None:
+            # created lazily so it binds to the running loop (Python 3.9)
+            self._lock = Lock()
+        async with self._lock:
+            if self._examples is None:
+                self._intents = [
+                    intent for intent, examples in INTENT_EXAMPLES.items() for _ in examples
+                ]
+                self._examples = await self._embed_all(
+                    [example for examples in INTENT_EXAMPLES.values() for example in examples]
+                )
+            if self._catalog is not repos:
+                missing = [repo for repo in repos if repo not in self._repos]
+                if missing:
+                    vectors = await self._embed_all(
+                        [" ".join([repo, *REPO_ALIASES.get(repo, [])]) for repo in missing]
+                    )
+                    self._repos.update(zip(missing, vectors))
+                self._repo_matrix = np.stack([self._repos[repo] for repo in repos])
+                self._catalog = repos
+
+    def _fallback(self, reason: str) -> None:
+        self.fallbacks[reason] = self.fallbacks.get(reason, 0) + 1
+        return None
+
+    def classify(self, query: np.ndarray) -> tuple[str, float]:
+        # Best intent and its margin over the runner-up intent
+        similarities = self._examples @ query
+        best: dict[str, float] = {}
+        for intent, similarity in zip(self._intents, similarities):
+            best[intent] = max(best.get(intent, -1.0), float(similarity))
+        ranked = sorted(best.items(), key=lambda item: -item[1])
+        return ranked[0][0], ranked[0][1] - ranked[1][1]
+
+    def resolve_repo(
+        self, question: str, query: np.ndarray, repos: RepoIndex
+    ) -> tuple[Optional[str], float]:
+        # A name that is also an everyday word isn't proof; without a
+        # distinctive name the repo embeddings have to agree on it
+        named = repos.named(question, common=False)
+        if len(named) == 1:
+            return named[0], 1.0
+        if len(named) > 1:
+            # comparisons across repos are the LLM's job
+            return None, 0.0
+        similarities = self._repo_matrix @ query
+        if len(similarities) < 2:
+            return repos.repos[0], 1.0
+        best, second = np.argpartition(-similarities, 1)[:2]
+        return repos.repos[best], float(similarities[best] - similarities[second])
+
+    async def route(
+        self, question: str, embedding: list[float], repos: Union[RepoIndex, list[str]]
+    ) -> Optional[Route]:
+        repos = as_repo_index(repos)
+        if not repos:
+            return self._fallback("repo_confidence")
+        await self._prepare(repos)
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / np.linalg.norm(query)
+
+        intent, intent_confidence = self.classify(query)
+        if intent not in ROUTABLE_INTENTS:
+            return self._fallback("intent")
+        if intent_confidence < self.intent_margin:
+            return self._fallback("intent_confidence")
+        repo, repo_confidence = self.resolve_repo(question, query, repos)
+        if repo is None or (repo_confidence < 1.0 and repo_confidence < self.repo_margin):
+            return self._fallback("repo_confidence")
+        time_range = parse_time_range(question)
+        if time_range is None:
+            return self._fallback("time_range")
+
+        self.routed += 1
+        return Route(
+            tool=intent,
+            repo=repo,
+            start=time_range[0],
+            end=time_range[1],
+            confidence=min(intent_confidence, repo_confidence),
+        )
+
+    def stats(self) -> dict:
+        fallbacks = sum(self.fallbacks.values())
+        total = self.routed + fallbacks
+        return {
+            "routed": self.routed,
+            "fallbacks": fallbacks,
+            "fallback_reasons": dict(self.fallbacks),
+            "routed_rate": self.routed / total if total else 0.0,
+        }
+
+
+router = Router()
@@ -0,0 +1,626 @@
+from pgvector.psycopg import Vector
+from psycopg import sql
+from psycopg.rows import args_row
+from db import PREPARE_STATEMENTS, get_pool
+from metrics import issue_metrics
+from repo_index import load_repo_catalog
+from singleflight import SingleFlight
+from array import array
+from datetime import datetime
+from typing import Literal, NamedTuple, Optional, Protocol
+import hashlib
+import os
+
+
+# opclass for the HNSW index and the operator that can use it
+DISTANCE_METRICS = {
+    "cosine": ("vector_cosine_ops", "<=>"),
+    "l2": ("vector_l2_ops", "<->"),
+    "inner_product": ("vector_ip_ops", "<#>"),
+}
+
+# setup_db builds each table's index from this, so index and queries can't drift
+TABLE_METRICS = {
+    "github_issues": "cosine",
+    "github_issue_summaries": "cosine",
+}
+
+# Table-wide HNSW indexes from before they were per repo; setup_db drops them
+HNSW_INDEXES = {
+    "github_issues": "github_issue_embedding_idx",
+    "github_issue_summaries": "github_issue_summaries_embedding_idx",
+}
+
+# GIN over (repo_name, tsvector) via btree_gin, so a repo's keyword matches and
+# counts come straight from the index. Queries must use TEXT_SEARCH_VECTOR
+# verbatim for the planner to match the index expression.
+TEXT_INDEXES = {
+    "github_issues": "github_issues_text_search_idx",
+    "github_issue_summaries": "github_issue_summaries_text_search_idx",
+}
+TEXT_SEARCH_CONFIG = "english"
+TEXT_SEARCH_VECTOR = f"to_tsvector('{TEXT_SEARCH_CONFIG}', text)"
+
+# Reciprocal-rank fusion: score = sum over rankings of 1 / (RRF_K + rank),
+# each ranking cut to HYBRID_CANDIDATES rows
+RRF_K = 60
+HYBRID_CANDIDATES = 40
+
+IterativeScan = Literal["off", "strict_order", "relaxed_order"]
+
+# What the HNSW indexes are built on. "full" indexes the float32 embedding
+# column; "halfvec" and "binary" index a half-precision or binary-quantized
+# expression of it, a half or about a thirtieth of the size. The table keeps
+# the float32 vectors, so compact searches fetch RERANK_FACTOR times as many
+# candidates from the index and re-rank them by their exact distance.
+VectorStorage = Literal["full", "halfvec", "binary"]
+VECTOR_STORAGE: VectorStorage = os.getenv("VECTOR_STORAGE", "full")
+RERANK_FACTOR = int(os.getenv("VECTOR_RERANK_FACTOR", "4"))
+EMBEDDING_DIMENSIONS = 1536
+
+# The columns a search returns, in SearchHit's order. Embeddings and issue
+# metadata stay in the database; issues have no label.
+HIT_COLUMNS = {
+    "github_issues": "issue_id, repo_name, text, NULL::text AS label, start_ts, end_ts",
+    "github_issue_summaries": "issue_id, repo_name, text, label::text, start_ts, end_ts",
+}
+HIT_FIELDS = "issue_id, repo_name, text, label, start_ts, end_ts"
+
+# "postgres" searches Supabase; "local" searches the in-process index built by
+# local_index.py under LOCAL_INDEX_PATH
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "postgres")
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "local_index")
+
+# Query text is fixed per table so each pooled connection prepares it once and
+# every later search only sends Bind/Execute with the vector in binary.
+VECTOR_SEARCH_SQL = """
+SELECT {columns}, embedding {operator} %(embedding)b AS distance
+FROM {table_name}
+WHERE repo_name = %(repo_name)s{time_range}
+ORDER BY embedding {operator} %(embedding)b
+LIMIT %(limit)s
+"""
+
+# The inner query walks the compact index, the outer one re-ranks its
+# candidates with the float32 embeddings
+RERANK_SEARCH_SQL = """
+SELECT {fields}, embedding {operator} %(embedding)b AS distance
+FROM (
+    SELECT {columns}, embedding
+    FROM {table_name}
+    WHERE repo_name = %(repo_name)s{time_range}
+    ORDER BY {coarse_distance}
+    LIMIT %(rerank_candidates)s
+) candidates
+ORDER BY distance
+LIMIT %(limit)s
+"""
+
+REPO_SCAN_SQL = """
+SELECT {columns}, NULL::float8 AS distance
+FROM {table_name}
+WHERE repo_name = %(repo_name)s{time_range}
+LIMIT %(limit)s
+"""
+
+
+# Both rankings are computed per repo, fused on issue_id, and only the winning
+# rows are read back in full
+HYBRID_SEARCH_SQL = """
+WITH vector_matches AS (
+    SELECT issue_id, row_number() OVER (ORDER BY distance) AS rank
+    FROM (
+        SELECT issue_id, embedding {operator} %(embedding)b AS distance
+        FROM {nearest}
+        ORDER BY distance
+        LIMIT %(candidates)s
+    ) nearest
+),
+text_matches AS (
+    SELECT issue_id, row_number() OVER (ORDER BY text_rank DESC) AS rank
+    FROM (
+        SELECT issue_id, ts_rank_cd({text_vector}, query) AS text_rank
+        FROM {table_name}, websearch_to_tsquery({config}, %(keywords)s) query
+        WHERE repo_name = %(repo_name)s{time_range} AND {text_vector} @@ query
+        ORDER BY text_rank DESC
+        LIMIT %(candidates)s
+    ) matched
+),
+fused AS (
+    SELECT issue_id, sum(1.0 / (%(rrf_k)s + rank)) AS score
+    FROM (SELECT * FROM vector_matches UNION ALL SELECT * FROM text_matches) ranked
+    GROUP BY issue_id
+)
+SELECT {columns}, embedding {operator} %(embedding)b AS distance
+FROM fused JOIN {table_name} USING (issue_id)
+WHERE repo_name = %(repo_name)s{time_range}
+ORDER BY fused.score DESC
+LIMIT %(limit)s
+"""
+
+KEYWORD_SEARCH_SQL = """
+SELECT {columns}, NULL::float8 AS distance
+FROM {table_name}, websearch_to_tsquery({config}, %(keywords)s) query
+WHERE repo_name = %(repo_name)s{time_range} AND {text_vector} @@ query
+ORDER BY ts_rank_cd({text_vector}, query) DESC
+LIMIT %(limit)s
+"""
+
+KEYWORD_COUNT_SQL = """
+SELECT count(*) AS count
+FROM {table_name}
+WHERE repo_name = %(repo_name)s{time_range}
+  AND {text_vector} @@ websearch_to_tsquery({config}, %(keywords)s)
+"""
+
+
+class SearchHit(NamedTuple):
+    """
+    One search result. distance is the cosine distance to the query
+    embedding, None for searches without one.
+    """
+
+    issue_id: int
+    repo_name: str
+    text: Optional[str]
+    label: Optional[str]
+    start_ts: Optional[datetime]
+    end_ts: Optional[datetime]
+    distance: Optional[float]
+
+
+def vector_index_expression(table_name: str, storage: VectorStorage) -> tuple[str, str, str]:
+    # (indexed expression, its opclass, the distance a search orders by). The
+    # search has to repeat the indexed expression verbatim to use the index.
+    opclass, operator = DISTANCE_METRICS[TABLE_METRICS[table_name]]
+    if storage == "halfvec":
+        cast = f"::halfvec({EMBEDDING_DIMENSIONS})"
+        return (
+            f"(embedding{cast})",
+            opclass.replace("vector_", "halfvec_"),
+            f"embedding{cast} {operator} %(embedding)b{cast}",
+        )
+    if storage == "binary":
+        # Hamming distance between sign bits; it only orders candidates
+        expression = f"binary_quantize(embedding)::bit({EMBEDDING_DIMENSIONS})"
+        return (
+            f"({expression})",
+            "bit_hamming_ops",
+            f"{expression} <~> binary_quantize(%(embedding)b)",
+        )
+    return "embedding", opclass, f"embedding {operator} %(embedding)b"
+
+
+def repo_hnsw_index_name(
+    table_name: str, repo_name: str, storage: VectorStorage = VECTOR_STORAGE
+) -> str:
+    # Hashed so any repo name fits in Postgres' 63 character identifiers, also
+    # inside Timescale's "<chunk>_<index>" per-chunk names
+    digest = hashlib.sha256(repo_name.encode()).hexdigest()[:12]
+    suffix = {"full": "", "halfvec": "h", "binary": "b"}[storage]
+    return f"{table_name}_hnsw{suffix}_{digest}"
+
+
+def hnsw_index_sql(
+    table_name: str, repo_name: str, storage: VectorStorage = VECTOR_STORAGE
+) -> sql.Composed:
+    # A partial index per repo: a search with repo_name = '<repo>' walks a
+    # graph of that repo's rows only, instead of post-filtering a global one
+    expression, opclass, _ = vector_index_expression(table_name, storage)
+    return sql.SQL(
+        "CREATE INDEX IF NOT EXISTS {} ON {} USING hnsw ({} {}) WHERE repo_name = {}"
+    ).format(
+        sql.Identifier(repo_hnsw_index_name(table_name, repo_name, storage)),
+        sql.Identifier(table_name),
+        sql.SQL(expression),
+        sql.SQL(opclass),
+        sql.Literal(repo_name),
+    )
+
+
+def rerank_candidates(limit: int, storage: VectorStorage) -> dict:
+    # Extra parameter compact searches need; empty for full storage
+    return {} if storage == "full" else {"rerank_candidates": limit * RERANK_FACTOR}
+
+
+def text_index_sql(table_name: str) -> str:
+    return f"""
+    CREATE INDEX IF NOT EXISTS {TEXT_INDEXES[table_name]}
+    ON {table_name}
+    USING gin (repo_name, {TEXT_SEARCH_VECTOR});
+    """
+
+
+def time_range_filter(start: Optional[datetime], end: Optional[datetime]) -> sql.Composed:
+    # Bounds stay parameters so the statement can be prepared; each combination
+    # of bounds is its own statement, and Timescale excludes chunks from the
+    # parameter values at execution time
+    conditions = []
+    if start is not None:
+        conditions.append(sql.SQL(" AND start_ts >= %(start)s"))
+    if end is not None:
+        conditions.append(sql.SQL(" AND start_ts < %(end)s"))
+    return sql.Composed(conditions)
+
+
+def time_range_params(start: Optional[datetime], end: Optional[datetime]) -> dict:
+    return {
+        name: value for name, value in [("start", start), ("end", end)] if value is not None
+    }
+
+
+def nearest_rows(
+    table_name: str,
+    storage: VectorStorage,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> sql.Composed:
+    # The rows hybrid search ranks by exact distance: the whole repo, whose
+    # ORDER BY ... LIMIT walks the full index, or the compact index's
+    # candidates
+    time_range = time_range_filter(start, end)
+    if storage == "full":
+        return sql.SQL("{} WHERE repo_name = %(repo_name)s{}").format(
+            sql.Identifier(table_name), time_range
+        )
+    _, _, coarse_distance = vector_index_expression(table_name, storage)
+    return sql.SQL(
+        "(SELECT issue_id, embedding FROM {} WHERE repo_name = %(repo_name)s{}"
+        " ORDER BY {} LIMIT %(rerank_candidates)s) candidates"
+    ).format(sql.Identifier(table_name), time_range, sql.SQL(coarse_distance))
+
+
+def text_search_query(
+    template: str,
+    table_name: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    storage: VectorStorage = VECTOR_STORAGE,
+) -> sql.Composed:
+    _, operator = DISTANCE_METRICS[TABLE_METRICS[table_name]]
+    return sql.SQL(template).format(
+        table_name=sql.Identifier(table_name),
+        columns=sql.SQL(HIT_COLUMNS[table_name]),
+        operator=sql.SQL(operator),
+        text_vector=sql.SQL(TEXT_SEARCH_VECTOR),
+        config=sql.Literal(TEXT_SEARCH_CONFIG),
+        time_range=time_range_filter(start, end),
+        nearest=nearest_rows(table_name, storage, start, end),
+    )
+
+
+def search_query(
+    table_name: str,
+    with_embedding: bool,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    storage: VectorStorage = VECTOR_STORAGE,
+) -> sql.Composed:
+    time_range = time_range_filter(start, end)
+    columns = sql.SQL(HIT_COLUMNS[table_name])
+    if not with_embedding:
+        return sql.SQL(REPO_SCAN_SQL).format(
+            table_name=sql.Identifier(table_name), columns=columns, time_range=time_range
+        )
+
+    _, operator = DISTANCE_METRICS[TABLE_METRICS[table_name]]
+    if storage == "full":
+        return sql.SQL(VECTOR_SEARCH_SQL).format(
+            table_name=sql.Identifier(table_name),
+            columns=columns,
+            operator=sql.SQL(operator),
+            time_range=time_range,
+        )
+    _, _, coarse_distance = vector_index_expression(table_name, storage)
+    return sql.SQL(RERANK_SEARCH_SQL).format(
+        table_name=sql.Identifier(table_name),
+        columns=columns,
+        fields=sql.SQL(HIT_FIELDS),
+        operator=sql.SQL(operator),
+        coarse_distance=sql.SQL(coarse_distance),
+        time_range=time_range,
+    )
+
+
+async def apply_search_settings(
+    conn, ef_search: Optional[int], iterative_scan: Optional[IterativeScan]
+):
+    # set_config(..., true) is the parameterizable form of SET LOCAL, so the
+    # settings only last for the surrounding transaction
+    settings = []
+    if ef_search is not None:
+        settings.append(("hnsw.ef_search", str(ef_search)))
+    if iterative_scan is not None:
+        settings.append(("hnsw.iterative_scan", iterative_scan))
+    if not settings:
+        return
+
+    query = sql.SQL("SELECT {}").format(
+        sql.SQL(", ").join(
+            sql.SQL("set_config({}, {}, true)").format(name, value)
+            for name, value in settings
+        )
+    )
+    await conn.execute(query)
+
+
+async def vector_search(
+    pool,
+    table_name: str,
+    repo_name: str,
+    embedding: Optional[list[float]],
+    limit: int,
+    ef_search: Optional[int] = None,
+    iterative_scan: Optional[IterativeScan] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    storage: VectorStorage = VECTOR_STORAGE,
+):
+    params = {"repo_name": repo_name, "limit": limit, **time_range_params(start, end)}
+    if embedding is not None:
+        params["embedding"] = Vector(embedding)
+        params.update(rerank_candidates(limit, storage))
+
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            await apply_search_settings(conn, ef_search, iterative_scan)
+            cur = conn.cursor(row_factory=args_row(SearchHit))
+            await cur.execute(
+                search_query(table_name, embedding is not None, start, end, storage),
+                params,
+                prepare=PREPARE_STATEMENTS,
+            )
+            return await cur.fetchall()
+
+
+class SearchBackend(Protocol):
+    async def search(
+        self,
+        table_name: str,
+        repo_name: str,
+        embedding: Optional[list[float]],
+        limit: int,
+        ef_search: Optional[int] = None,
+        iterative_scan: Optional[IterativeScan] = None,
+        keywords: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> list[SearchHit]: ...
+
+    async def count(
+        self,
+        table_name: str,
+        repo_name: str,
+        keywords: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> int: ...
+
+    async def metrics(
+        self,
+        repo_name: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> list[dict]: ...
+
+    async def repos(self) -> list[str]: ...
+
+
+# Identical searches running at the same time (the same question asked by
+# several users at once) share one query
+search_flights = SingleFlight()
+
+
+class PostgresSearch:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def search(
+        self,
+        table_name: str,
+        repo_name: str,
+        embedding: Optional[list[float]],
+        limit: int,
+        ef_search: Optional[int] = None,
+        iterative_scan: Optional[IterativeScan] = None,
+        keywords: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> list[SearchHit]:
+        key = (
+            "search",
+            table_name,
+            repo_name,
+            None if embedding is None else array("f", embedding).tobytes(),
+            limit,
+            ef_search,
+            iterative_scan,
+            keywords,
+            start,
+            end,
+        )
+        if keywords:
+            return await search_flights.do(
+                key,
+                lambda: hybrid_search(
+                    self.pool,
+                    table_name,
+                    repo_name,
+                    embedding,
+                    keywords,
+                    limit,
+                    ef_search,
+                    iterative_scan,
+                    start,
+                    end,
+                ),
+            )
+        return await search_flights.do(
+            key,
+            lambda: vector_search(
+                self.pool,
+                table_name,
+                repo_name,
+                embedding,
+                limit,
+                ef_search,
+                iterative_scan,
+                start,
+                end,
+            ),
+        )
+
+    async def count(
+        self,
+        table_name: str,
+        repo_name: str,
+        keywords: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> int:
+        return await search_flights.do(
+            ("count", table_name, repo_name, keywords, start, end),
+            lambda: keyword_count(self.pool, table_name, repo_name, keywords, start, end),
+        )
+
+    async def metrics(
+        self,
+        repo_name: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> list[dict]:
+        return await search_flights.do(
+            ("metrics", repo_name, start, end),
+            lambda: issue_metrics(self.pool, repo_name, start, end),
+        )
+
+    async def repos(self) -> list[str]:
+        return await load_repo_catalog(self.pool)
+
+
+_backend: Optional[SearchBackend] = None
+
+
+async def get_search_backend() -> SearchBackend:
+    global _backend
+    if _backend is None:
+        if SEARCH_BACKEND == "local":
+            from local_index import LocalSearch
+
+            _backend = LocalSearch(LOCAL_INDEX_PATH)
+        elif SEARCH_BACKEND == "postgres":
+            _backend = PostgresSearch(await get_pool())
+        else:
+            raise ValueError(f"Unknown SEARCH_BACKEND {SEARCH_BACKEND!r}")
+    return _backend
+
+
+async def hybrid_search(
+    pool,
+    table_name: str,
+    repo_name: str,
+    embedding: Optional[list[float]],
+    keywords: str,
+    limit: int,
+    ef_search: Optional[int] = None,
+    iterative_scan: Optional[IterativeScan] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    storage: VectorStorage = VECTOR_STORAGE,
+):
+    # Without an embedding only the keyword ranking applies
+    params = {
+        "repo_name": repo_name,
+        "keywords": keywords,
+        "limit": limit,
+        **time_range_params(start, end),
+    }
+    template = KEYWORD_SEARCH_SQL
+    if embedding is not None:
+        params["embedding"] = Vector(embedding)
+        params["candidates"] = max(HYBRID_CANDIDATES, limit)
+        params["rrf_k"] = RRF_K
+        params.update(rerank_candidates(params["candidates"], storage))
+        template = HYBRID_SEARCH_SQL
+
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            await apply_search_settings(conn, ef_search, iterative_scan)
+            cur = conn.cursor(row_factory=args_row(SearchHit))
+            await cur.execute(
+                text_search_query(template, table_name, start, end, storage),
+                params,
+                prepare=PREPARE_STATEMENTS,
+            )
+            return await cur.fetchall()
+
+
+async def keyword_count(
+    pool,
+    table_name: str,
+    repo_name: str,
+    keywords: str,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+) -> int:
+    async with pool.connection() as conn:
+        cur = await conn.execute(
+            text_search_query(KEYWORD_COUNT_SQL, table_name, start, end),
+            {"repo_name": repo_name, "keywords": keywords, **time_range_params(start, end)},
+            prepare=PREPARE_STATEMENTS,
+        )
+        return (await cur.fetchone())["count"]
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], limit: int, k: int = RRF_K) -> list[int]:
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True)[:limit]
+
+
+def plan_index_names(plan: dict) -> set[str]:
+    names = set()
+    if "Index Name" in plan:
+        names.add(plan["Index Name"])
+    for child in plan.get("Plans", []):
+        names |= plan_index_names(child)
+    return names
+
+
+async def explain_search(
+    pool,
+    table_name: str,
+    repo_name: str,
+    embedding: list[float],
+    limit: int,
+    ef_search: Optional[int] = None,
+    iterative_scan: Optional[IterativeScan] = None,
+    storage: VectorStorage = VECTOR_STORAGE,
+) -> dict:
+    params = {
+        "repo_name": repo_name,
+        "limit": limit,
+        "embedding": Vector(embedding),
+        **rerank_candidates(limit, storage),
+    }
+    query = sql.SQL("EXPLAIN (FORMAT JSON) ") + search_query(
+        table_name, True, storage=storage
+    )
+
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            await apply_search_settings(conn, ef_search, iterative_scan)
+            cur = await conn.execute(query, params)
+            return (await cur.fetchone())["QUERY PLAN"][0]["Plan"]
+
+
+async def search_uses_index(
+    pool, table_name: str, repo_name: str, embedding, storage: VectorStorage = VECTOR_STORAGE
+) -> bool:
+    # True when the search walks its repo's partial index. Timescale names
+    # per-chunk indexes "<chunk>_<index name>", hence endswith.
+    plan = await explain_search(pool, table_name, repo_name, embedding, limit=10, storage=storage)
+    index_name = repo_hnsw_index_name(table_name, repo_name, storage)
+    return any(name.endswith(index_name) for name in plan_index_names(plan))
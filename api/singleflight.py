@@ -0,0 +1,106 @@
+from asyncio import Condition, Task, create_task, shield
+from typing import AsyncIterator, Awaitable, Callable, Hashable, Optional, TypeVar
+
+
+T = TypeVar("T")
+
+
+class _Broadcast:
+    # Everything one shared stream has produced so far, replayed to each
+    # subscriber from the start
+    def __init__(self):
+        self.events: list = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.condition = Condition()
+        self.task: Optional[Task] = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls. The first call for a key runs;
+    calls with the same key that arrive while it is in flight wait for its
+    result instead of repeating it. Nothing is kept once the call finishes,
+    remembering results is the caches' job. `calls` counts the calls that
+    ran and `shared` the ones that were saved.
+
+    The shared call runs as its own task, so a caller that is cancelled (a
+    client hanging up) doesn't cancel it for everyone else.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._tasks: dict[Hashable, Task] = {}
+        self._streams: dict[Hashable, _Broadcast] = {}
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        task = self._tasks.get(key)
+        if task is not None:
+            self.shared += 1
+            return await shield(task)
+
+        self.calls += 1
+        task = create_task(call())
+        self._tasks[key] = task
+        task.add_done_callback(lambda done: self._finish(key, done))
+        return await shield(task)
+
+    def _finish(self, key: Hashable, task: Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # marks the error retrieved even when every caller has gone
+            task.exception()
+
+    async def stream(
+        self, key: Hashable, events: Callable[[], AsyncIterator[T]]
+    ) -> AsyncIterator[T]:
+        # Like do() for an async generator: subscribers that join late get
+        # the events produced so far, then each new one as it arrives
+        broadcast = self._streams.get(key)
+        if broadcast is None:
+            self.calls += 1
+            broadcast = self._streams[key] = _Broadcast()
+            broadcast.task = create_task(self._pump(key, broadcast, events()))
+        else:
+            self.shared += 1
+
+        seen = 0
+        while True:
+            async with broadcast.condition:
+                await broadcast.condition.wait_for(
+                    lambda: len(broadcast.events) > seen or broadcast.done
+                )
+                pending = broadcast.events[seen:]
+                done, error = broadcast.done, broadcast.error
+            for event in pending:
+                yield event
+            seen += len(pending)
+            if done and seen == len(broadcast.events):
+                if error is not None:
+                    raise error
+                return
+
+    async def _pump(self, key: Hashable, broadcast: _Broadcast, events: AsyncIterator):
+        try:
+            async for event in events:
+                async with broadcast.condition:
+                    broadcast.events.append(event)
+                    broadcast.condition.notify_all()
+        except Exception as e:
+            broadcast.error = e
+        finally:
+            # later callers start a fresh stream
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+            async with broadcast.condition:
+                broadcast.done = True
+                broadcast.condition.notify_all()
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "shared": self.shared,
+            "in_flight": len(self._tasks) + len(self._streams),
+        }
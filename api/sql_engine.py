@@ -0,0 +1,186 @@
+from metrics import METRICS_VIEW
+from psycopg.rows import tuple_row
+from sqlglot import exp
+from sqlglot.optimizer.qualify import qualify
+from sqlglot.optimizer.scope import traverse_scope
+import os
+import pandas as pd
+import sqlglot
+
+
+# Generated SQL runs read-only, is cancelled after SQL_STATEMENT_TIMEOUT_MS and
+# returns at most SQL_ROW_LIMIT rows, fetched SQL_FETCH_ROWS at a time from a
+# server-side cursor.
+SQL_STATEMENT_TIMEOUT_MS = int(os.getenv("SQL_STATEMENT_TIMEOUT_MS", "5000"))
+SQL_ROW_LIMIT = int(os.getenv("SQL_ROW_LIMIT", "1000"))
+SQL_FETCH_ROWS = int(os.getenv("SQL_FETCH_ROWS", "500"))
+
+# The only tables and columns generated SQL may read. Embeddings are left out
+# on purpose; they're 1536 floats a row and useless to a text answer.
+ALLOWED_COLUMNS = {
+    "github_issues": [
+        "issue_id",
+        "metadata",
+        "text",
+        "repo_name",
+        "start_ts",
+        "end_ts",
+        "first_response_ts",
+    ],
+    "github_issue_summaries": ["issue_id", "text", "label", "repo_name", "start_ts", "end_ts"],
+    METRICS_VIEW: [
+        "repo_name",
+        "month",
+        "opened",
+        "closed",
+        "responded",
+        "avg_seconds_to_close",
+        "p50_seconds_to_close",
+        "p90_seconds_to_close",
+        "avg_seconds_to_first_response",
+        "p50_seconds_to_first_response",
+    ],
+}
+
+# The columns left out above. No output alias may take one of their names:
+# GROUP BY and window ORDER BY read a table column before an alias, so the
+# alias would name the hidden column there
+HIDDEN_COLUMNS = {"embedding", "content_hash"}
+
+ALLOWED_SCHEMA = {
+    table: {column: "text" for column in columns} for table, columns in ALLOWED_COLUMNS.items()
+}
+
+# Functions that reach outside the query (files, settings, other servers);
+# the read-only transaction and timeout cover everything else
+BLOCKED_FUNCTION_PREFIXES = ("pg_", "lo_", "dblink")
+BLOCKED_FUNCTIONS = {"set_config", "current_setting", "query_to_xml", "txid_current"}
+
+
+def schema_description() -> str:
+    return "; ".join(f"{table}({', '.join(columns)})" for table, columns in ALLOWED_COLUMNS.items())
+
+
+def validate_sql(query: str) -> str:
+    """
+    Checks that `query` is a single SELECT over the allowlisted tables and
+    columns and returns it normalized to PostgreSQL. Raises ValueError with a
+    message the model can act on otherwise.
+    """
+    try:
+        statements = [s for s in sqlglot.parse(query, read="postgres") if s is not None]
+    except sqlglot.errors.SqlglotError as e:
+        raise ValueError(f"Could not parse the SQL: {e}")
+    if len(statements) != 1:
+        raise ValueError("Write exactly one SQL statement")
+    tree = statements[0]
+    if not isinstance(tree, exp.Query):
+        raise ValueError("Only SELECT queries can be run")
+
+    for node in tree.walk():
+        if isinstance(node, (exp.DML, exp.DDL, exp.Command, exp.Into, exp.Lock)):
+            raise ValueError("Only SELECT queries can be run, without INTO or locking clauses")
+        if isinstance(node, exp.Star) and not isinstance(node.parent, exp.Count):
+            raise ValueError("Select the columns you need by name instead of *")
+        if isinstance(node, exp.Func):
+            name = (node.name if isinstance(node, exp.Anonymous) else node.sql_name()).lower()
+            if name.startswith(BLOCKED_FUNCTION_PREFIXES) or name in BLOCKED_FUNCTIONS:
+                raise ValueError(f"The function {name} is not allowed")
+
+    ctes = {cte.alias_or_name for cte in tree.find_all(exp.CTE)}
+    for table in tree.find_all(exp.Table):
+        if table.name in ctes and not table.db:
+            continue
+        if table.db not in ("", "public") or table.name not in ALLOWED_COLUMNS:
+            raise ValueError(
+                f"Unknown table {table.sql(dialect='postgres')}; "
+                f"the available tables are {schema_description()}"
+            )
+        alias = table.args.get("alias")
+        if alias is not None and alias.columns:
+            # t(a, b) renames the table's columns, hiding which ones are read
+            raise ValueError(f"Don't rename the columns of {table.name}")
+
+    for alias in tree.find_all(exp.Alias):
+        if alias.alias in HIDDEN_COLUMNS:
+            raise ValueError(f"{alias.alias} can't be used as an alias")
+
+    # An output alias is only a name in ORDER BY and GROUP BY; anywhere else
+    # Postgres reads the table column of that name, whatever the alias says
+    for select in tree.find_all(exp.Select):
+        aliases = {
+            e.alias
+            for e in select.expressions
+            if isinstance(e, exp.Alias)
+            and not (isinstance(e.this, exp.Column) and e.this.name == e.alias)
+        }
+        for column in select.find_all(exp.Column):
+            if (
+                column.name in aliases
+                and not column.table
+                and column.parent_select is select
+                and not column.find_ancestor(exp.Order, exp.Group)
+            ):
+                raise ValueError(
+                    f"{column.name} is an output alias; refer to the column it names instead"
+                )
+
+    # Resolves every column to the table, CTE or subquery it comes from, with
+    # only the allowlisted columns in the schema, so anything else is unknown
+    try:
+        qualified = qualify(
+            tree.copy(), schema=ALLOWED_SCHEMA, dialect="postgres", validate_qualify_columns=True
+        )
+    except sqlglot.errors.SqlglotError as e:
+        raise ValueError(f"{e}; the available tables are {schema_description()}")
+    for whole_row in qualified.find_all(exp.TableColumn):
+        raise ValueError(
+            f"{whole_row.name} is a whole row; select the columns you need by name"
+        )
+    for scope in traverse_scope(qualified):
+        outputs = set(scope.expression.named_selects)
+        for column in scope.columns:
+            source = scope.sources.get(column.table)
+            if isinstance(source, exp.Table) and column.name not in ALLOWED_COLUMNS[source.name]:
+                raise ValueError(
+                    f"Unknown column {column.name}; the available tables are {schema_description()}"
+                )
+            if column.table:
+                continue
+            if column.name not in outputs or not column.find_ancestor(exp.Order, exp.Group):
+                raise ValueError(
+                    f"Unknown column {column.name}; the available tables are {schema_description()}"
+                )
+
+    return tree.sql(dialect="postgres")
+
+
+async def run_sql(
+    pool,
+    query: str,
+    row_limit: int = SQL_ROW_LIMIT,
+    timeout_ms: int = SQL_STATEMENT_TIMEOUT_MS,
+    fetch_rows: int = SQL_FETCH_ROWS,
+) -> pd.DataFrame:
+    # The extra row tells a result that was cut off (attrs["truncated"]) from
+    # one that happened to have exactly row_limit rows
+    statement = f"SELECT * FROM ({validate_sql(query)}) AS result LIMIT {int(row_limit) + 1}"
+    frames = []
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            await conn.execute("SET TRANSACTION READ ONLY")
+            await conn.execute(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+            async with conn.cursor(name="run_sql", row_factory=tuple_row) as cur:
+                await cur.execute(statement)
+                names = [column.name for column in cur.description]
+                while True:
+                    rows = await cur.fetchmany(fetch_rows)
+                    if not rows:
+                        break
+                    frames.append(pd.DataFrame.from_records(rows, columns=names))
+
+    frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=names)
+    truncated = len(frame) > row_limit
+    frame = frame.iloc[:row_limit]
+    frame.attrs["truncated"] = truncated
+    return frame